@@ -1,2 +1,3 @@
 from .iresnet import iresnet18, iresnet34, iresnet50, iresnet100
 from .mixnetm import MixNet, mixnet_s, mixnet_m, mixnet_l
+from .inference import fuse_for_inference
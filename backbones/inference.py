@@ -0,0 +1,392 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from backbones.activation import Identity
+from backbones.mixnetm import MixConv, MixConvBlock, MixNet, MixUnit, PackedMixConv
+from backbones.utils import ConvBlock
+
+
+def _fold_bn(weight, bias, bn):
+    """
+    Fold the running statistics and affine parameters of a BatchNorm layer into a weight/bias pair.
+
+    Parameters:
+    ----------
+    weight : Tensor
+        Weight of the preceding layer, output channels first.
+    bias : Tensor or None
+        Bias of the preceding layer.
+    bn : nn.BatchNorm1d or nn.BatchNorm2d
+        Normalization layer applied to the output of the preceding layer.
+
+    Returns:
+    -------
+    tuple of two Tensors
+        Folded weight and bias.
+    """
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    weight = weight * scale.reshape([-1] + [1] * (weight.dim() - 1))
+    bias = shift if bias is None else bias * scale + shift
+    return weight, bias
+
+
+@torch.no_grad()
+def fuse_conv_bn(conv, bn):
+    """
+    Create a convolution with bias equivalent to `bn(conv(x))` in inference mode.
+
+    Parameters:
+    ----------
+    conv : nn.Conv2d
+        Convolution layer.
+    bn : nn.BatchNorm1d or nn.BatchNorm2d
+        Normalization layer applied to the output of the convolution.
+
+    Returns:
+    -------
+    nn.Conv2d
+        Fused convolution layer.
+    """
+    fused = nn.Conv2d(
+        in_channels=conv.in_channels,
+        out_channels=conv.out_channels,
+        kernel_size=conv.kernel_size,
+        stride=conv.stride,
+        padding=conv.padding,
+        dilation=conv.dilation,
+        groups=conv.groups,
+        bias=True,
+        padding_mode=conv.padding_mode).to(conv.weight.device)
+    weight, bias = _fold_bn(conv.weight, conv.bias, bn)
+    fused.weight.copy_(weight)
+    fused.bias.copy_(bias)
+    return fused
+
+
+@torch.no_grad()
+def fuse_mixconv_bn(mix_conv, bn):
+    """
+    Fold a BatchNorm layer into every per-kernel-size branch of a MixConv layer, in place.
+
+    Parameters:
+    ----------
+    mix_conv : MixConv
+        Mixed convolution layer.
+    bn : nn.BatchNorm2d
+        Normalization layer applied to the concatenated output of the mixed convolution.
+    """
+    start = 0
+    for name, conv in list(mix_conv.named_children()):
+        end = start + conv.out_channels
+        bn_i = nn.BatchNorm2d(num_features=conv.out_channels, eps=bn.eps, affine=bn.affine).to(conv.weight.device)
+        bn_i.running_mean.copy_(bn.running_mean[start:end])
+        bn_i.running_var.copy_(bn.running_var[start:end])
+        if bn.affine:
+            bn_i.weight.copy_(bn.weight[start:end])
+            bn_i.bias.copy_(bn.bias[start:end])
+        mix_conv.add_module(name, fuse_conv_bn(conv, bn_i))
+        start = end
+
+
+@torch.no_grad()
+def fuse_for_inference(model):
+    """
+    Fold every BatchNorm layer of a MixNet into the preceding convolution.
+
+    Covers the BatchNorm2d of each ConvBlock and MixConvBlock (including every branch of a MixConv) and the
+    final BatchNorm1d `features_norm`, which is folded into the pointwise convolution of `feautre_layer`.
+    The input model is left untouched.
+
+    Parameters:
+    ----------
+    model : MixNet
+        Trained model.
+
+    Returns:
+    -------
+    MixNet
+        Numerically equivalent model in eval mode without BatchNorm layers.
+    """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        if isinstance(module, ConvBlock) and module.use_bn:
+            module.conv = fuse_conv_bn(module.conv, module.bn)
+        elif isinstance(module, MixConvBlock) and module.use_bn:
+            fuse_mixconv_bn(module.conv, module.bn)
+        else:
+            continue
+        module.use_bn = False
+        del module.bn
+
+    if isinstance(model, MixNet) and isinstance(model.features_norm, nn.BatchNorm1d):
+        pw_conv = model.feautre_layer.pw_conv
+        assert (not pw_conv.use_bn) and (not pw_conv.activate)
+        pw_conv.conv = fuse_conv_bn(pw_conv.conv, model.features_norm)
+        model.features_norm = Identity()
+    return model
+
+
+@torch.no_grad()
+def pack_mixconv(model):
+    """
+    Replace every depthwise MixConv of a model by a PackedMixConv running a single depthwise convolution.
+    Pointwise (1x1) mixed convolutions are kept as they are. The input model is left untouched.
+
+    Parameters:
+    ----------
+    model : nn.Module
+        Trained model.
+
+    Returns:
+    -------
+    nn.Module
+        Numerically equivalent model in eval mode.
+    """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, MixConv) and (len(child._modules) > 1) and PackedMixConv.can_pack(child):
+                module.add_module(name, PackedMixConv.from_mixconv(child))
+    return model
+
+
+def _shuffle_permutation(channels, groups):
+    """
+    Channel order produced by `channel_shuffle2`: output channel c is input channel perm[c].
+    """
+    return torch.arange(channels).view(channels // groups, groups).t().reshape(-1)
+
+
+def _permute_rows(tensor, order):
+    """
+    Move row c of a tensor to row order[c].
+    """
+    out = torch.empty_like(tensor)
+    out[order] = tensor
+    return out
+
+
+def _permute_cols(tensor, order):
+    """
+    Move column c of a tensor to column order[c].
+    """
+    out = torch.empty_like(tensor)
+    out[:, order] = tensor
+    return out
+
+
+@torch.no_grad()
+def _mixconv_to_dense(mix_conv):
+    """
+    Convert a MixConv whose branches are all dense (groups=1) convolutions of the same shape into one
+    convolution with a block-diagonal weight.
+    """
+    convs = list(mix_conv.children())
+    first = convs[0]
+    for conv in convs:
+        if not ((conv.groups == 1) and (conv.kernel_size == first.kernel_size) and (conv.stride == first.stride) and
+                (conv.padding == first.padding) and (conv.dilation == first.dilation)):
+            raise ValueError("Only MixConv layers with dense branches of the same shape can be merged")
+    in_channels = sum(conv.in_channels for conv in convs)
+    out_channels = sum(conv.out_channels for conv in convs)
+    dense = nn.Conv2d(
+        in_channels=in_channels,
+        out_channels=out_channels,
+        kernel_size=first.kernel_size,
+        stride=first.stride,
+        padding=first.padding,
+        dilation=first.dilation,
+        bias=(first.bias is not None)).to(first.weight.device)
+    dense.weight.zero_()
+    in_start = 0
+    out_start = 0
+    for conv in convs:
+        in_end = in_start + conv.in_channels
+        out_end = out_start + conv.out_channels
+        dense.weight[out_start:out_end, in_start:in_end] = conv.weight
+        if conv.bias is not None:
+            dense.bias[out_start:out_end] = conv.bias
+        in_start = in_end
+        out_start = out_end
+    return dense
+
+
+def _block_conv(block):
+    """
+    Single nn.Conv2d of a ConvBlock or MixConvBlock. A MixConv is packed into one depthwise convolution if possible
+    and merged into one block-diagonal convolution otherwise.
+    """
+    if isinstance(block.conv, MixConv):
+        block.conv = PackedMixConv.from_mixconv(block.conv) if PackedMixConv.can_pack(block.conv) else \
+            _mixconv_to_dense(block.conv)
+    if isinstance(block.conv, PackedMixConv):
+        return block.conv.conv
+    return block.conv
+
+
+def _block_out_channels(block):
+    """
+    Number of output channels of a ConvBlock or MixConvBlock.
+    """
+    if isinstance(block.conv, MixConv):
+        return sum(conv.out_channels for conv in block.conv.children())
+    if isinstance(block.conv, PackedMixConv):
+        return block.conv.conv.out_channels
+    return block.conv.out_channels
+
+
+@torch.no_grad()
+def _permute_block_input(block, order):
+    """
+    Make a dense convolution block consume an input whose logical channel c is stored at channel order[c].
+    """
+    conv = _block_conv(block)
+    assert (conv.groups == 1)
+    conv.weight.copy_(_permute_cols(conv.weight, order))
+
+
+@torch.no_grad()
+def _permute_block_output(block, order):
+    """
+    Make a convolution block store its logical output channel c at channel order[c]. For a depthwise block this
+    also makes it consume an input stored in the same order.
+    """
+    conv = _block_conv(block)
+    conv.weight.copy_(_permute_rows(conv.weight, order))
+    if conv.bias is not None:
+        conv.bias.copy_(_permute_rows(conv.bias, order))
+    if block.use_bn:
+        for tensor in [block.bn.weight, block.bn.bias, block.bn.running_mean, block.bn.running_var]:
+            tensor.copy_(_permute_rows(tensor, order))
+    if block.activate and isinstance(block.activ, nn.PReLU) and (block.activ.num_parameters > 1):
+        block.activ.weight.copy_(_permute_rows(block.activ.weight, order))
+
+
+@torch.no_grad()
+def _permute_se(se, order):
+    """
+    Make an SE block work on an input whose logical channel c is stored at channel order[c].
+    """
+    assert se.use_conv
+    se.conv1.weight.copy_(_permute_cols(se.conv1.weight, order))
+    se.conv2.weight.copy_(_permute_rows(se.conv2.weight, order))
+    se.conv2.bias.copy_(_permute_rows(se.conv2.bias, order))
+
+
+@torch.no_grad()
+def _absorb_unit_shuffle(unit, order):
+    """
+    Rewrite a MixUnit so that it consumes an input stored in the given channel order and drops its trailing
+    channel shuffle.
+
+    Parameters:
+    ----------
+    unit : MixUnit
+        Unit to rewrite in place.
+    order : Tensor or None
+        Logical input channel c is stored at channel order[c]; None for the natural order.
+
+    Returns:
+    -------
+    Tensor or None
+        Storage order of the logical output channels of the unit.
+    """
+    if order is not None:
+        if unit.use_exp_conv:
+            _permute_block_input(unit.exp_conv, order)
+        else:
+            # The depthwise convolution (and the SE block) keep working in the permuted order.
+            _permute_block_output(unit.conv1, order)
+            if unit.use_se:
+                _permute_se(unit.se, order)
+            _permute_block_input(unit.conv2, order)
+        if unit.residual:
+            # The identity path is stored in the permuted order, so the main path has to match it.
+            _permute_block_output(unit.conv2, order)
+        else:
+            order = None
+    if unit.shuffle:
+        perm = _shuffle_permutation(_block_out_channels(unit.conv2), 2)
+        order = perm if order is None else order[perm]
+        unit.shuffle = False
+    return order
+
+
+@torch.no_grad()
+def absorb_channel_shuffle(model):
+    """
+    Fold every `channel_shuffle2` of a (Shuffle)MixNet into the weights of the following layers.
+
+    A channel shuffle is a fixed permutation, so instead of copying the activation map the consumers of a shuffled
+    tensor are re-indexed: the input channels of the next dense convolution, the channels of depthwise
+    convolutions/SE blocks in between, and the output channels of the residual branch, which has to match the
+    stored order of the identity path. Pointwise MixConv layers adjacent to a shuffle are merged into one
+    block-diagonal convolution, because the permutation mixes their branches. The input model is left untouched.
+
+    Parameters:
+    ----------
+    model : MixNet
+        Trained model.
+
+    Returns:
+    -------
+    MixNet
+        Numerically equivalent model in eval mode without channel shuffle copies.
+    """
+    model = copy.deepcopy(model).eval()
+    order = None
+    for module in model.features.modules():
+        if isinstance(module, MixUnit):
+            order = _absorb_unit_shuffle(module, order)
+    if order is not None:
+        _permute_block_input(model.tail, order)
+    return model
+
+
+def _test():
+    from backbones.mixnetm import mixnet_s, mixnet_m
+
+    for model in [mixnet_s, mixnet_m]:
+        for shuffle in [True, False]:
+            net = model(embedding_size=512, width_scale=0.5, shuffle=shuffle)
+            # Random running statistics so that the folding is actually exercised.
+            for module in net.modules():
+                if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d)):
+                    module.running_mean.uniform_(-0.5, 0.5)
+                    module.running_var.uniform_(0.5, 2.0)
+                    module.bias.data.uniform_(-0.5, 0.5)
+            net.eval()
+            fused = fuse_for_inference(net)
+            assert not any(isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d)) for m in fused.modules())
+
+            x = torch.randn(4, 3, 112, 112)
+            with torch.no_grad():
+                y = net(x)
+                y_fused = fused(x)
+            assert torch.allclose(y, y_fused, rtol=1e-3, atol=1e-3), (y - y_fused).abs().max()
+            print("m={}, shuffle={}, max abs diff={}".format(model.__name__, shuffle, (y - y_fused).abs().max()))
+
+            for candidate in [net, fused]:
+                packed = pack_mixconv(candidate)
+                assert any(isinstance(m, PackedMixConv) for m in packed.modules())
+                with torch.no_grad():
+                    y_packed = packed(x)
+                assert torch.allclose(y, y_packed, rtol=1e-3, atol=1e-3), (y - y_packed).abs().max()
+
+            for candidate in [net, fused, pack_mixconv(fused)]:
+                unshuffled = absorb_channel_shuffle(candidate)
+                assert not any(m.shuffle for m in unshuffled.modules() if isinstance(m, MixUnit))
+                with torch.no_grad():
+                    y_unshuffled = unshuffled(x)
+                assert torch.allclose(y, y_unshuffled, rtol=1e-3, atol=1e-3), (y - y_unshuffled).abs().max()
+
+
+if __name__ == "__main__":
+    _test()
@@ -1,6 +1,6 @@
 
 
-__all__ = ['MixNet', 'mixnet_s', 'mixnet_m', 'mixnet_l']
+__all__ = ['MixNet', 'mixnet_s', 'mixnet_m', 'mixnet_l', 'PackedMixConv']
 
 
 import torch.nn.init as init
@@ -93,6 +93,105 @@ class MixConv(nn.Module):
         return splitted_channels
 
 
+class PackedMixConv(nn.Module):
+    """
+    Depthwise mixed convolution executed as a single depthwise convolution. The kernels of the smaller branches
+    are zero-padded (centered) to the largest kernel size, so the layer runs one convolution into one output
+    buffer instead of split/per-branch convolutions/concatenation.
+
+    Parameters:
+    ----------
+    channels : int
+        Number of input/output channels.
+    kernel_size : int
+        Largest convolution window size.
+    stride : int or tuple/list of 2 int
+        Strides of the convolution.
+    dilation : int or tuple/list of 2 int, default 1
+        Dilation value for convolution layer.
+    bias : bool, default False
+        Whether the layer uses a bias vector.
+    """
+    def __init__(self,
+                 channels,
+                 kernel_size,
+                 stride,
+                 dilation=1,
+                 bias=False):
+        super(PackedMixConv, self).__init__()
+        self.conv = nn.Conv2d(
+            in_channels=channels,
+            out_channels=channels,
+            kernel_size=kernel_size,
+            stride=stride,
+            padding=(dilation * (kernel_size - 1) // 2),
+            dilation=dilation,
+            groups=channels,
+            bias=bias)
+
+    def forward(self, x):
+        return self.conv(x)
+
+    @staticmethod
+    def can_pack(mix_conv):
+        """
+        Whether a MixConv layer is depthwise with centered padding in every branch.
+        """
+        for conv in mix_conv.children():
+            if not ((conv.groups == conv.in_channels == conv.out_channels) and
+                    (conv.kernel_size[0] == conv.kernel_size[1]) and (conv.kernel_size[0] % 2 == 1) and
+                    (conv.dilation[0] == conv.dilation[1]) and
+                    (conv.padding[0] == conv.padding[1] == conv.dilation[0] * (conv.kernel_size[0] - 1) // 2)):
+                return False
+        convs = list(mix_conv.children())
+        return (len(set(conv.stride for conv in convs)) == 1) and (len(set(conv.dilation for conv in convs)) == 1)
+
+    @classmethod
+    def from_mixconv(cls, mix_conv):
+        """
+        Build a packed layer from the state dict of a trained depthwise MixConv layer.
+
+        Parameters:
+        ----------
+        mix_conv : MixConv
+            Depthwise mixed convolution layer.
+
+        Returns:
+        -------
+        PackedMixConv
+            Equivalent packed layer.
+        """
+        if not cls.can_pack(mix_conv):
+            raise ValueError("Only depthwise MixConv layers with centered padding can be packed")
+        convs = list(mix_conv.children())
+        state_dict = mix_conv.state_dict()
+        channels = sum(conv.out_channels for conv in convs)
+        kernel_size = max(conv.kernel_size[0] for conv in convs)
+        use_bias = convs[0].bias is not None
+        packed = cls(
+            channels=channels,
+            kernel_size=kernel_size,
+            stride=convs[0].stride,
+            dilation=convs[0].dilation[0],
+            bias=use_bias)
+        weight = state_dict["0.weight"].new_zeros(channels, 1, kernel_size, kernel_size)
+        bias = weight.new_zeros(channels) if use_bias else None
+        start = 0
+        for i, conv in enumerate(convs):
+            end = start + conv.out_channels
+            offset = (kernel_size - conv.kernel_size[0]) // 2
+            weight[start:end, :, offset:offset + conv.kernel_size[0], offset:offset + conv.kernel_size[1]] = \
+                state_dict["{}.weight".format(i)]
+            if use_bias:
+                bias[start:end] = state_dict["{}.bias".format(i)]
+            start = end
+        packed_state_dict = {"conv.weight": weight}
+        if use_bias:
+            packed_state_dict["conv.bias"] = bias
+        packed.load_state_dict(packed_state_dict)
+        return packed
+
+
 class MixConvBlock(nn.Module):
     """
     Mixed convolution block with Batch normalization and activation.
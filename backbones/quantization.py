@@ -0,0 +1,259 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn.quantized import FloatFunctional
+from torch.quantization import DeQuantStub, QuantStub
+
+from backbones.activation import Swish
+from backbones.common import SEBlock
+from backbones.inference import fuse_for_inference, pack_mixconv
+from backbones.mixnetm import MixConv, MixUnit
+from backbones.utils import channel_shuffle2
+
+
+class QuantizableSwish(nn.Module):
+    """
+    Swish activation with the product expressed through FloatFunctional, so that it is observed during
+    calibration and runs as a quantized multiplication after conversion.
+    """
+    def __init__(self):
+        super(QuantizableSwish, self).__init__()
+        self.sigmoid = nn.Sigmoid()
+        self.mul = FloatFunctional()
+
+    def forward(self, x):
+        return self.mul.mul(x, self.sigmoid(x))
+
+
+class FloatPReLU(nn.Module):
+    """
+    PReLU executed in floating point between a dequantization and a quantization, for quantization engines
+    without a quantized PReLU kernel.
+
+    Parameters:
+    ----------
+    prelu : nn.PReLU
+        Trained activation layer.
+    """
+    def __init__(self, prelu):
+        super(FloatPReLU, self).__init__()
+        self.dequant = DeQuantStub()
+        self.prelu = prelu
+        # Keep the activation out of observation/conversion.
+        self.prelu.qconfig = None
+        self.quant = QuantStub()
+
+    def forward(self, x):
+        return self.quant(self.prelu(self.dequant(x)))
+
+
+class QuantizableMixConv(MixConv):
+    """
+    MixConv whose concatenation goes through FloatFunctional, so that the branches share one set of output
+    quantization parameters.
+    """
+    def forward(self, x):
+        xx = torch.split(x, self.splitted_in_channels, dim=self.axis)
+        out = [getattr(self, str(i))(x_i) for i, x_i in enumerate(xx)]
+        return self.cat.cat(out, dim=self.axis)
+
+    @classmethod
+    def make_quantizable(cls, module):
+        module.__class__ = cls
+        module.cat = FloatFunctional()
+        return module
+
+
+class QuantizableSEBlock(SEBlock):
+    """
+    SE block whose channel re-weighting goes through FloatFunctional.
+    """
+    def forward(self, x):
+        w = self.pool(x)
+        if not self.use_conv:
+            w = w.view(x.size(0), -1)
+        w = self.conv1(w) if self.use_conv else self.fc1(w)
+        w = self.activ(w)
+        w = self.conv2(w) if self.use_conv else self.fc2(w)
+        w = self.sigmoid(w)
+        if not self.use_conv:
+            w = w.unsqueeze(2).unsqueeze(3)
+        return self.mul.mul(x, w)
+
+    @classmethod
+    def make_quantizable(cls, module):
+        module.__class__ = cls
+        module.mul = FloatFunctional()
+        return module
+
+
+class QuantizableMixUnit(MixUnit):
+    """
+    MixNet unit whose residual addition goes through FloatFunctional.
+    """
+    def forward(self, x):
+        if self.residual:
+            identity = x
+        if self.use_exp_conv:
+            x = self.exp_conv(x)
+        x = self.conv1(x)
+        if self.use_se:
+            x = self.se(x)
+        x = self.conv2(x)
+        if self.residual:
+            x = self.skip_add.add(x, identity)
+        if self.shuffle:
+            x = channel_shuffle2(x, 2)
+        return x
+
+    @classmethod
+    def make_quantizable(cls, module):
+        module.__class__ = cls
+        module.skip_add = FloatFunctional()
+        return module
+
+
+class QuantizableMixNet(nn.Module):
+    """
+    Wrapper placing quantization/dequantization stubs around a MixNet prepared by `prepare_mixnet`.
+
+    Parameters:
+    ----------
+    model : MixNet
+        Model with quantization-friendly modules.
+    """
+    def __init__(self, model):
+        super(QuantizableMixNet, self).__init__()
+        self.quant = QuantStub()
+        self.model = model
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.model(x)
+        return self.dequant(x)
+
+
+def _has_quantized_prelu():
+    from torch.quantization import get_default_static_quant_module_mappings
+    return nn.PReLU in get_default_static_quant_module_mappings()
+
+
+@torch.no_grad()
+def prepare_mixnet(model, backend="fbgemm"):
+    """
+    Turn a trained MixNet into an observed model ready for calibration.
+
+    BatchNorm layers are folded and depthwise MixConv layers packed first (see backbones/inference.py). The
+    residual additions, SE multiplications, MixConv concatenations and Swish products are then routed through
+    FloatFunctional, and PReLU layers run in floating point if the installed PyTorch has no quantized PReLU.
+    The input model is left untouched.
+
+    Parameters:
+    ----------
+    model : MixNet
+        Trained model.
+    backend : str, default 'fbgemm'
+        Quantization engine, 'fbgemm' for x86 or 'qnnpack' for ARM CPUs.
+
+    Returns:
+    -------
+    QuantizableMixNet
+        Model with observers, in eval mode.
+    """
+    model = pack_mixconv(fuse_for_inference(model))
+    float_prelu = not _has_quantized_prelu()
+    for module in list(model.modules()):
+        if isinstance(module, MixConv):
+            QuantizableMixConv.make_quantizable(module)
+        elif isinstance(module, SEBlock):
+            QuantizableSEBlock.make_quantizable(module)
+        elif isinstance(module, MixUnit):
+            QuantizableMixUnit.make_quantizable(module)
+        for name, child in list(module.named_children()):
+            if isinstance(child, Swish):
+                module.add_module(name, QuantizableSwish())
+            elif float_prelu and isinstance(child, nn.PReLU):
+                module.add_module(name, FloatPReLU(child))
+
+    model = QuantizableMixNet(model).eval()
+    torch.backends.quantized.engine = backend
+    model.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(model, inplace=True)
+    return model
+
+
+@torch.no_grad()
+def calibrate(model, data_loader, num_batches=None):
+    """
+    Run normalized float batches through an observed model to collect activation ranges.
+
+    Parameters:
+    ----------
+    model : QuantizableMixNet
+        Model returned by `prepare_mixnet`.
+    data_loader : iterable
+        Yields (image, label) batches of normalized float32 images.
+    num_batches : int or None, default None
+        Maximum number of batches, all batches if None.
+    """
+    model.eval()
+    for i, (img, _) in enumerate(data_loader):
+        if (num_batches is not None) and (i >= num_batches):
+            break
+        model(img)
+
+
+def quantize_mixnet(model, data_loader, num_batches=None, backend="fbgemm"):
+    """
+    Post-training static INT8 quantization of a trained MixNet.
+
+    Parameters:
+    ----------
+    model : MixNet
+        Trained model, left untouched.
+    data_loader : iterable
+        Calibration batches of normalized float32 images.
+    num_batches : int or None, default None
+        Maximum number of calibration batches.
+    backend : str, default 'fbgemm'
+        Quantization engine, 'fbgemm' for x86 or 'qnnpack' for ARM CPUs.
+
+    Returns:
+    -------
+    QuantizableMixNet
+        Quantized model running on CPU.
+    """
+    # model.cpu() works in place, move a copy.
+    model = prepare_mixnet(copy.deepcopy(model).cpu(), backend)
+    calibrate(model, data_loader, num_batches)
+    return torch.quantization.convert(model, inplace=True)
+
+
+def _test():
+    from backbones.mixnetm import mixnet_s
+
+    torch.manual_seed(0)
+    net = mixnet_s(embedding_size=512, width_scale=0.5)
+    # BatchNorm statistics of the input distribution, so that the float model is a meaningful reference.
+    with torch.no_grad():
+        for _ in range(4):
+            net(torch.randn(8, 3, 112, 112))
+    net.eval()
+    calib = [(torch.randn(8, 3, 112, 112), None) for _ in range(4)]
+    qnet = quantize_mixnet(net, calib)
+    assert not any(isinstance(m, (Swish, nn.BatchNorm2d)) for m in qnet.modules())
+
+    x = torch.randn(4, 3, 112, 112)
+    with torch.no_grad():
+        y = net(x)
+        y_q = qnet(x)
+    assert tuple(y_q.size()) == (4, 512)
+    cos = nn.functional.cosine_similarity(y, y_q).min()
+    print("min cosine similarity fp32/int8: {}".format(cos))
+    assert cos > 0.9, cos
+
+
+if __name__ == "__main__":
+    _test()
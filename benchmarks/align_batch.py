@@ -0,0 +1,56 @@
+"""Per-image estimate_norm/norm_crop against the batched Umeyama solver and warp of utils/align_trans on a stack
+of synthetic video frames, with the pixel difference between both paths.
+
+Usage: python -m benchmarks.align_batch --num_faces 256 --frame_size 720 1280
+"""
+import argparse
+import time
+
+import numpy as np
+
+from utils.align_trans import arcface_ref_points, estimate_norm, estimate_norm_batch, norm_crop, norm_crop_batch
+
+
+def synthetic_frames(num_faces, height, width, seed=0):
+    """
+    Random frames with one face-sized landmark set each (random scale, rotation and position).
+    """
+    rng = np.random.RandomState(seed)
+    frames = rng.randint(0, 256, (num_faces, height, width, 3), dtype=np.uint8)
+    angles = rng.uniform(-0.4, 0.4, num_faces)
+    scales = rng.uniform(1.0, 3.0, num_faces)
+    R = np.stack([np.stack([np.cos(angles), -np.sin(angles)], 1), np.stack([np.sin(angles), np.cos(angles)], 1)], 1)
+    centers = np.stack([rng.uniform(200, width - 200, num_faces), rng.uniform(200, height - 200, num_faces)], 1)
+    lmks = np.einsum('nij,kj->nki', R * scales[:, None, None], arcface_ref_points - 56.0) + centers[:, None]
+    return frames, (lmks + rng.randn(num_faces, 5, 2)).astype(np.float32)
+
+
+def main(args):
+    frames, lmks = synthetic_frames(args.num_faces, *args.frame_size)
+
+    tic = time.perf_counter()
+    for lmk in lmks:
+        estimate_norm(lmk)
+    loop_estimate = time.perf_counter() - tic
+    tic = time.perf_counter()
+    estimate_norm_batch(lmks)
+    batch_estimate = time.perf_counter() - tic
+    print("estimate: per image {:8.2f} ms, batched {:8.2f} ms".format(loop_estimate * 1000, batch_estimate * 1000))
+
+    tic = time.perf_counter()
+    ref = np.stack([norm_crop(frame, lmk) for frame, lmk in zip(frames, lmks)])
+    loop_crop = time.perf_counter() - tic
+    tic = time.perf_counter()
+    aligned = norm_crop_batch(frames, lmks)
+    batch_crop = time.perf_counter() - tic
+    print("norm_crop: per image {:8.2f} ms, batched {:8.2f} ms".format(loop_crop * 1000, batch_crop * 1000))
+
+    diff = np.abs(aligned.astype(np.int16) - ref.astype(np.int16))
+    print("pixel difference: mean {:.4f}, max {}".format(diff.mean(), diff.max()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Batched face alignment benchmark')
+    parser.add_argument('--num_faces', type=int, default=256, help='number of faces')
+    parser.add_argument('--frame_size', type=int, nargs=2, default=[720, 1280], help='frame height and width')
+    main(parser.parse_args())
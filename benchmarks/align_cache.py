@@ -0,0 +1,67 @@
+"""Throughput of per-face norm_crop against the AlignmentCache on a synthetic video stream, at several fractions of
+repeated faces (re-detections of the same face on an unchanged frame region).
+
+Usage: python -m benchmarks.align_cache --length 20000 --repeat 0 0.5 0.9 0.99
+"""
+import argparse
+import time
+
+import numpy as np
+
+from utils.align_trans import arcface_ref_points, norm_crop
+from utils.utils_cache import AlignmentCache
+
+
+def synthetic_stream(length, repeat, num_frames, height, width, history, seed=0):
+    """
+    (frame index, landmarks) items: with probability `repeat` a face from the recent history, otherwise a new face
+    at a random position, scale and rotation in one of the frames.
+    """
+    rng = np.random.RandomState(seed)
+    items = []
+    for _ in range(length):
+        if items and rng.rand() < repeat:
+            items.append(items[-1 - rng.randint(min(history, len(items)))])
+            continue
+        angle = rng.uniform(-0.4, 0.4)
+        scale = rng.uniform(1.0, 2.5)
+        R = scale * np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        center = np.array([rng.uniform(160, width - 160), rng.uniform(160, height - 160)])
+        lmk = ((arcface_ref_points - 56.0) @ R.T + center).astype(np.float32)
+        items.append((rng.randint(num_frames), lmk))
+    return items
+
+
+def run(align, frames, items):
+    tic = time.perf_counter()
+    for frame_index, lmk in items:
+        align(frames[frame_index], lmk)
+    return len(items) / (time.perf_counter() - tic)
+
+
+def main(args):
+    rng = np.random.RandomState(0)
+    frames = rng.randint(0, 256, (args.num_frames, args.frame_size[0], args.frame_size[1], 3), dtype=np.uint8)
+    for repeat in args.repeat:
+        items = synthetic_stream(args.length, repeat, args.num_frames, args.frame_size[0], args.frame_size[1],
+                                 args.history)
+        baseline = run(norm_crop, frames, items)
+        cache = AlignmentCache(max_entries=args.max_entries, disk_dir=args.disk_dir)
+        cached = run(cache, frames, items)
+        metrics = cache.metrics()
+        print("repeat {:.2f}: norm_crop {:8.0f} faces/s, cached {:8.0f} faces/s ({:.2f}x), "
+              "hit rate {:.3f}, evictions {}".format(repeat, baseline, cached, cached / baseline,
+                                                     metrics["hit_rate"], metrics["evictions"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Alignment cache benchmark')
+    parser.add_argument('--length', type=int, default=20000, help='number of faces in the stream')
+    parser.add_argument('--repeat', type=float, nargs='+', default=[0.0, 0.5, 0.9, 0.99],
+                        help='fractions of repeated faces')
+    parser.add_argument('--history', type=int, default=256, help='repeated faces are drawn from the last N faces')
+    parser.add_argument('--num_frames', type=int, default=16, help='distinct frames')
+    parser.add_argument('--frame_size', type=int, nargs=2, default=[720, 1280], help='frame height and width')
+    parser.add_argument('--max_entries', type=int, default=4096, help='in-memory cache size')
+    parser.add_argument('--disk_dir', type=str, default=None, help='directory of the on-disk tier')
+    main(parser.parse_args())
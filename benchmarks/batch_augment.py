@@ -0,0 +1,50 @@
+"""CPU time per batch of the per-sample PIL augmentation against the batched uint8 FaceCollate.
+
+Usage: python -m benchmarks.batch_augment --batch_size 128
+"""
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+
+from benchmarks.bench_utils import time_fn
+from dataset import FaceCollate
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    rng = np.random.RandomState(0)
+    batch = [(rng.randint(0, 256, (112, 112, 3), dtype=np.uint8), torch.tensor(i, dtype=torch.long))
+             for i in range(args.batch_size)]
+    per_sample = transforms.Compose(
+        [transforms.ToPILImage(),
+         transforms.RandomHorizontalFlip(),
+         transforms.ToTensor(),
+         transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+         ])
+
+    def before():
+        return default_collate([(per_sample(sample), label) for sample, label in batch])
+
+    collate = FaceCollate()
+    collate_uint8 = FaceCollate(normalize=False)
+
+    # Without flipping both pipelines have to produce the same batch.
+    no_flip = transforms.Compose(per_sample.transforms[:1] + per_sample.transforms[2:])
+    reference = torch.stack([no_flip(sample) for sample, _ in batch])
+    assert torch.allclose(reference, FaceCollate(flip=False)(batch)[0], atol=1e-5)
+
+    for name, fn in [("per-sample PIL", before), ("FaceCollate", lambda: collate(batch)),
+                     ("FaceCollate uint8", lambda: collate_uint8(batch))]:
+        median, p90 = time_fn(fn, warmup=3, iters=args.iters)
+        print("{:<18} {:>8.2f} ms/batch (p90 {:.2f})".format(name, median, p90))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Batched augmentation benchmark')
+    parser.add_argument('--batch_size', type=int, default=128, help='batch size')
+    parser.add_argument('--threads', type=int, default=1, help='number of intra-op threads')
+    parser.add_argument('--iters', type=int, default=20, help='timed iterations')
+    main(parser.parse_args())
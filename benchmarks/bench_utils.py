@@ -0,0 +1,41 @@
+import time
+
+import numpy as np
+import torch
+
+
+def time_fn(fn, warmup=5, iters=20):
+    """
+    Measure the wall-clock time of a callable.
+
+    Parameters:
+    ----------
+    fn : callable
+        Function without arguments to measure.
+    warmup : int, default 5
+        Number of untimed calls before measuring.
+    iters : int, default 20
+        Number of timed calls.
+
+    Returns:
+    -------
+    tuple of two floats
+        Median and 90th percentile time per call in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        tic = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - tic) * 1000.0)
+    return float(np.median(times)), float(np.percentile(times, 90))
+
+
+def time_model(model, x, warmup=5, iters=20):
+    """
+    Measure the eval-mode forward latency of a model on a fixed input.
+    """
+    model.eval()
+    with torch.no_grad():
+        return time_fn(lambda: model(x), warmup=warmup, iters=iters)
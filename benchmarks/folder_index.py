@@ -0,0 +1,66 @@
+"""Start-up time of FaceDatasetFolder with a cold scan against the cached memory-mapped index.
+
+Also checks the cached index against a plain os.listdir walk of the same tree.
+
+Usage: python -m benchmarks.folder_index --root /data/faces_folder
+       python -m benchmarks.folder_index --work_dir /tmp/folder_bench --num_identities 2000
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from dataset import FaceDatasetFolder
+
+
+def make_synthetic_folder(root, num_identities, images_per_identity):
+    for i in range(num_identities):
+        identity_dir = os.path.join(root, "{:07d}".format(i))
+        os.makedirs(identity_dir, exist_ok=True)
+        for j in range(images_per_identity):
+            open(os.path.join(identity_dir, "{:03d}.jpg".format(j)), 'wb').close()
+
+
+def listdir_walk(root):
+    paths, labels = [], []
+    for label, identity in enumerate(sorted(d for d in os.listdir(root) if not d.startswith('.'))):
+        for img in sorted(os.listdir(os.path.join(root, identity))):
+            paths.append(os.path.join(identity, img))
+            labels.append(label)
+    return paths, labels
+
+
+def main(args):
+    root = args.root
+    if root is None:
+        root = os.path.join(args.work_dir, "folder")
+        if not os.path.exists(root):
+            make_synthetic_folder(root, args.num_identities, args.images_per_identity)
+
+    tic = time.perf_counter()
+    paths, labels = listdir_walk(root)
+    print("listdir walk:         {:8.3f}s  ({} images)".format(time.perf_counter() - tic, len(paths)))
+
+    tic = time.perf_counter()
+    dataset = FaceDatasetFolder(root, 0, cache_dir=args.cache_dir, rebuild_index=True)
+    print("parallel scan + save: {:8.3f}s".format(time.perf_counter() - tic))
+
+    tic = time.perf_counter()
+    dataset = FaceDatasetFolder(root, 0, cache_dir=args.cache_dir)
+    print("cached index:         {:8.3f}s".format(time.perf_counter() - tic))
+
+    assert len(dataset) == len(paths)
+    assert [p.decode('utf-8') for p in dataset.imgidx] == paths
+    assert np.array_equal(np.asarray(dataset.labels), np.array(labels))
+    print("index matches the listdir walk")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Folder index benchmark')
+    parser.add_argument('--root', type=str, default=None, help='existing dataset folder')
+    parser.add_argument('--cache_dir', type=str, default=None, help='index cache directory, default the root')
+    parser.add_argument('--work_dir', type=str, default="/tmp/folder_bench", help='directory for the synthetic tree')
+    parser.add_argument('--num_identities', type=int, default=2000, help='synthetic identities')
+    parser.add_argument('--images_per_identity', type=int, default=20, help='synthetic images per identity')
+    main(parser.parse_args())
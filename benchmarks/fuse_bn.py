@@ -0,0 +1,38 @@
+"""CPU latency of MixFaceNets before and after folding BatchNorm into the convolutions.
+
+Usage: python -m benchmarks.fuse_bn --threads 4
+"""
+import argparse
+
+import torch
+
+import backbones.mixnetm as mx
+from backbones.inference import fuse_for_inference
+from benchmarks.bench_utils import time_model
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    print("threads: {}".format(torch.get_num_threads()))
+    print("{:<10} {:>6} {:>12} {:>12} {:>8}".format("model", "batch", "eager ms", "fused ms", "speedup"))
+    for name in ["mixnet_s", "mixnet_m"]:
+        net = getattr(mx, name)(embedding_size=512, width_scale=args.scale, gdw_size=args.gdw_size).eval()
+        fused = fuse_for_inference(net)
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, 3, 112, 112)
+            with torch.no_grad():
+                diff = (net(x) - fused(x)).abs().max().item()
+            t_eager, _ = time_model(net, x, iters=args.iters)
+            t_fused, _ = time_model(fused, x, iters=args.iters)
+            print("{:<10} {:>6} {:>12.2f} {:>12.2f} {:>7.2f}x  (max abs diff {:.2e})".format(
+                name, batch_size, t_eager, t_fused, t_eager / t_fused, diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BatchNorm folding benchmark')
+    parser.add_argument('--threads', type=int, default=1, help='number of intra-op threads')
+    parser.add_argument('--scale', type=float, default=1.0, help='width scale')
+    parser.add_argument('--gdw_size', type=int, default=512, help='GDC embedding size')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32], help='batch sizes')
+    parser.add_argument('--iters', type=int, default=20, help='timed iterations')
+    main(parser.parse_args())
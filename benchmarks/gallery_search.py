@@ -0,0 +1,91 @@
+"""Recall@k and per-query latency of the exact float16/int8 gallery search and of the IVF-PQ index against the
+float32 brute-force baseline, on synthetic clustered galleries.
+
+Usage: python -m benchmarks.gallery_search --sizes 100000 1000000 --num_queries 200
+"""
+import argparse
+import time
+
+import numpy as np
+
+from gallery import Gallery, IVFPQIndex, l2_normalize
+
+
+def synthetic_embeddings(num, dim, centers, rng, sigma):
+    """
+    Normalized embeddings scattered around random identity centers (cosine to the center around 0.7).
+    """
+    labels = rng.randint(len(centers), size=num)
+    noise = rng.standard_normal((num, dim)).astype(np.float32) * sigma
+    return l2_normalize(centers[labels] + noise)
+
+
+def build(size, dim, num_ids, chunk, seed):
+    rng = np.random.RandomState(seed)
+    centers = l2_normalize(rng.standard_normal((num_ids, dim)))
+    sigma = 1.0 / np.sqrt(dim)
+    for start in range(0, size, chunk):
+        end = min(start + chunk, size)
+        yield np.arange(start, end), synthetic_embeddings(end - start, dim, centers, rng, sigma)
+
+
+def recall(ids, ref_ids):
+    k = ref_ids.shape[1]
+    return float(np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(ids, ref_ids)]))
+
+
+def timed_search(search, queries, query_batch):
+    tic = time.perf_counter()
+    ids = np.concatenate([search(queries[i:i + query_batch])[1] for i in range(0, len(queries), query_batch)])
+    return ids, (time.perf_counter() - tic) * 1000.0 / len(queries)
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed + 1)
+    for size in args.sizes:
+        galleries = {dtype: Gallery(dim=args.dim, dtype=dtype, capacity=size) for dtype in ["float32"] + args.dtypes}
+        index = IVFPQIndex(dim=args.dim, num_lists=args.num_lists, num_subspaces=args.num_subspaces)
+        tic = time.perf_counter()
+        for i, (ids, x) in enumerate(build(size, args.dim, args.num_ids, args.chunk, args.seed)):
+            if i == 0:
+                index.train(x[:args.train_size], num_iters=args.kmeans_iters)
+            for gallery in galleries.values():
+                gallery.add(x, ids)
+            index.add(x, ids)
+        print("size {}: built in {:.1f}s".format(size, time.perf_counter() - tic))
+
+        baseline = galleries.pop("float32")
+        rows = rng.choice(size, args.num_queries, replace=False)
+        noise = rng.standard_normal((args.num_queries, args.dim)).astype(np.float32) * 0.5 / np.sqrt(args.dim)
+        queries = baseline.reconstruct(rows) + noise
+        ref_ids, ms = timed_search(lambda q: baseline.search(q, args.k), queries, args.query_batch)
+        print("  {:<22} recall@{} 1.0000  {:8.3f} ms/query  {:7.1f} MB".format(
+            "exact float32", args.k, ms, baseline.codes.nbytes / 2 ** 20))
+        for dtype, gallery in galleries.items():
+            ids, ms = timed_search(lambda q: gallery.search(q, args.k), queries, args.query_batch)
+            print("  {:<22} recall@{} {:.4f}  {:8.3f} ms/query  {:7.1f} MB".format(
+                "exact " + dtype, args.k, recall(ids, ref_ids), ms, gallery.codes.nbytes / 2 ** 20))
+        index.search(queries[:1], args.k)
+        for nprobe in args.nprobe:
+            ids, ms = timed_search(lambda q: index.search(q, args.k, nprobe), queries, args.query_batch)
+            print("  {:<22} recall@{} {:.4f}  {:8.3f} ms/query  {:7.1f} MB".format(
+                "ivfpq nprobe={}".format(nprobe), args.k, recall(ids, ref_ids), ms, index.codes.nbytes / 2 ** 20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Gallery search benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000], help='gallery sizes')
+    parser.add_argument('--dim', type=int, default=512, help='embedding size')
+    parser.add_argument('--num_ids', type=int, default=20000, help='synthetic identities')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=["float16", "int8"], help='exact gallery dtypes')
+    parser.add_argument('--num_queries', type=int, default=200, help='number of queries')
+    parser.add_argument('--query_batch', type=int, default=50, help='queries per search call')
+    parser.add_argument('--k', type=int, default=10, help='neighbours')
+    parser.add_argument('--num_lists', type=int, default=1024, help='IVF lists')
+    parser.add_argument('--num_subspaces', type=int, default=64, help='PQ sub-vectors')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 32, 128], help='probed lists')
+    parser.add_argument('--train_size', type=int, default=50000, help='IVF-PQ training sample')
+    parser.add_argument('--kmeans_iters', type=int, default=10, help='k-means iterations')
+    parser.add_argument('--chunk', type=int, default=100000, help='rows generated at once')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+"""Latency benchmark suite over the backbone variants: warm CPU latency and throughput per batch size and thread
+count, peak resident memory, parameters and FLOPs (count_model_flops). Every variant is measured in its own
+subprocess so that the peak memory of one model does not leak into the next. Results are written as JSON and
+CSV, plot_latency.py plots them.
+
+Usage: python -m benchmarks.latency --output latency --batch_sizes 1 8 32 --threads 1 4
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+
+import torch
+
+import backbones
+from backbones.utils import _calc_width, count_model_flops
+from benchmarks.bench_utils import time_model
+
+IRESNETS = ["iresnet18", "iresnet34", "iresnet50", "iresnet100"]
+FIELDS = ["variant", "family", "params", "mflops", "batch_size", "threads", "latency_ms", "latency_p90_ms",
+          "throughput", "peak_rss_mb"]
+
+
+def variant_names(scales):
+    """
+    mixnet_s/mixnet_m at every width scale and mixnet_l (width 1.3), each with and without channel shuffle,
+    followed by the iresnets.
+    """
+    names = []
+    for model in ["mixnet_s", "mixnet_m"]:
+        for scale in scales:
+            for shuffle in [False, True]:
+                names.append("{}-x{}{}".format(model, scale, "-shuffle" if shuffle else ""))
+    for shuffle in [False, True]:
+        names.append("mixnet_l-x1.3{}".format("-shuffle" if shuffle else ""))
+    return names + IRESNETS
+
+
+def build_variant(name, embedding_size=512):
+    if name in IRESNETS:
+        return getattr(backbones, name)(False, num_features=embedding_size)
+    parts = name.split("-")
+    model, scale, shuffle = parts[0], float(parts[1][1:]), parts[-1] == "shuffle"
+    # gdw_size as in config.py: 512 for mixnet_s, 1024 otherwise.
+    gdw_size = 512 if model == "mixnet_s" else 1024
+    return getattr(backbones, model)(embedding_size=embedding_size, width_scale=scale, gdw_size=gdw_size,
+                                     shuffle=shuffle)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def measure(name, batch_sizes, threads, warmup, iters):
+    """
+    Measure one variant in the current process.
+    """
+    net = build_variant(name)
+    params = int(_calc_width(net))
+    mflops = float(count_model_flops(net).split()[0]) * 1000.0
+    net.eval()
+    rows = []
+    for num_threads in threads:
+        torch.set_num_threads(num_threads)
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, 3, 112, 112)
+            latency, latency_p90 = time_model(net, x, warmup=warmup, iters=iters)
+            rows.append({"variant": name, "family": name.split("-")[0], "params": params, "mflops": mflops,
+                         "batch_size": batch_size, "threads": num_threads, "latency_ms": latency,
+                         "latency_p90_ms": latency_p90, "throughput": batch_size * 1000.0 / latency,
+                         "peak_rss_mb": peak_rss_mb()})
+    return rows
+
+
+def main(args):
+    if args.variant is not None:
+        print(json.dumps(measure(args.variant, args.batch_sizes, args.threads, args.warmup, args.iters)))
+        return
+    names = args.variants if args.variants else variant_names(args.scales)
+    rows = []
+    for name in names:
+        cmd = [sys.executable, "-m", "benchmarks.latency", "--variant", name, "--warmup", str(args.warmup),
+               "--iters", str(args.iters), "--batch_sizes"] + [str(b) for b in args.batch_sizes] + \
+              ["--threads"] + [str(t) for t in args.threads]
+        output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        # count_model_flops prints warnings for layers it does not count, the result is the last line.
+        variant_rows = json.loads(output.strip().splitlines()[-1])
+        for row in variant_rows:
+            print("{variant:<24} batch {batch_size:<3} threads {threads:<2} {latency_ms:9.2f} ms "
+                  "{throughput:8.1f} img/s  {mflops:8.1f} MFLOPs  {params:>9} params  "
+                  "{peak_rss_mb:7.1f} MB".format(**row))
+        rows.extend(variant_rows)
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, "latency.json"), 'w') as f:
+        json.dump({"torch": torch.__version__, "cpu_count": os.cpu_count(), "results": rows}, f, indent=1)
+    with open(os.path.join(args.output, "latency.csv"), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Backbone latency benchmark suite')
+    parser.add_argument('--output', type=str, default="latency", help='directory of latency.json/latency.csv')
+    parser.add_argument('--variants', type=str, nargs='+', default=None,
+                        help='variants to measure, e.g. mixnet_s-x0.5-shuffle iresnet50 (default: all)')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 1.0], help='mixnet_s/mixnet_m widths')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='batch sizes')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4], help='intra-op thread counts')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed iterations')
+    parser.add_argument('--iters', type=int, default=20, help='timed iterations')
+    parser.add_argument('--variant', type=str, default=None, help=argparse.SUPPRESS)
+    main(parser.parse_args())
@@ -0,0 +1,54 @@
+"""Samples/s of DataLoaderX over a synthetic training set as the number of loader workers grows.
+
+Usage: python -m benchmarks.loader_workers --work_dir /tmp/packed_bench --workers 0 1 2 4 8
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from benchmarks.packed_dataset import make_synthetic_record
+from dataset import DataLoaderX, FaceCollate, MXFaceDataset, PackedFaceDataset
+from pack_dataset import pack_record
+
+
+def loader_throughput(dataset, num_workers, batch_size, num_batches, prefetch_factor):
+    kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=True) if num_workers > 0 else {}
+    loader = DataLoaderX(
+        local_rank=0, dataset=dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(), drop_last=True,
+        collate_fn=FaceCollate(), **kwargs)
+    iterator = iter(loader)
+    # The first batches include the worker start-up.
+    for _ in range(min(2, num_batches)):
+        next(iterator)
+    tic = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterator)
+    return num_batches * batch_size / (time.perf_counter() - tic)
+
+
+def main(args):
+    rec_dir = os.path.join(args.work_dir, "rec")
+    packed_dir = os.path.join(args.work_dir, "packed")
+    if not os.path.exists(os.path.join(rec_dir, "train.rec")):
+        make_synthetic_record(rec_dir, args.num_images, 1000)
+    if not os.path.exists(packed_dir):
+        pack_record(rec_dir, packed_dir)
+    print("cpu count: {}".format(os.cpu_count()))
+    for name, dataset in [("MXFaceDataset", MXFaceDataset(rec_dir, 0)), ("PackedFaceDataset", PackedFaceDataset(packed_dir, 0))]:
+        for num_workers in args.workers:
+            speed = loader_throughput(dataset, num_workers, args.batch_size, args.num_batches, args.prefetch_factor)
+            print("{:<18} workers={:<3} {:>8.0f} samples/s".format(name, num_workers, speed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Data loader worker scaling benchmark')
+    parser.add_argument('--work_dir', type=str, default="/tmp/packed_bench", help='directory for the synthetic data')
+    parser.add_argument('--num_images', type=int, default=100000, help='synthetic dataset size')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8], help='worker counts')
+    parser.add_argument('--batch_size', type=int, default=128, help='batch size')
+    parser.add_argument('--num_batches', type=int, default=50, help='timed batches')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='batches prefetched per worker')
+    main(parser.parse_args())
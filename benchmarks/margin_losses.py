@@ -0,0 +1,134 @@
+"""Per-step time and peak memory of the margin losses: the dense implementations with one-hot margin matrices
+(as losses.py had them) against the sparse gather/scatter ones in losses.py, for a PartialFC shard of 85k and
+1M classes. A step is the cosine matrix, the margin and the backward pass. Every configuration runs in its own
+subprocess; peak memory is the CUDA peak allocation on GPU and the peak RSS increase on the cpu.
+
+Usage: python -m benchmarks.margin_losses --num_classes 85742 1000000 --batch_size 512 --device cpu
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import torch
+import torch.nn.functional as F
+
+import losses
+from benchmarks.bench_utils import time_fn
+from benchmarks.latency import peak_rss_mb
+
+LOSSES = ["CosFace", "ArcFace", "CombineLoss"]
+
+
+def dense_margin(loss, cosine, label):
+    """
+    The margin with dense [num_valid, num_classes] margin matrices.
+    """
+    index = torch.where(label != -1)[0]
+    if isinstance(loss, losses.CosFace):
+        m_hot = torch.zeros(index.size()[0], cosine.size()[1], device=cosine.device)
+        m_hot.scatter_(1, label[index, None], loss.m)
+        cosine[index] -= m_hot
+        return cosine * loss.s
+    m2 = loss.m if isinstance(loss, losses.ArcFace) else loss.m2
+    m_hot = torch.zeros(index.size()[0], cosine.size()[1], device=cosine.device)
+    m_hot.scatter_(1, label[index, None], m2)
+    cosine.acos_()
+    cosine[index] += m_hot
+    cosine.cos_()
+    if isinstance(loss, losses.CombineLoss):
+        m_hot3 = torch.zeros(index.size()[0], cosine.size()[1], device=cosine.device)
+        m_hot3.scatter_(1, label[index, None], loss.m3)
+        cosine[index] -= m_hot3
+    return cosine.mul_(loss.s)
+
+
+def step(loss, mode, features, weight, label):
+    cosine = F.linear(features, weight)
+    logits = dense_margin(loss, cosine, label) if mode == "dense" else loss(cosine, label)
+    logits.sum().backward()
+    features.grad = None
+    weight.grad = None
+
+
+def check_parity(device):
+    torch.manual_seed(0)
+    features = F.normalize(torch.randn(16, 32, device=device))
+    weight = F.normalize(torch.randn(100, 32, device=device))
+    label = torch.randint(0, 100, (16,), device=device)
+    label[::3] = -1
+    for name in LOSSES:
+        outputs = []
+        for mode in ["dense", "sparse"]:
+            x = features.clone().requires_grad_(True)
+            logits = getattr(losses, name)()(F.linear(x, weight), label) if mode == "sparse" else \
+                dense_margin(getattr(losses, name)(), F.linear(x, weight), label)
+            logits.sum().backward()
+            outputs.append((logits.detach(), x.grad))
+        (dense, dense_grad), (sparse, sparse_grad) = outputs
+        assert torch.allclose(dense, sparse, atol=1e-3), (name, (dense - sparse).abs().max())
+        assert torch.allclose(dense_grad, sparse_grad, rtol=1e-4, atol=1e-2), \
+            (name, (dense_grad - sparse_grad).abs().max())
+
+
+def measure(name, mode, num_classes, batch_size, embedding_size, device, warmup, iters):
+    """
+    Measure one configuration in the current process.
+    """
+    device = torch.device(device)
+    torch.manual_seed(0)
+    features = F.normalize(torch.randn(batch_size, embedding_size, device=device)).requires_grad_(True)
+    weight = F.normalize(torch.randn(num_classes, embedding_size, device=device)).requires_grad_(True)
+    label = torch.randint(0, num_classes, (batch_size,), device=device)
+    loss = getattr(losses, name)()
+
+    def run():
+        step(loss, mode, features, weight, label)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    else:
+        base = peak_rss_mb()
+    latency, latency_p90 = time_fn(run, warmup=warmup, iters=iters)
+    if device.type == "cuda":
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2 ** 20
+    else:
+        peak = peak_rss_mb() - base
+    return {"loss": name, "mode": mode, "num_classes": num_classes, "batch_size": batch_size,
+            "latency_ms": latency, "latency_p90_ms": latency_p90, "peak_mb": peak}
+
+
+def main(args):
+    if args.run is not None:
+        name, mode, num_classes = args.run.split(":")
+        print(json.dumps(measure(name, mode, int(num_classes), args.batch_size, args.embedding_size, args.device,
+                                 args.warmup, args.iters)))
+        return
+    check_parity(args.device)
+    for num_classes in args.num_classes:
+        for name in args.losses:
+            for mode in ["dense", "sparse"]:
+                cmd = [sys.executable, "-m", "benchmarks.margin_losses", "--run",
+                       "{}:{}:{}".format(name, mode, num_classes), "--batch_size", str(args.batch_size),
+                       "--embedding_size", str(args.embedding_size), "--device", args.device,
+                       "--warmup", str(args.warmup), "--iters", str(args.iters)]
+                output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+                row = json.loads(output.strip().splitlines()[-1])
+                print("{num_classes:>8} classes  {loss:<12} {mode:<6} {latency_ms:9.1f} ms  "
+                      "{peak_mb:8.1f} MB".format(**row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Dense vs sparse margin losses')
+    parser.add_argument('--num_classes', type=int, nargs='+', default=[85742, 1000000], help='classes per shard')
+    parser.add_argument('--losses', type=str, nargs='+', default=LOSSES, choices=LOSSES, help='margin losses')
+    parser.add_argument('--batch_size', type=int, default=512, help='total batch size over all ranks')
+    parser.add_argument('--embedding_size', type=int, default=512, help='embedding size')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu", help='device')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed steps')
+    parser.add_argument('--iters', type=int, default=5, help='timed steps')
+    parser.add_argument('--run', type=str, default=None, help=argparse.SUPPRESS)
+    main(parser.parse_args())
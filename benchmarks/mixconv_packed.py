@@ -0,0 +1,66 @@
+"""Per-layer CPU latency of the split/per-branch/cat MixConv against the packed single depthwise convolution.
+
+Every distinct depthwise MixConv configuration of MixFaceNet-S/M is measured at its real input resolution.
+
+Usage: python -m benchmarks.mixconv_packed --threads 4
+"""
+import argparse
+
+import torch
+
+import backbones.mixnetm as mx
+from backbones.mixnetm import MixConv, PackedMixConv
+from benchmarks.bench_utils import time_model
+
+
+def collect_layers(net):
+    """
+    Distinct packable MixConv layers of a model with the shape of their input.
+    """
+    layers = {}
+    handles = []
+
+    def hook(module, input, output):
+        convs = list(module.children())
+        key = (tuple(conv.kernel_size[0] for conv in convs), tuple(input[0].shape[1:]), convs[0].stride[0])
+        layers.setdefault(key, module)
+
+    for module in net.modules():
+        if isinstance(module, MixConv) and (len(module._modules) > 1) and PackedMixConv.can_pack(module):
+            handles.append(module.register_forward_hook(hook))
+    with torch.no_grad():
+        net.eval()(torch.randn(1, 3, 112, 112))
+    for h in handles:
+        h.remove()
+    return layers
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    print("threads: {}".format(torch.get_num_threads()))
+    print("{:<20} {:<16} {:>6} {:>6} {:>11} {:>11} {:>8}".format(
+        "kernels", "input (C,H,W)", "stride", "batch", "split ms", "packed ms", "speedup"))
+    layers = {}
+    for name in ["mixnet_s", "mixnet_m"]:
+        net = getattr(mx, name)(embedding_size=512, width_scale=args.scale)
+        for key, module in collect_layers(net).items():
+            layers.setdefault(key, module)
+    for (kernels, shape, stride), module in sorted(layers.items()):
+        packed = PackedMixConv.from_mixconv(module).eval()
+        for batch_size in args.batch_sizes:
+            x = torch.randn((batch_size,) + shape)
+            with torch.no_grad():
+                assert torch.allclose(module(x), packed(x), rtol=1e-4, atol=1e-5)
+            t_split, _ = time_model(module, x, iters=args.iters)
+            t_packed, _ = time_model(packed, x, iters=args.iters)
+            print("{:<20} {:<16} {:>6} {:>6} {:>11.3f} {:>11.3f} {:>7.2f}x".format(
+                str(kernels), str(shape), stride, batch_size, t_split, t_packed, t_split / t_packed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Packed MixConv microbenchmark')
+    parser.add_argument('--threads', type=int, default=1, help='number of intra-op threads')
+    parser.add_argument('--scale', type=float, default=1.0, help='width scale')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32, 256], help='batch sizes')
+    parser.add_argument('--iters', type=int, default=10, help='timed iterations')
+    main(parser.parse_args())
@@ -0,0 +1,67 @@
+"""Per-worker read+decode throughput of MXFaceDataset against PackedFaceDataset on a synthetic image set.
+
+Usage: python -m benchmarks.packed_dataset --work_dir /tmp/packed_bench --num_images 100000
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from dataset import MXFaceDataset, PackedFaceDataset
+from pack_dataset import pack_record
+
+
+def make_synthetic_record(root_dir, num_images, num_classes, seed=0):
+    """
+    Write a `train.rec`/`train.idx` pair of smooth random 112x112 JPEG faces.
+    """
+    import mxnet as mx
+    rng = np.random.RandomState(seed)
+    os.makedirs(root_dir, exist_ok=True)
+    record = mx.recordio.MXIndexedRecordIO(
+        os.path.join(root_dir, 'train.idx'), os.path.join(root_dir, 'train.rec'), 'w')
+    bases = [cv2.resize(rng.randint(0, 256, (14, 14, 3), dtype=np.uint8), (112, 112)) for _ in range(64)]
+    for idx in range(num_images):
+        img = bases[idx % len(bases)] + rng.randint(0, 8, (112, 112, 3), dtype=np.uint8)
+        _, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        header = mx.recordio.IRHeader(0, float(idx % num_classes), idx, 0)
+        record.write_idx(idx, mx.recordio.pack(header, jpeg.tobytes()))
+    record.close()
+
+
+def throughput(dataset, num_samples, seed=0):
+    """
+    Samples/s of random-order __getitem__ calls in the current process, i.e. of a single loader worker.
+    """
+    order = np.random.RandomState(seed).permutation(len(dataset))[:num_samples]
+    dataset[int(order[0])]
+    tic = time.perf_counter()
+    for i in order:
+        dataset[int(i)]
+    return len(order) / (time.perf_counter() - tic)
+
+
+def main(args):
+    rec_dir = os.path.join(args.work_dir, "rec")
+    packed_dir = os.path.join(args.work_dir, "packed")
+    if not os.path.exists(os.path.join(rec_dir, "train.rec")):
+        print("writing {} synthetic images".format(args.num_images))
+        make_synthetic_record(rec_dir, args.num_images, args.num_classes)
+    if not os.path.exists(packed_dir):
+        tic = time.perf_counter()
+        pack_record(rec_dir, packed_dir)
+        print("conversion: {:.1f}s".format(time.perf_counter() - tic))
+
+    for name, dataset in [("MXFaceDataset", MXFaceDataset(rec_dir, 0)), ("PackedFaceDataset", PackedFaceDataset(packed_dir, 0))]:
+        print("{:<18} read+decode {:>8.0f} samples/s".format(name, throughput(dataset, args.num_samples)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Packed dataset throughput benchmark')
+    parser.add_argument('--work_dir', type=str, default="/tmp/packed_bench", help='directory for the synthetic data')
+    parser.add_argument('--num_images', type=int, default=100000, help='synthetic dataset size')
+    parser.add_argument('--num_classes', type=int, default=1000, help='synthetic identities')
+    parser.add_argument('--num_samples', type=int, default=20000, help='samples read per measurement')
+    main(parser.parse_args())
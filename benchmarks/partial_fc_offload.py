@@ -0,0 +1,90 @@
+"""Step time and peak memory of PartialFC with the class weights on the device ("memory", and "fused" for the
+chunked path) against weights offloaded to pinned host memory or memory-mapped files and streamed in chunks,
+at several class counts. Runs a single rank; every configuration runs in its own subprocess. Device memory is
+the CUDA peak allocation (0 on the cpu), host memory the peak RSS.
+
+Usage: python -m benchmarks.partial_fc_offload --num_classes 100000 1000000 4000000 --batch_size 512
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+import losses
+from benchmarks.bench_utils import time_fn
+from benchmarks.latency import peak_rss_mb
+from partial_fc import PartialFC
+
+MODES = ["memory", "fused", "pinned", "memmap"]
+
+
+def measure(mode, num_classes, args):
+    """
+    Measure one configuration in the current process.
+    """
+    device = torch.device(args.device)
+    with tempfile.TemporaryDirectory() as tmp:
+        dist.init_process_group(backend="nccl" if device.type == "cuda" else "gloo",
+                                init_method="file://" + os.path.join(tmp, "store"), rank=0, world_size=1)
+        pfc = PartialFC(rank=0, local_rank=device.index or 0, world_size=1, batch_size=args.batch_size,
+                        resume=False, margin_softmax=losses.ArcFace(), num_classes=num_classes,
+                        embedding_size=args.embedding_size, prefix=tmp, device=device, fused=mode == "fused",
+                        chunk_size=args.chunk_size, offload=mode if mode in ["pinned", "memmap"] else None)
+        optimizer = torch.optim.SGD(params=[{'params': pfc.parameters()}], lr=0.1, momentum=0.9, weight_decay=5e-4)
+        features = F.normalize(torch.randn(args.batch_size, args.embedding_size, device=device))
+        label = torch.randint(0, num_classes, (args.batch_size,), device=device)
+
+        def run():
+            pfc.forward_backward(label.clone(), features, optimizer)
+            optimizer.step()
+            pfc.update()
+            optimizer.zero_grad()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        latency, latency_p90 = time_fn(run, warmup=args.warmup, iters=args.iters)
+        device_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == "cuda" else 0.0
+        dist.destroy_process_group()
+    return {"mode": mode, "num_classes": num_classes, "batch_size": args.batch_size, "latency_ms": latency,
+            "latency_p90_ms": latency_p90, "device_mb": device_mb, "host_mb": peak_rss_mb()}
+
+
+def main(args):
+    if args.run is not None:
+        mode, num_classes = args.run.split(":")
+        print(json.dumps(measure(mode, int(num_classes), args)))
+        return
+    for num_classes in args.num_classes:
+        for mode in args.modes:
+            cmd = [sys.executable, "-m", "benchmarks.partial_fc_offload", "--run", "{}:{}".format(mode, num_classes),
+                   "--batch_size", str(args.batch_size), "--embedding_size", str(args.embedding_size),
+                   "--chunk_size", str(args.chunk_size), "--device", args.device, "--warmup", str(args.warmup),
+                   "--iters", str(args.iters)]
+            output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            row = json.loads(output.strip().splitlines()[-1])
+            print("{num_classes:>9} classes  {mode:<7} {latency_ms:9.1f} ms/step  device {device_mb:9.1f} MB  "
+                  "host {host_mb:9.1f} MB".format(**row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PartialFC with offloaded class weights')
+    parser.add_argument('--num_classes', type=int, nargs='+', default=[100000, 1000000, 4000000],
+                        help='classes of the rank')
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES, help='weight placement')
+    parser.add_argument('--batch_size', type=int, default=512, help='batch size')
+    parser.add_argument('--embedding_size', type=int, default=512, help='embedding size')
+    parser.add_argument('--chunk_size', type=int, default=65536, help='classes per streamed chunk')
+    parser.add_argument('--device', type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        help='device')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed steps')
+    parser.add_argument('--iters', type=int, default=5, help='timed steps')
+    parser.add_argument('--run', type=str, default=None, help=argparse.SUPPRESS)
+    main(parser.parse_args())
@@ -0,0 +1,102 @@
+"""Training steps/s of PartialFC at several sample rates, with the persistent sampled-weight workspace against
+rebuilding the sampled Parameter and rebinding the optimizer every step (the previous implementation). Runs a
+single rank.
+
+Usage: python -m benchmarks.partial_fc_sampling --num_classes 85742 --sample_rates 0.1 0.3 1.0
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parameter import Parameter
+
+import losses
+from benchmarks.bench_utils import time_fn
+from partial_fc import PartialFC
+
+
+class RebuildPartialFC(PartialFC):
+    """
+    PartialFC building a new sampled Parameter and momentum every step.
+    """
+    @torch.no_grad()
+    def sample(self, total_label):
+        index_positive = (self.class_start <= total_label) & (total_label < self.class_start + self.num_local)
+        total_label[~index_positive] = -1
+        total_label[index_positive] -= self.class_start
+        if int(self.sample_rate) != 1:
+            positive = torch.unique(total_label[index_positive], sorted=True)
+            if self.num_sample - positive.size(0) >= 0:
+                perm = torch.rand(size=[self.num_local], device=self.device)
+                perm[positive] = 2.0
+                index = torch.topk(perm, k=self.num_sample)[1]
+                index = index.sort()[0]
+            else:
+                index = positive
+            self.index = index
+            total_label[index_positive] = torch.searchsorted(index, total_label[index_positive])
+            self.sub_weight = Parameter(self.weight[index])
+            self.sub_weight_mom = self.weight_mom[index]
+
+    @torch.no_grad()
+    def update(self):
+        self.weight_mom[self.index] = self.sub_weight_mom
+        self.weight[self.index] = self.sub_weight
+
+    def prepare(self, label, optimizer):
+        with self.stream_context():
+            total_label = torch.zeros(
+                size=[self.batch_size * self.world_size], device=self.device, dtype=torch.long)
+            dist.all_gather(list(total_label.chunk(self.world_size, dim=0)), label)
+            self.sample(total_label)
+            optimizer.state.pop(optimizer.param_groups[-1]['params'][0], None)
+            optimizer.param_groups[-1]['params'][0] = self.sub_weight
+            optimizer.state[self.sub_weight]['momentum_buffer'] = self.sub_weight_mom
+            norm_weight = F.normalize(self.sub_weight) if not self.fused else None
+            return total_label, norm_weight
+
+
+def main(args):
+    device = torch.device(args.device)
+    with tempfile.TemporaryDirectory() as tmp:
+        dist.init_process_group(backend="nccl" if device.type == "cuda" else "gloo",
+                                init_method="file://" + os.path.join(tmp, "store"), rank=0, world_size=1)
+        for sample_rate in args.sample_rates:
+            for name, cls in [("rebuild", RebuildPartialFC), ("workspace", PartialFC)]:
+                torch.manual_seed(0)
+                pfc = cls(rank=0, local_rank=device.index or 0, world_size=1, batch_size=args.batch_size,
+                          resume=False, margin_softmax=losses.ArcFace(), num_classes=args.num_classes,
+                          sample_rate=sample_rate, embedding_size=args.embedding_size, prefix=tmp, device=device)
+                optimizer = torch.optim.SGD(params=[{'params': pfc.parameters()}], lr=0.1, momentum=0.9,
+                                            weight_decay=5e-4)
+                features = F.normalize(torch.randn(args.batch_size, args.embedding_size, device=device))
+                label = torch.randint(0, args.num_classes, (args.batch_size,), device=device)
+
+                def run():
+                    pfc.forward_backward(label.clone(), features, optimizer)
+                    optimizer.step()
+                    pfc.update()
+                    optimizer.zero_grad()
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+
+                latency, latency_p90 = time_fn(run, warmup=args.warmup, iters=args.iters)
+                print("sample_rate {:<4} {:<9} {:8.2f} ms/step (p90 {:8.2f})  {:7.1f} steps/s".format(
+                    sample_rate, name, latency, latency_p90, 1000.0 / latency))
+        dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PartialFC steps/s per sample rate')
+    parser.add_argument('--num_classes', type=int, default=85742, help='classes of the rank')
+    parser.add_argument('--sample_rates', type=float, nargs='+', default=[0.1, 0.3, 1.0], help='sample rates')
+    parser.add_argument('--batch_size', type=int, default=512, help='batch size')
+    parser.add_argument('--embedding_size', type=int, default=512, help='embedding size')
+    parser.add_argument('--device', type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        help='device')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed steps')
+    parser.add_argument('--iters', type=int, default=50, help='timed steps')
+    main(parser.parse_args())
@@ -0,0 +1,66 @@
+"""Closed-loop load generator for serving.EmbeddingService on CPU: every client sends one crop, waits for its
+embedding and sends the next. Reports p50/p99 latency and throughput per concurrency level, for micro-batching
+against batch size 1.
+
+Usage: python -m benchmarks.serving_load --concurrency 1 4 16 64 --duration 10 --threads 4
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+import torch
+
+import backbones.mixnetm as mx
+from serving import EmbeddingService
+
+
+async def client(service, crops, offset, stop_at, latencies):
+    i = offset
+    while time.perf_counter() < stop_at:
+        tic = time.perf_counter()
+        await service.embed(crops[i % len(crops)])
+        latencies.append((time.perf_counter() - tic) * 1000.0)
+        i += 1
+
+
+async def load(backbone, crops, concurrency, duration, max_batch_size, max_wait_ms, num_workers):
+    latencies = []
+    async with EmbeddingService(backbone, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                                num_workers=num_workers) as service:
+        # Warm-up.
+        await asyncio.gather(*[service.embed(crop) for crop in crops[:max_batch_size]])
+        tic = time.perf_counter()
+        stop_at = tic + duration
+        await asyncio.gather(*[client(service, crops, c, stop_at, latencies) for c in range(concurrency)])
+        elapsed = time.perf_counter() - tic
+        metrics = service.metrics()
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), len(latencies) / elapsed, metrics
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    backbone = mx.mixnet_s(embedding_size=512, width_scale=args.scale, gdw_size=512).eval()
+    if args.weights is not None:
+        backbone.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    crops = np.random.RandomState(0).randint(0, 256, (256, 3, 112, 112)).astype(np.uint8)
+    for concurrency in args.concurrency:
+        for max_batch_size, max_wait_ms in [(1, 0.0), (args.max_batch_size, args.max_wait_ms)]:
+            p50, p99, throughput, metrics = asyncio.run(load(
+                backbone, crops, concurrency, args.duration, max_batch_size, max_wait_ms, args.num_workers))
+            print("concurrency {:<4} max_batch {:<3} p50 {:8.2f} ms  p99 {:8.2f} ms  {:8.1f} req/s  "
+                  "mean batch {:.1f}".format(concurrency, max_batch_size, p50, p99, throughput,
+                                             metrics["mean_batch_size"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Embedding service load generator')
+    parser.add_argument('--weights', type=str, default=None, help='mixnet_s backbone checkpoint')
+    parser.add_argument('--scale', type=float, default=0.5, help='width scale')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per measurement')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='micro-batch size')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0, help='micro-batch wait')
+    parser.add_argument('--num_workers', type=int, default=1, help='batches in flight')
+    parser.add_argument('--threads', type=int, default=4, help='number of intra-op threads')
+    main(parser.parse_args())
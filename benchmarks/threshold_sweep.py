@@ -0,0 +1,100 @@
+"""Threshold sweep of eval/verification: per-threshold loops against the sorted/searchsorted implementation.
+
+Usage: python -m benchmarks.threshold_sweep --pairs 6000 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy import interpolate
+
+from eval import verification
+
+
+def reference_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_folds=10):
+    """
+    Loop implementation of calculate_roc (pca=0) as it was before the vectorized sweep.
+    """
+    nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
+    k_fold = verification.LFold(n_splits=nrof_folds, shuffle=False)
+    tprs = np.zeros((nrof_folds, len(thresholds)))
+    fprs = np.zeros((nrof_folds, len(thresholds)))
+    accuracy = np.zeros((nrof_folds))
+    dist = np.sum(np.square(np.subtract(embeddings1, embeddings2)), 1)
+    for fold_idx, (train_set, test_set) in enumerate(k_fold.split(np.arange(nrof_pairs))):
+        acc_train = np.zeros((len(thresholds)))
+        for threshold_idx, threshold in enumerate(thresholds):
+            _, _, acc_train[threshold_idx] = verification.calculate_accuracy(
+                threshold, dist[train_set], actual_issame[train_set])
+        best_threshold_index = np.argmax(acc_train)
+        for threshold_idx, threshold in enumerate(thresholds):
+            tprs[fold_idx, threshold_idx], fprs[fold_idx, threshold_idx], _ = verification.calculate_accuracy(
+                threshold, dist[test_set], actual_issame[test_set])
+        _, _, accuracy[fold_idx] = verification.calculate_accuracy(
+            thresholds[best_threshold_index], dist[test_set], actual_issame[test_set])
+    return np.mean(tprs, 0), np.mean(fprs, 0), accuracy
+
+
+def reference_val(thresholds, embeddings1, embeddings2, actual_issame, far_target, nrof_folds=10):
+    """
+    Loop implementation of calculate_val as it was before the vectorized sweep.
+    """
+    nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
+    k_fold = verification.LFold(n_splits=nrof_folds, shuffle=False)
+    val = np.zeros(nrof_folds)
+    far = np.zeros(nrof_folds)
+    dist = np.sum(np.square(np.subtract(embeddings1, embeddings2)), 1)
+    for fold_idx, (train_set, test_set) in enumerate(k_fold.split(np.arange(nrof_pairs))):
+        far_train = np.zeros(len(thresholds))
+        for threshold_idx, threshold in enumerate(thresholds):
+            _, far_train[threshold_idx] = verification.calculate_val_far(
+                threshold, dist[train_set], actual_issame[train_set])
+        if np.max(far_train) >= far_target:
+            threshold = interpolate.interp1d(far_train, thresholds, kind='slinear')(far_target)
+        else:
+            threshold = 0.0
+        val[fold_idx], far[fold_idx] = verification.calculate_val_far(
+            threshold, dist[test_set], actual_issame[test_set])
+    return np.mean(val), np.std(val), np.mean(far)
+
+
+def synthetic_pairs(num_pairs, dim=512, seed=0):
+    rng = np.random.RandomState(seed)
+    issame = rng.rand(num_pairs) < 0.5
+    embeddings1 = rng.randn(num_pairs, dim).astype(np.float32)
+    noise = rng.randn(num_pairs, dim).astype(np.float32)
+    embeddings2 = np.where(issame[:, None], embeddings1 + 1.2 * noise, noise)
+    embeddings1 /= np.linalg.norm(embeddings1, axis=1, keepdims=True)
+    embeddings2 /= np.linalg.norm(embeddings2, axis=1, keepdims=True)
+    return embeddings1, embeddings2, issame
+
+
+def timed(fn, *args, **kwargs):
+    tic = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - tic
+
+
+def main(args):
+    roc_thresholds = np.arange(0, 4, 0.01)
+    val_thresholds = np.arange(0, 4, 0.001)
+    for num_pairs in args.pairs:
+        embeddings1, embeddings2, issame = synthetic_pairs(num_pairs)
+        roc, t_roc = timed(verification.calculate_roc, roc_thresholds, embeddings1, embeddings2, issame)
+        val, t_val = timed(verification.calculate_val, val_thresholds, embeddings1, embeddings2, issame, 1e-3)
+        line = "pairs={:<8} calculate_roc {:8.3f}s  calculate_val {:8.3f}s".format(num_pairs, t_roc, t_val)
+        if num_pairs <= args.max_reference_pairs:
+            roc_ref, t_roc_ref = timed(reference_roc, roc_thresholds, embeddings1, embeddings2, issame)
+            val_ref, t_val_ref = timed(reference_val, val_thresholds, embeddings1, embeddings2, issame, 1e-3)
+            assert all(np.array_equal(a, b) for a, b in zip(roc, roc_ref))
+            assert all(np.array_equal(a, b) for a, b in zip(val, val_ref))
+            line += "   | loops: roc {:8.3f}s  val {:8.3f}s  (identical results)".format(t_roc_ref, t_val_ref)
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verification threshold sweep benchmark')
+    parser.add_argument('--pairs', type=int, nargs='+', default=[6000, 1000000], help='synthetic pair counts')
+    parser.add_argument('--max_reference_pairs', type=int, default=1000000,
+                        help='largest set on which the loop implementation is also run')
+    main(parser.parse_args())
@@ -0,0 +1,90 @@
+"""Load time and resident memory of a verification set: decoded float32 original+flipped tensors (previous
+load_bin) against the memory-mapped uint8 cache.
+
+Usage: python -m benchmarks.verification_cache --bin /data/faces_emore/lfw.bin
+       python -m benchmarks.verification_cache --work_dir /tmp/ver_bench --num_pairs 6000
+"""
+import argparse
+import multiprocessing
+import os
+import pickle
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from eval import verification
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return float('nan')
+
+
+def load_float_tensors(path, image_size):
+    """
+    Previous load_bin behaviour: two float32 tensors (original and flipped) held in memory.
+    """
+    bins, issame_list = verification._read_bin(path)
+    num_images = len(issame_list) * 2
+    decoded = verification._decode_bin(bins, num_images, image_size,
+                                       np.empty((num_images, 3, image_size[0], image_size[1]), dtype=np.uint8))
+    data_list = [torch.from_numpy(decoded).float(), torch.from_numpy(np.ascontiguousarray(decoded[..., ::-1])).float()]
+    del decoded, bins
+    return data_list, issame_list
+
+
+def _measure(mode, path, queue):
+    base = rss_mb()
+    tic = time.perf_counter()
+    if mode == "float tensors":
+        data_set = load_float_tensors(path, (112, 112))
+        touch = data_set[0][0].sum()
+    else:
+        data_set = verification.load_bin(path, (112, 112))
+        # Touch every page of the mapping to include what a full evaluation pass keeps resident.
+        touch = sum(int(data_set[0][i:i + 1000].sum()) for i in range(0, len(data_set[0]), 1000))
+    queue.put((mode, time.perf_counter() - tic, rss_mb() - base))
+
+
+def make_synthetic_bin(path, num_pairs, seed=0):
+    rng = np.random.RandomState(seed)
+    bins = []
+    for _ in range(num_pairs * 2):
+        img = cv2.resize(rng.randint(0, 256, (14, 14, 3), dtype=np.uint8), (112, 112))
+        bins.append(cv2.imencode('.jpg', img)[1].tobytes())
+    issame_list = (rng.rand(num_pairs) < 0.5).tolist()
+    with open(path, 'wb') as f:
+        pickle.dump((bins, issame_list), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def main(args):
+    path = args.bin
+    if path is None:
+        os.makedirs(args.work_dir, exist_ok=True)
+        path = os.path.join(args.work_dir, "synthetic.bin")
+        if not os.path.exists(path):
+            make_synthetic_bin(path, args.num_pairs)
+    queue = multiprocessing.Queue()
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(os.path.dirname(path), "{}_112x112.npy".format(name))
+    for mode in ["float tensors", "uint8 cache (build)", "uint8 cache (mmap)"]:
+        if mode == "uint8 cache (build)" and os.path.exists(cache_path):
+            os.remove(cache_path)
+        process = multiprocessing.Process(target=_measure, args=(mode, path, queue))
+        process.start()
+        process.join()
+        mode, seconds, rss = queue.get()
+        print("{:<20} load {:7.2f}s   resident +{:8.1f} MB".format(mode, seconds, rss))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verification set cache benchmark')
+    parser.add_argument('--bin', type=str, default=None, help='existing verification .bin')
+    parser.add_argument('--work_dir', type=str, default="/tmp/ver_bench", help='directory for the synthetic .bin')
+    parser.add_argument('--num_pairs', type=int, default=6000, help='synthetic pairs')
+    main(parser.parse_args())
@@ -0,0 +1,91 @@
+"""End-to-end CPU time of one verification benchmark: the previous per-batch loop (float64 buffers, separate
+original/flipped passes, batch size 10) against the streaming extractor of eval/verification.test.
+
+Usage: python -m benchmarks.verification_speed --bin /data/faces_emore/lfw.bin --threads 4
+"""
+import argparse
+import datetime
+import os
+import time
+
+import numpy as np
+import sklearn
+import torch
+
+import backbones.mixnetm as mx
+from benchmarks.verification_cache import make_synthetic_bin
+from eval import verification
+
+
+@torch.no_grad()
+def reference_test(data_list, issame_list, backbone, batch_size, nfolds=10):
+    """
+    Previous verification.test on the previous load_bin output (float32 original and flipped tensors).
+    """
+    embeddings_list = []
+    for data in data_list:
+        embeddings = None
+        ba = 0
+        while ba < data.shape[0]:
+            bb = min(ba + batch_size, data.shape[0])
+            count = bb - ba
+            _data = data[bb - batch_size: bb]
+            time0 = datetime.datetime.now()
+            img = ((_data / 255) - 0.5) / 0.5
+            _embeddings = backbone(img).detach().cpu().numpy()
+            if embeddings is None:
+                embeddings = np.zeros((data.shape[0], _embeddings.shape[1]))
+            embeddings[ba:bb, :] = _embeddings[(batch_size - count):, :]
+            ba = bb
+        embeddings_list.append(embeddings)
+    _xnorm = 0.0
+    _xnorm_cnt = 0
+    for embed in embeddings_list:
+        for i in range(embed.shape[0]):
+            _xnorm += np.linalg.norm(embed[i])
+            _xnorm_cnt += 1
+    _xnorm /= _xnorm_cnt
+    embeddings = sklearn.preprocessing.normalize(embeddings_list[0] + embeddings_list[1])
+    _, _, accuracy, _, _, _ = verification.evaluate(embeddings, issame_list, nrof_folds=nfolds)
+    return np.mean(accuracy), _xnorm
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    path = args.bin
+    if path is None:
+        os.makedirs(args.work_dir, exist_ok=True)
+        path = os.path.join(args.work_dir, "synthetic.bin")
+        if not os.path.exists(path):
+            make_synthetic_bin(path, args.num_pairs)
+    data, issame_list = verification.load_bin(path, (112, 112))
+    backbone = mx.mixnet_s(embedding_size=512, width_scale=args.scale, gdw_size=512).eval()
+    if args.weights is not None:
+        backbone.load_state_dict(torch.load(args.weights, map_location="cpu"))
+
+    data_float = torch.from_numpy(np.asarray(data)).float()
+    data_list = [data_float, data_float.flip(3)]
+    tic = time.perf_counter()
+    acc_ref, xnorm_ref = reference_test(data_list, issame_list, backbone, 10)
+    print("previous loop (batch 10):  {:8.2f}s  acc {:.5f}  xnorm {:.4f}".format(
+        time.perf_counter() - tic, acc_ref, xnorm_ref))
+
+    for channels_last in [False, True]:
+        model = backbone.to(memory_format=torch.channels_last) if channels_last else backbone
+        tic = time.perf_counter()
+        _, _, acc, _, xnorm, _ = verification.test((data, issame_list), model, args.batch_size,
+                                                   channels_last=channels_last)
+        print("streaming (batch {}{}): {:8.2f}s  acc {:.5f}  xnorm {:.4f}".format(
+            args.batch_size, ", channels_last" if channels_last else "", time.perf_counter() - tic, acc, xnorm))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verification extraction benchmark')
+    parser.add_argument('--bin', type=str, default=None, help='verification .bin, e.g. lfw.bin')
+    parser.add_argument('--weights', type=str, default=None, help='mixnet_s backbone checkpoint')
+    parser.add_argument('--scale', type=float, default=0.5, help='width scale')
+    parser.add_argument('--work_dir', type=str, default="/tmp/ver_bench", help='directory for the synthetic .bin')
+    parser.add_argument('--num_pairs', type=int, default=6000, help='synthetic pairs')
+    parser.add_argument('--batch_size', type=int, default=64, help='streaming batch size')
+    parser.add_argument('--threads', type=int, default=1, help='number of intra-op threads')
+    main(parser.parse_args())
@@ -4,12 +4,24 @@ config = edict()
 config.dataset = "emore"
 config.embedding_size = 512
 config.sample_rate = 1
+# PartialFC loss and gradients in chunks of classes, without the full logits temporaries
+config.fused_softmax = False
+config.softmax_chunk_size = 8192
+# None, or keep the PartialFC weights in "pinned" host memory or "memmap" files (needs sample_rate 1)
+config.softmax_offload = None
 config.fp16 = False
 config.momentum = 0.9
 config.weight_decay = 5e-4
 config.weight_decay_last = 5e-3
 
 config.batch_size = 128
+# data loading
+config.num_workers = 4
+config.prefetch_factor = 2
+config.persistent_workers = True
+# verification
+config.async_verification = False
+config.verification_device = "cpu"
 config.lr = 0.1  # batch size is 512
 config.output = "output/emore_random_resnet2"
 config.global_step=295672
@@ -1,13 +1,27 @@
+import json
+import logging
 import numbers
 import os
 import queue as Queue
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import mxnet as mx
+import cv2
 import numpy as np
 import torch
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
+
+try:
+    import mxnet as mx
+except ImportError:
+    mx = None
+
+PACKED_INDEX_DTYPE = np.dtype([('shard', '<u2'), ('offset', '<u8'), ('length', '<u4'), ('label', '<i4')])
+PACKED_INDEX_NAME = "index.npy"
+PACKED_META_NAME = "meta.json"
+PACKED_SHARD_NAME = "shard_{:05d}.bin"
+FOLDER_INDEX_DIR = ".face_index"
+FOLDER_INDEX_META = "meta.json"
 
 
 class BackgroundGenerator(threading.Thread):
@@ -20,7 +34,8 @@ class BackgroundGenerator(threading.Thread):
         self.start()
 
     def run(self):
-        torch.cuda.set_device(self.local_rank)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(self.local_rank)
         for item in self.generator:
             self.queue.put(item)
         self.queue.put(None)
@@ -38,11 +53,53 @@ class BackgroundGenerator(threading.Thread):
         return self
 
 
+def normalize_batch(img):
+    """
+    Map a uint8 image batch to float32 in [-1, 1], i.e. ToTensor followed by Normalize(0.5, 0.5).
+    """
+    return img.float().sub_(127.5).div_(127.5)
+
+
+class FaceCollate(object):
+    """
+    Collate function stacking raw uint8 HWC samples into one uint8 NCHW batch. The random horizontal flip is
+    applied to the whole batch at once and the normalization, if enabled, once per batch. With normalize=False
+    the batch stays uint8 and can be normalized after the host-to-device copy (DataLoaderX(normalize=True)).
+
+    Parameters:
+    ----------
+    flip : bool, default True
+        Whether to flip every sample horizontally with probability 0.5.
+    normalize : bool, default True
+        Whether to return a normalized float32 batch.
+    """
+    def __init__(self, flip=True, normalize=True):
+        self.flip = flip
+        self.normalize = normalize
+
+    def __call__(self, batch):
+        img = torch.from_numpy(np.stack([sample for sample, _ in batch]))
+        label = torch.stack([label for _, label in batch])
+        img = img.permute(0, 3, 1, 2).contiguous()
+        if self.flip:
+            index = torch.nonzero(torch.rand(img.size(0)) < 0.5).squeeze(1)
+            img[index] = img[index].flip(3)
+        if self.normalize:
+            img = normalize_batch(img)
+        return [img, label]
+
+
 class DataLoaderX(DataLoader):
-    def __init__(self, local_rank, **kwargs):
+    def __init__(self, local_rank, normalize=False, device=None, **kwargs):
         super(DataLoaderX, self).__init__(**kwargs)
-        self.stream = torch.cuda.Stream(local_rank)
         self.local_rank = local_rank
+        # Normalize uint8 batches produced by FaceCollate(normalize=False) on the target device.
+        self.normalize = normalize
+        if device is None:
+            device = torch.device("cuda", local_rank) if torch.cuda.is_available() else torch.device("cpu")
+        self.device = torch.device(device)
+        # On the host batches stay where they are and no side stream is needed.
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
 
     def __iter__(self):
         self.iter = super(DataLoaderX, self).__iter__()
@@ -54,13 +111,20 @@ class DataLoaderX(DataLoader):
         self.batch = next(self.iter, None)
         if self.batch is None:
             return None
+        if self.stream is None:
+            if self.normalize:
+                self.batch[0] = normalize_batch(self.batch[0])
+            return None
         with torch.cuda.stream(self.stream):
             for k in range(len(self.batch)):
-                self.batch[k] = self.batch[k].to(device=self.local_rank,
+                self.batch[k] = self.batch[k].to(device=self.device,
                                                  non_blocking=True)
+            if self.normalize:
+                self.batch[0] = normalize_batch(self.batch[0])
 
     def __next__(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
         batch = self.batch
         if batch is None:
             raise StopIteration
@@ -71,26 +135,38 @@ class DataLoaderX(DataLoader):
 class MXFaceDataset(Dataset):
     def __init__(self, root_dir, local_rank):
         super(MXFaceDataset, self).__init__()
-        self.transform = transforms.Compose(
-            [transforms.ToPILImage(),
-             transforms.RandomHorizontalFlip(),
-             transforms.ToTensor(),
-             transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-             ])
+        # Samples are raw uint8 HWC arrays, flip and normalization are applied per batch by FaceCollate.
+        self.transform = None
         self.root_dir = root_dir
         self.local_rank = local_rank
-        path_imgrec = os.path.join(root_dir, 'train.rec')
-        path_imgidx = os.path.join(root_dir, 'train.idx')
-        self.imgrec = mx.recordio.MXIndexedRecordIO(path_imgidx, path_imgrec, 'r')
-        s = self.imgrec.read_idx(0)
+        if mx is None:
+            raise ImportError("MXFaceDataset requires mxnet, convert the dataset with pack_dataset.py "
+                              "and use PackedFaceDataset instead")
+        self.path_imgrec = os.path.join(root_dir, 'train.rec')
+        self.path_imgidx = os.path.join(root_dir, 'train.idx')
+        imgrec = mx.recordio.MXIndexedRecordIO(self.path_imgidx, self.path_imgrec, 'r')
+        s = imgrec.read_idx(0)
         header, _ = mx.recordio.unpack(s)
         if header.flag > 0:
             self.header0 = (int(header.label[0]), int(header.label[1]))
             self.imgidx = np.array(range(1, int(header.label[0])))
         else:
-            self.imgidx = np.array(list(self.imgrec.keys))
+            self.imgidx = np.array(list(imgrec.keys))
+        imgrec.close()
+        # The record handle is not fork-safe, every worker process opens its own on first access.
+        self.imgrec = None
+        self.imgrec_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["imgrec"] = None
+        state["imgrec_pid"] = None
+        return state
 
     def __getitem__(self, index):
+        if self.imgrec is None or self.imgrec_pid != os.getpid():
+            self.imgrec = mx.recordio.MXIndexedRecordIO(self.path_imgidx, self.path_imgrec, 'r')
+            self.imgrec_pid = os.getpid()
         idx = self.imgidx[index]
         s = self.imgrec.read_idx(idx)
         header, img = mx.recordio.unpack(s)
@@ -105,37 +181,102 @@ class MXFaceDataset(Dataset):
 
     def __len__(self):
         return len(self.imgidx)
+def _scan_identity(root, identity):
+    with os.scandir(os.path.join(root, identity)) as it:
+        return sorted(entry.name for entry in it if not entry.name.startswith('.'))
+
+
+def scan_folder(root, num_threads=32):
+    """
+    List a dataset with one directory per identity. Identity directories are listed in parallel, which hides
+    the per-directory latency of network file systems.
+
+    Returns:
+    -------
+    tuple of two np.ndarray
+        Relative image paths (utf-8 bytes) and int32 labels, labels follow the sorted identity directory names.
+    """
+    with os.scandir(root) as it:
+        identities = sorted(entry.name for entry in it if entry.is_dir() and not entry.name.startswith('.'))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        images = list(executor.map(lambda identity: _scan_identity(root, identity), identities))
+    paths = np.array([os.path.join(identity, img).encode('utf-8')
+                      for identity, names in zip(identities, images) for img in names], dtype=np.bytes_)
+    labels = np.repeat(np.arange(len(identities), dtype=np.int32), [len(names) for names in images])
+    return paths, labels
+
+
+def load_folder_index(root, cache_dir=None, rebuild=False, num_threads=32):
+    """
+    Load the cached index of a FaceDatasetFolder, building it with scan_folder if it is missing or stale.
+
+    The index is stored as `paths.npy`/`labels.npy` under `<cache_dir>/.face_index` and keyed by the modification
+    time of the root directory, which changes when identities are added or removed. Rebuild the index explicitly
+    after changing the images of an existing identity.
+
+    Returns:
+    -------
+    tuple of two np.ndarray
+        Memory-mapped relative image paths (utf-8 bytes) and int32 labels.
+    """
+    index_dir = os.path.join(cache_dir if cache_dir is not None else root, FOLDER_INDEX_DIR)
+    meta_path = os.path.join(index_dir, FOLDER_INDEX_META)
+    try:
+        # Created before reading the key, creating it inside the root would otherwise change the root mtime.
+        os.makedirs(index_dir, exist_ok=True)
+    except OSError:
+        pass
+    key = {"root": os.path.abspath(root), "mtime_ns": os.stat(root).st_mtime_ns}
+    if not rebuild and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == key:
+                return (np.load(os.path.join(index_dir, "paths.npy"), mmap_mode='r'),
+                        np.load(os.path.join(index_dir, "labels.npy"), mmap_mode='r'))
+    paths, labels = scan_folder(root, num_threads=num_threads)
+    try:
+        for name, array in [("paths.npy", paths), ("labels.npy", labels)]:
+            tmp = os.path.join(index_dir, "{}.{}.tmp.npy".format(name, os.getpid()))
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(index_dir, name))
+        tmp = "{}.{}.tmp".format(meta_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(key, f)
+        os.replace(tmp, meta_path)
+    except OSError as e:
+        logging.warning("could not write the folder index to %s: %s" % (index_dir, e))
+        return paths, labels
+    return (np.load(os.path.join(index_dir, "paths.npy"), mmap_mode='r'),
+            np.load(os.path.join(index_dir, "labels.npy"), mmap_mode='r'))
+
+
 class FaceDatasetFolder(Dataset):
-    def __init__(self, root_dir, local_rank):
+    def __init__(self, root_dir, local_rank, cache_dir=None, rebuild_index=False):
         super(FaceDatasetFolder, self).__init__()
-        self.transform = transforms.Compose(
-            [transforms.ToPILImage(),
-             transforms.RandomHorizontalFlip(),
-             transforms.ToTensor(),
-             transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-             ])
+        # Samples are raw uint8 HWC arrays, flip and normalization are applied per batch by FaceCollate.
+        self.transform = None
         self.root_dir = root_dir
         self.local_rank = local_rank
-        self.imgidx, self.labels=self.scan(root_dir)
-    def scan(self,root):
-        imgidex=[]
-        labels=[]
-        lb=-1
-        list_dir=os.listdir(root)
-        list_dir.sort()
-        for l in list_dir:
-            images=os.listdir(os.path.join(root,l))
-            lb += 1
-            for img in images:
-                imgidex.append(os.path.join(l,img))
-                labels.append(lb)
-        return imgidex,labels
+        self.cache_dir = cache_dir
+        self.imgidx, self.labels = load_folder_index(root_dir, cache_dir=cache_dir, rebuild=rebuild_index)
+        self.num_samples = len(self.labels)
+
+    def __getstate__(self):
+        # Workers map the cached index themselves instead of receiving a pickled copy of it.
+        state = self.__dict__.copy()
+        state["imgidx"] = None
+        state["labels"] = None
+        return state
+
+    def get_path(self, index):
+        if self.imgidx is None:
+            self.imgidx, self.labels = load_folder_index(self.root_dir, cache_dir=self.cache_dir)
+        return os.path.join(self.root_dir, self.imgidx[index].decode('utf-8'))
+
     def readImage(self,path):
-        return cv2.imread(os.path.join(self.root_dir,path))
+        return cv2.imread(path)
 
     def __getitem__(self, index):
-        path = self.imgidx[index]
-        img=self.readImage(path)
+        img=self.readImage(self.get_path(index))
         label = self.labels[index]
         label = torch.tensor(label, dtype=torch.long)
         sample = cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
@@ -145,4 +286,94 @@ class FaceDatasetFolder(Dataset):
         return sample, label
 
     def __len__(self):
-        return len(self.imgidx)
\ No newline at end of file
+        return self.num_samples
+
+
+class PackedFaceDataset(Dataset):
+    """
+    Face dataset stored in the packed format written by pack_dataset.py: JPEG bytes concatenated into a few large
+    shard files and one numpy index of (shard, offset, length, label) records. Shards and index are memory-mapped,
+    so reading a sample is a slice of a mapping instead of a file seek and read.
+    """
+    def __init__(self, root_dir, local_rank):
+        super(PackedFaceDataset, self).__init__()
+        # Samples are raw uint8 HWC arrays, flip and normalization are applied per batch by FaceCollate.
+        self.transform = None
+        self.root_dir = root_dir
+        self.local_rank = local_rank
+        with open(os.path.join(root_dir, PACKED_META_NAME)) as f:
+            meta = json.load(f)
+        self.num_samples = meta["num_samples"]
+        self.num_shards = meta["num_shards"]
+        self._index = None
+        self._shards = None
+
+    def __getstate__(self):
+        # The mappings are reopened in every worker instead of being pickled with their content.
+        state = self.__dict__.copy()
+        state["_index"] = None
+        state["_shards"] = None
+        return state
+
+    def _open(self):
+        self._index = np.load(os.path.join(self.root_dir, PACKED_INDEX_NAME), mmap_mode='r')
+        assert self._index.dtype == PACKED_INDEX_DTYPE and len(self._index) == self.num_samples
+        self._shards = [np.memmap(os.path.join(self.root_dir, PACKED_SHARD_NAME.format(i)), dtype=np.uint8, mode='r')
+                        for i in range(self.num_shards)]
+
+    def __getitem__(self, index):
+        if self._index is None:
+            self._open()
+        record = self._index[index]
+        offset = int(record['offset'])
+        buf = self._shards[record['shard']][offset:offset + int(record['length'])]
+        sample = cv2.imdecode(np.asarray(buf), cv2.IMREAD_COLOR)
+        sample = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
+        label = torch.tensor(int(record['label']), dtype=torch.long)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample, label
+
+    def __len__(self):
+        return self.num_samples
+
+
+def _test():
+    import tempfile
+
+    def listdir_walk(root):
+        identities = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)) and d[0] != '.')
+        return [(os.path.join(identity, img), label) for label, identity in enumerate(identities)
+                for img in sorted(os.listdir(os.path.join(root, identity)))]
+
+    def index_inode(root):
+        return os.stat(os.path.join(root, FOLDER_INDEX_DIR, "paths.npy")).st_ino
+
+    with tempfile.TemporaryDirectory() as root:
+        for identity, count in [("id_b", 2), ("id_a", 3), ("id_c", 1)]:
+            os.makedirs(os.path.join(root, identity))
+            for i in range(count):
+                open(os.path.join(root, identity, "{}.jpg".format(i)), 'wb').close()
+        paths, labels = load_folder_index(root, num_threads=2)
+        assert [(p.decode('utf-8'), int(l)) for p, l in zip(paths, labels)] == listdir_walk(root)
+        # Unchanged root: the index on disk is reused as is.
+        inode = index_inode(root)
+        paths, labels = load_folder_index(root)
+        assert index_inode(root) == inode and len(paths) == 6
+        # A new identity changes the root mtime, pushed forward in case of a coarse timestamp resolution.
+        os.makedirs(os.path.join(root, "id_0"))
+        open(os.path.join(root, "id_0", "0.jpg"), 'wb').close()
+        mtime_ns = os.stat(root).st_mtime_ns + 10 ** 9
+        os.utime(root, ns=(mtime_ns, mtime_ns))
+        paths, labels = load_folder_index(root)
+        assert index_inode(root) != inode
+        assert [(p.decode('utf-8'), int(l)) for p, l in zip(paths, labels)] == listdir_walk(root)
+        assert paths[0] == os.path.join("id_0", "0.jpg").encode("utf-8") and int(labels[-1]) == 3
+        # An explicit rebuild rescans even when the key matches.
+        inode = index_inode(root)
+        load_folder_index(root, rebuild=True)
+        assert index_inode(root) != inode
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,184 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from config import config as cfg
+from dataset import FaceCollate, load_folder_index
+from export import build_backbone, load_checkpoint
+from gallery import EmbeddingStore, l2_normalize
+from utils.align_trans import norm_crop
+
+
+def read_landmarks(path):
+    """
+    Read a landmark sidecar file with one line `<identity>/<image> x1 y1 ... x5 y5` per image, paths relative
+    to the enrollment root.
+
+    Returns:
+    -------
+    dict
+        Relative path to a (5, 2) float32 landmark array.
+    """
+    landmarks = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 11:
+                continue
+            landmarks[parts[0]] = np.array(parts[1:], dtype=np.float32).reshape(5, 2)
+    return landmarks
+
+
+class EnrollDataset(Dataset):
+    """
+    Reads and aligns the enrollment images. Samples are aligned uint8 RGB 112x112 arrays with their index, so
+    decoding and alignment run in the loader workers.
+
+    Parameters:
+    ----------
+    root_dir : str
+        Enrollment root with one directory per identity.
+    paths : list of str
+        Image paths relative to the root.
+    landmarks : np.ndarray or None
+        (N, 5, 2) landmarks of the images, None if the images are already aligned 112x112 crops.
+    """
+    def __init__(self, root_dir, paths, landmarks=None):
+        super(EnrollDataset, self).__init__()
+        self.root_dir = root_dir
+        self.paths = paths
+        self.landmarks = landmarks
+
+    def __getitem__(self, index):
+        path = os.path.join(self.root_dir, self.paths[index])
+        img = cv2.imread(path)
+        if img is None:
+            raise IOError("could not read {}".format(path))
+        if self.landmarks is not None:
+            img = norm_crop(img, self.landmarks[index])
+        elif img.shape[:2] != (112, 112):
+            raise ValueError("{} is not an aligned 112x112 crop, pass --landmarks".format(path))
+        sample = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return sample, torch.tensor(index, dtype=torch.long)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def load_backbone(args):
+    """
+    Load a TorchScript model written by export.py (`.pt`) or a training checkpoint (`.pth`).
+    """
+    if args.weights.endswith(".pt"):
+        return torch.jit.load(args.weights, map_location="cpu").eval()
+    return load_checkpoint(
+        build_backbone(args.net_size, args.scale, args.gdw_size, args.shuffle, args.embedding_size), args.weights)
+
+
+def select_images(args, store):
+    """
+    Images still to enroll: identities already in the store are skipped, so an interrupted run resumes.
+    """
+    paths, labels = load_folder_index(args.images, cache_dir=args.cache_dir)
+    paths = [p.decode('utf-8') for p in paths]
+    done = set(store.names)
+    landmarks = read_landmarks(args.landmarks) if args.landmarks is not None else None
+    keep = []
+    missing = 0
+    for i, path in enumerate(paths):
+        if path.split('/', 1)[0] in done:
+            continue
+        if landmarks is not None and path not in landmarks:
+            missing += 1
+            continue
+        keep.append(i)
+    if missing > 0:
+        logging.warning("%d images without landmarks skipped" % missing)
+    keep = np.array(keep, dtype=np.int64)
+    paths = [paths[i] for i in keep]
+    labels = np.asarray(labels)[keep]
+    if landmarks is not None:
+        landmarks = np.stack([landmarks[p] for p in paths]) if paths else np.empty((0, 5, 2), np.float32)
+    return paths, labels, landmarks
+
+
+@torch.no_grad()
+def main(args):
+    torch.set_num_threads(args.threads)
+    store = EmbeddingStore(args.output, dim=args.embedding_size, dtype=args.dtype)
+    logging.info("%d identities already enrolled" % len(store))
+    paths, labels, landmarks = select_images(args, store)
+    if len(paths) == 0:
+        logging.info("nothing to enroll")
+        store.close()
+        return
+    # Images of one identity are contiguous, a template is written once all of them are embedded.
+    remaining = dict(zip(*np.unique(labels, return_counts=True)))
+    logging.info("enrolling %d images of %d identities" % (len(paths), len(remaining)))
+
+    backbone = load_backbone(args)
+    loader = DataLoader(EnrollDataset(args.images, paths, landmarks), batch_size=args.batch_size, shuffle=False,
+                        num_workers=args.num_workers, collate_fn=FaceCollate(flip=False))
+    sums = {}
+    num_images = 0
+    tic = time.perf_counter()
+    for step, (img, index) in enumerate(loader):
+        embeddings = backbone(img)
+        if args.flip:
+            embeddings = embeddings + backbone(img.flip(3))
+        embeddings = l2_normalize(embeddings.float().numpy())
+        index = index.numpy()
+        names, templates = [], []
+        for label in np.unique(labels[index]):
+            mask = labels[index] == label
+            sums[label] = sums.get(label, 0) + embeddings[mask].sum(0)
+            remaining[label] -= int(mask.sum())
+            if remaining[label] == 0:
+                names.append(paths[index[mask][0]].split('/', 1)[0])
+                templates.append(sums.pop(label))
+        if names:
+            store.append(names, np.stack(templates))
+        num_images += len(index)
+        if (step + 1) % args.log_every == 0:
+            store.flush()
+            logging.info("%d images, %d identities enrolled, %.1f images/s" %
+                         (num_images, len(store), num_images / (time.perf_counter() - tic)))
+    store.close()
+    logging.info("done: %d images in %.1fs, %.1f images/s, %d identities in store" %
+                 (num_images, time.perf_counter() - tic, num_images / (time.perf_counter() - tic), len(store)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Enroll identities from an image folder tree')
+    parser.add_argument('--images', type=str, required=True, help='root with one directory per identity')
+    parser.add_argument('--landmarks', type=str, default=None,
+                        help='sidecar file with `<identity>/<image> x1 y1 ... x5 y5` lines, omit for aligned crops')
+    parser.add_argument('--output', type=str, required=True, help='embedding store directory')
+    parser.add_argument('--weights', type=str, required=True, help='TorchScript model (.pt) or checkpoint (.pth)')
+    parser.add_argument('--net_size', type=str, default=cfg.net_size, choices=["s", "m"], help='MixNet size')
+    parser.add_argument('--scale', type=float, default=cfg.scale, help='width scale')
+    parser.add_argument('--gdw_size', type=int, default=cfg.gdw_size, help='GDW channels')
+    parser.add_argument('--shuffle', type=int, default=int(cfg.shuffle), help='channel shuffle (ShuffleMixFaceNet)')
+    parser.add_argument('--embedding_size', type=int, default=cfg.embedding_size, help='embedding size')
+    parser.add_argument('--dtype', type=str, default="float16", choices=["float32", "float16", "int8"],
+                        help='store type')
+    parser.add_argument('--flip', action='store_true', help='add the embedding of the flipped image')
+    parser.add_argument('--cache_dir', type=str, default=None, help='directory of the cached folder index')
+    parser.add_argument('--batch_size', type=int, default=64, help='backbone batch size')
+    # Decode/align workers and backbone threads share the cores.
+    num_cpus = os.cpu_count() or 1
+    parser.add_argument('--num_workers', type=int, default=num_cpus // 2, help='decode/align workers')
+    parser.add_argument('--threads', type=int, default=max(1, num_cpus - num_cpus // 2),
+                        help='backbone intra-op threads')
+    parser.add_argument('--log_every', type=int, default=50, help='batches between progress reports')
+    args_ = parser.parse_args()
+    args_.shuffle = bool(args_.shuffle)
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    main(args_)
@@ -27,12 +27,12 @@
 import datetime
 import os
 import pickle
+import time
 
-import mxnet as mx
+import cv2
 import numpy as np
 import sklearn
 import torch
-from mxnet import ndarray as nd
 from scipy import interpolate
 from sklearn.decomposition import PCA
 from sklearn.model_selection import KFold
@@ -88,15 +88,12 @@ def calculate_roc(thresholds,
             dist = np.sum(np.square(diff), 1)
 
         # Find the best threshold for the fold
-        acc_train = np.zeros((nrof_thresholds))
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, _, acc_train[threshold_idx] = calculate_accuracy(
-                threshold, dist[train_set], actual_issame[train_set])
+        _, _, acc_train = calculate_accuracy_sweep(
+            thresholds, dist[train_set], actual_issame[train_set])
         best_threshold_index = np.argmax(acc_train)
-        for threshold_idx, threshold in enumerate(thresholds):
-            tprs[fold_idx, threshold_idx], fprs[fold_idx, threshold_idx], _ = calculate_accuracy(
-                threshold, dist[test_set],
-                actual_issame[test_set])
+        tprs[fold_idx], fprs[fold_idx], _ = calculate_accuracy_sweep(
+            thresholds, dist[test_set],
+            actual_issame[test_set])
         _, _, accuracy[fold_idx] = calculate_accuracy(
             thresholds[best_threshold_index], dist[test_set],
             actual_issame[test_set])
@@ -121,6 +118,32 @@ def calculate_accuracy(threshold, dist, actual_issame):
     return tpr, fpr, acc
 
 
+def _sweep_counts(thresholds, dist, actual_issame):
+    """
+    Number of same and different pairs predicted as same (dist < threshold) for every threshold at once,
+    by binary search of the thresholds in the sorted distances of each class.
+    """
+    actual_issame = np.asarray(actual_issame, dtype=bool)
+    dist_same = np.sort(dist[actual_issame])
+    dist_diff = np.sort(dist[np.logical_not(actual_issame)])
+    thresholds = np.asarray(thresholds)
+    tp = np.searchsorted(dist_same, thresholds, side='left')
+    fp = np.searchsorted(dist_diff, thresholds, side='left')
+    return tp, fp, dist_same.size, dist_diff.size
+
+
+def calculate_accuracy_sweep(thresholds, dist, actual_issame):
+    """
+    Vectorized calculate_accuracy over an array of thresholds, returns arrays of tpr, fpr and accuracy.
+    """
+    tp, fp, n_same, n_diff = _sweep_counts(thresholds, dist, actual_issame)
+    tn = n_diff - fp
+    tpr = tp / float(n_same) if n_same > 0 else np.zeros(tp.shape)
+    fpr = fp / float(n_diff) if n_diff > 0 else np.zeros(fp.shape)
+    acc = (tp + tn) / float(dist.size)
+    return tpr, fpr, acc
+
+
 def calculate_val(thresholds,
                   embeddings1,
                   embeddings2,
@@ -130,7 +153,6 @@ def calculate_val(thresholds,
     assert (embeddings1.shape[0] == embeddings2.shape[0])
     assert (embeddings1.shape[1] == embeddings2.shape[1])
     nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
-    nrof_thresholds = len(thresholds)
     k_fold = LFold(n_splits=nrof_folds, shuffle=False)
 
     val = np.zeros(nrof_folds)
@@ -143,10 +165,8 @@ def calculate_val(thresholds,
     for fold_idx, (train_set, test_set) in enumerate(k_fold.split(indices)):
 
         # Find the threshold that gives FAR = far_target
-        far_train = np.zeros(nrof_thresholds)
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, far_train[threshold_idx] = calculate_val_far(
-                threshold, dist[train_set], actual_issame[train_set])
+        _, far_train = calculate_val_far_sweep(
+            thresholds, dist[train_set], actual_issame[train_set])
         if np.max(far_train) >= far_target:
             f = interpolate.interp1d(far_train, thresholds, kind='slinear')
             threshold = f(far_target)
@@ -176,6 +196,16 @@ def calculate_val_far(threshold, dist, actual_issame):
     return val, far
 
 
+def calculate_val_far_sweep(thresholds, dist, actual_issame):
+    """
+    Vectorized calculate_val_far over an array of thresholds, returns arrays of val and far.
+    """
+    true_accept, false_accept, n_same, n_diff = _sweep_counts(thresholds, dist, actual_issame)
+    val = true_accept / float(n_same)
+    far = false_accept / float(n_diff)
+    return val, far
+
+
 def evaluate(embeddings, actual_issame, nrof_folds=10, pca=0):
     # Calculate evaluation metrics
     thresholds = np.arange(0, 4, 0.01)
@@ -196,73 +226,157 @@ def evaluate(embeddings, actual_issame, nrof_folds=10, pca=0):
                                       nrof_folds=nrof_folds)
     return tpr, fpr, accuracy, val, val_std, far
 
-@torch.no_grad()
-def load_bin(path, image_size):
+def _read_bin(path):
     try:
         with open(path, 'rb') as f:
             bins, issame_list = pickle.load(f)  # py2
     except UnicodeDecodeError as e:
         with open(path, 'rb') as f:
             bins, issame_list = pickle.load(f, encoding='bytes')  # py3
-    data_list = []
-    for flip in [0, 1]:
-        data = torch.empty((len(issame_list) * 2, 3, image_size[0], image_size[1]))
-        data_list.append(data)
-    for idx in range(len(issame_list) * 2):
+    return bins, issame_list
+
+
+def _decode_bin(bins, num_images, image_size, out):
+    """
+    Decode the JPEG images of a verification .bin into a uint8 (N, 3, H, W) RGB array.
+    """
+    for idx in range(num_images):
         _bin = bins[idx]
-        img = mx.image.imdecode(_bin)
-        if img.shape[1] != image_size[0]:
-            img = mx.image.resize_short(img, image_size[0])
-        img = nd.transpose(img, axes=(2, 0, 1))
-        for flip in [0, 1]:
-            if flip == 1:
-                img = mx.ndarray.flip(data=img, axis=2)
-            data_list[flip][idx][:] = torch.from_numpy(img.asnumpy())
+        img = cv2.imdecode(np.frombuffer(_bin, dtype=np.uint8), cv2.IMREAD_COLOR)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if img.shape[0] != image_size[0] or img.shape[1] != image_size[1]:
+            img = cv2.resize(img, (image_size[1], image_size[0]))
+        out[idx] = img.transpose(2, 0, 1)
         if idx % 1000 == 0:
             print('loading bin', idx)
-    print(data_list[0].shape)
-    return data_list, issame_list
-
-@torch.no_grad()
-def test(data_set, backbone, batch_size, nfolds=10):
-    print('testing verification..')
-    data_list = data_set[0]
-    issame_list = data_set[1]
-    embeddings_list = []
-    time_consumed = 0.0
-    for i in range(len(data_list)):
-        data = data_list[i]
-        embeddings = None
-        ba = 0
-        while ba < data.shape[0]:
-            bb = min(ba + batch_size, data.shape[0])
+    return out
+
+
+def load_bin(path, image_size, cache_dir=None):
+    """
+    Load a verification set. The decoded images are cached once as a uint8 (N, 3, H, W) .npy next to the .bin
+    (or in cache_dir) and memory-mapped on later loads; the flipped view is computed at batch time by `test`.
+
+    Returns:
+    -------
+    tuple
+        uint8 image array and the list of is-same flags of the pairs.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_dir = os.path.dirname(path) if cache_dir is None else cache_dir
+    data_path = os.path.join(cache_dir, "{}_{}x{}.npy".format(name, image_size[0], image_size[1]))
+    issame_path = os.path.join(cache_dir, "{}_issame.npy".format(name))
+    if os.path.exists(data_path) and os.path.exists(issame_path) and \
+            os.path.getmtime(data_path) >= os.path.getmtime(path):
+        data = np.load(data_path, mmap_mode='r')
+        issame_list = np.load(issame_path).tolist()
+        print(data.shape)
+        return data, issame_list
+
+    bins, issame_list = _read_bin(path)
+    num_images = len(issame_list) * 2
+    shape = (num_images, 3, image_size[0], image_size[1])
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp.npy".format(data_path[:-len(".npy")], os.getpid())
+        data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+    except OSError:
+        print('cannot write verification cache to', cache_dir)
+        data = _decode_bin(bins, num_images, image_size, np.empty(shape, dtype=np.uint8))
+        print(data.shape)
+        return data, issame_list
+    _decode_bin(bins, num_images, image_size, data)
+    data.flush()
+    del data
+    # Both files are written to a temporary name and renamed, the issame flags first.
+    tmp_issame_path = "{}.{}.tmp.npy".format(issame_path[:-len(".npy")], os.getpid())
+    np.save(tmp_issame_path, np.asarray(issame_list, dtype=bool))
+    os.replace(tmp_issame_path, issame_path)
+    os.replace(tmp_path, data_path)
+    data = np.load(data_path, mmap_mode='r')
+    print(data.shape)
+    return data, issame_list
+
+def _inference_mode():
+    # torch.inference_mode is only available from PyTorch 1.9.
+    return torch.inference_mode() if hasattr(torch, "inference_mode") else torch.no_grad()
+
+
+def extract_embeddings(data, backbone, batch_size=64, device=None, channels_last=False, cache=None):
+    """
+    Stream a uint8 (N, 3, H, W) image array through the backbone. Every batch holds the original and the
+    horizontally flipped images, so both views are embedded in a single forward pass.
+
+    Parameters:
+    ----------
+    data : np.ndarray
+        uint8 images, e.g. the memory-mapped array returned by load_bin.
+    backbone : nn.Module
+        Embedding model in eval mode.
+    batch_size : int, default 64
+        Number of images per batch (the forward pass sees twice as many).
+    device : torch.device or None, default None
+        Device to run on, defaults to the device of the backbone parameters.
+    channels_last : bool, default False
+        Whether to feed the batches in channels_last memory format.
+    cache : EmbeddingCache or None, default None
+        Embedding cache wrapping the backbone (see utils/utils_cache.py), only crops missing from it are
+        forwarded. Device and memory format are those of the cache.
+
+    Returns:
+    -------
+    list of two np.ndarray
+        float32 embeddings of the original and of the flipped images.
+    """
+    if cache is not None:
+        return _extract_cached(data, cache, batch_size)
+    if device is None:
+        device = next(backbone.parameters()).device
+    num_images = data.shape[0]
+    embeddings_list = None
+    with _inference_mode():
+        for ba in range(0, num_images, batch_size):
+            bb = min(ba + batch_size, num_images)
             count = bb - ba
-            _data = data[bb - batch_size: bb]
-            time0 = datetime.datetime.now()
-            img = ((_data / 255) - 0.5) / 0.5
+            _data = torch.from_numpy(np.ascontiguousarray(data[ba:bb])).to(device, non_blocking=True)
+            _data = torch.cat([_data, _data.flip(3)])
+            img = _data.float().sub_(127.5).div_(127.5)
+            if channels_last:
+                img = img.contiguous(memory_format=torch.channels_last)
             net_out: torch.Tensor = backbone(img)
-            _embeddings = net_out.detach().cpu().numpy()
-            time_now = datetime.datetime.now()
-            diff = time_now - time0
-            time_consumed += diff.total_seconds()
-            if embeddings is None:
-                embeddings = np.zeros((data.shape[0], _embeddings.shape[1]))
-            embeddings[ba:bb, :] = _embeddings[(batch_size - count):, :]
-            ba = bb
-        embeddings_list.append(embeddings)
+            _embeddings = net_out.float().cpu().numpy()
+            if embeddings_list is None:
+                embeddings_list = [np.empty((num_images, _embeddings.shape[1]), dtype=np.float32) for _ in range(2)]
+            embeddings_list[0][ba:bb] = _embeddings[:count]
+            embeddings_list[1][ba:bb] = _embeddings[count:]
+    return embeddings_list
+
+
+def _extract_cached(data, cache, batch_size):
+    num_images = data.shape[0]
+    embeddings_list = None
+    for ba in range(0, num_images, batch_size):
+        bb = min(ba + batch_size, num_images)
+        _data = np.asarray(data[ba:bb])
+        _embeddings = cache(np.concatenate([_data, _data[:, :, :, ::-1]]))
+        if embeddings_list is None:
+            embeddings_list = [np.empty((num_images, _embeddings.shape[1]), dtype=np.float32) for _ in range(2)]
+        embeddings_list[0][ba:bb] = _embeddings[:bb - ba]
+        embeddings_list[1][ba:bb] = _embeddings[bb - ba:]
+    return embeddings_list
+
+
+def test(data_set, backbone, batch_size=64, nfolds=10, device=None, channels_last=False, cache=None):
+    print('testing verification..')
+    data = data_set[0]
+    issame_list = data_set[1]
+    time0 = time.time()
+    embeddings_list = extract_embeddings(data, backbone, batch_size, device=device, channels_last=channels_last,
+                                         cache=cache)
+    time_consumed = time.time() - time0
+
+    _xnorm = float(np.mean(np.linalg.norm(np.concatenate(embeddings_list), axis=1)))
 
-    _xnorm = 0.0
-    _xnorm_cnt = 0
-    for embed in embeddings_list:
-        for i in range(embed.shape[0]):
-            _em = embed[i]
-            _norm = np.linalg.norm(_em)
-            _xnorm += _norm
-            _xnorm_cnt += 1
-    _xnorm /= _xnorm_cnt
-
-    embeddings = embeddings_list[0].copy()
-    embeddings = sklearn.preprocessing.normalize(embeddings)
     acc1 = 0.0
     std1 = 0.0
     embeddings = embeddings_list[0] + embeddings_list[1]
@@ -280,6 +394,8 @@ def dumpR(data_set,
           name='',
           data_extra=None,
           label_shape=None):
+    import mxnet as mx
+    from mxnet import ndarray as nd
     print('dump verification embedding..')
     data_list = data_set[0]
     issame_list = data_set[1]
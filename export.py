@@ -0,0 +1,161 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+import backbones.mixnetm as mx
+from backbones import fuse_for_inference
+from config import config as cfg
+
+# Runs in a fresh interpreter outside the repository, so only torch (and onnxruntime) are importable.
+FRESH_PROCESS_CHECK = """
+import sys
+import numpy as np
+import torch
+ref = np.load(sys.argv[2])
+model = torch.jit.load(sys.argv[1], map_location="cpu")
+with torch.no_grad():
+    out = model(torch.from_numpy(ref["x"])).numpy()
+assert "backbones" not in sys.modules
+print(float(np.abs(out - ref["y"]).max()))
+if len(sys.argv) > 3:
+    import onnxruntime
+    session = onnxruntime.InferenceSession(sys.argv[3], providers=["CPUExecutionProvider"])
+    out = session.run(None, {session.get_inputs()[0].name: ref["x"]})[0]
+    print(float(np.abs(out - ref["y"]).max()))
+"""
+
+
+def build_backbone(net_size, scale, gdw_size, shuffle, embedding_size):
+    """
+    Build the MixNet variant selected in config.py.
+    """
+    if net_size == "s":
+        return mx.mixnet_s(embedding_size=embedding_size, width_scale=scale, gdw_size=gdw_size, shuffle=shuffle)
+    elif net_size == "m":
+        return mx.mixnet_m(embedding_size=embedding_size, width_scale=scale, gdw_size=gdw_size, shuffle=shuffle)
+    raise ValueError("Unsupported MixNet size {}".format(net_size))
+
+
+def load_checkpoint(backbone, path):
+    """
+    Load a `<step>backbone.pth` written by CallBackModelCheckpoint (a DDP-wrapped state dict is accepted too).
+    """
+    state_dict = torch.load(path, map_location=torch.device('cpu'))
+    state_dict = {(k[len("module."):] if k.startswith("module.") else k): v for k, v in state_dict.items()}
+    backbone.load_state_dict(state_dict)
+    return backbone.eval()
+
+
+def export_torchscript(backbone, path, example, meta):
+    """
+    Trace the model and save it with the model configuration attached as `config.json`. Tracing is used because
+    MixConv iterates over its child modules, which TorchScript scripting does not support.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(backbone, example)
+    torch.jit.save(traced, path, _extra_files={"config.json": json.dumps(meta)})
+    return traced
+
+
+def export_onnx(backbone, path, example, opset):
+    with torch.no_grad():
+        torch.onnx.export(
+            backbone, example, path, input_names=["input"], output_names=["embedding"],
+            dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}},
+            opset_version=opset, do_constant_folding=True)
+
+
+def check_parity(backbone, traced, onnx_path, batch_sizes, atol):
+    """
+    Compare the exported graphs with the eager model on random inputs of several batch sizes.
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        onnxruntime = None
+        logging.info("onnxruntime not installed, ONNX parity check skipped")
+    session = None
+    if onnxruntime is not None and onnx_path is not None:
+        session = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 3, 112, 112)
+        with torch.no_grad():
+            y = backbone(x).numpy()
+            diff = np.abs(traced(x).numpy() - y).max()
+        logging.info("batch %d: torchscript max abs diff %.3e" % (batch_size, diff))
+        assert diff <= atol, "TorchScript output differs from the eager model"
+        if session is not None:
+            diff = np.abs(session.run(None, {"input": x.numpy()})[0] - y).max()
+            logging.info("batch %d: onnx max abs diff %.3e" % (batch_size, diff))
+            assert diff <= atol, "ONNX output differs from the eager model"
+    return session is not None
+
+
+def check_fresh_process(backbone, ts_path, onnx_path, batch_size, atol):
+    """
+    Load and run the artifacts in a new interpreter started outside the repository.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        ref_path = os.path.join(tmp, "reference.npz")
+        x = torch.randn(batch_size, 3, 112, 112)
+        with torch.no_grad():
+            np.savez(ref_path, x=x.numpy(), y=backbone(x).numpy())
+        cmd = [sys.executable, "-c", FRESH_PROCESS_CHECK, os.path.abspath(ts_path), ref_path]
+        if onnx_path is not None:
+            cmd.append(os.path.abspath(onnx_path))
+        output = subprocess.run(cmd, cwd=tmp, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    diffs = [float(line) for line in output.split()]
+    logging.info("fresh process max abs diff: %s" % ", ".join("%.3e" % d for d in diffs))
+    assert max(diffs) <= atol, "exported model differs from the eager model in a fresh process"
+
+
+def main(args):
+    backbone = load_checkpoint(
+        build_backbone(args.net_size, args.scale, args.gdw_size, args.shuffle, args.embedding_size), args.weights)
+    if args.fuse:
+        backbone = fuse_for_inference(backbone)
+    os.makedirs(args.output, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.weights))[0]
+    meta = {"net_size": args.net_size, "scale": args.scale, "gdw_size": args.gdw_size, "shuffle": args.shuffle,
+            "embedding_size": args.embedding_size, "fused": args.fuse, "input_size": [112, 112],
+            "input_normalization": "(x / 255 - 0.5) / 0.5"}
+    example = torch.randn(2, 3, 112, 112)
+
+    ts_path = os.path.join(args.output, name + ".pt")
+    traced = export_torchscript(backbone, ts_path, example, meta)
+    logging.info("saved TorchScript model to %s" % ts_path)
+    onnx_path = None
+    if not args.no_onnx:
+        onnx_path = os.path.join(args.output, name + ".onnx")
+        export_onnx(backbone, onnx_path, example, args.opset)
+        logging.info("saved ONNX model to %s" % onnx_path)
+
+    has_ort = check_parity(backbone, traced, onnx_path, args.batch_sizes, args.atol)
+    check_fresh_process(backbone, ts_path, onnx_path if has_ort else None, args.batch_sizes[-1], args.atol)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a MixFaceNet checkpoint to TorchScript and ONNX')
+    parser.add_argument('--weights', type=str, required=True, help='checkpoint written by CallBackModelCheckpoint')
+    parser.add_argument('--output', type=str, default="export", help='output directory')
+    parser.add_argument('--net_size', type=str, default=cfg.net_size, choices=["s", "m"], help='MixNet size')
+    parser.add_argument('--scale', type=float, default=cfg.scale, help='width scale')
+    parser.add_argument('--gdw_size', type=int, default=cfg.gdw_size, help='GDW channels')
+    parser.add_argument('--shuffle', type=int, default=int(cfg.shuffle), help='channel shuffle (ShuffleMixFaceNet)')
+    parser.add_argument('--embedding_size', type=int, default=cfg.embedding_size, help='embedding size')
+    parser.add_argument('--fuse', action='store_true', help='fold BatchNorm layers before exporting')
+    parser.add_argument('--no_onnx', action='store_true', help='only export TorchScript')
+    parser.add_argument('--opset', type=int, default=11, help='ONNX opset version')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 17], help='parity check batch sizes')
+    parser.add_argument('--atol', type=float, default=1e-4, help='maximum absolute difference')
+    args_ = parser.parse_args()
+    args_.shuffle = bool(args_.shuffle)
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    main(args_)
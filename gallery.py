@@ -0,0 +1,423 @@
+import json
+import os
+
+import numpy as np
+
+GALLERY_META_NAME = "gallery.json"
+GALLERY_CODES_NAME = "codes.npy"
+GALLERY_IDS_NAME = "ids.npy"
+STORE_META_NAME = "store.json"
+STORE_CODES_NAME = "codes.bin"
+STORE_NAMES_NAME = "names.txt"
+# Symmetric int8 scale: the components of an L2-normalized vector lie in [-1, 1].
+INT8_SCALE = 127.0
+
+
+def l2_normalize(x, eps=1e-12):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), eps)
+
+
+def _merge_topk(scores, ids, new_scores, new_ids, k):
+    """
+    Merge a block of candidate scores into the running per-query top-k (unsorted).
+    """
+    if new_scores.shape[1] > k:
+        part = np.argpartition(-new_scores, k - 1, axis=1)[:, :k]
+        new_scores = np.take_along_axis(new_scores, part, axis=1)
+        new_ids = np.take_along_axis(new_ids, part, axis=1)
+    if scores is None:
+        return new_scores, new_ids
+    scores = np.concatenate([scores, new_scores], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    return scores, ids
+
+
+def _sort_topk(scores, ids):
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class Gallery(object):
+    """
+    Gallery of L2-normalized embeddings stored as float16 or int8 codes with an id per row, searched exactly
+    by cosine similarity. The codes are decoded and multiplied with the queries one block at a time, so the
+    float32 working set stays bounded by the block size.
+
+    Parameters:
+    ----------
+    dim : int, default 512
+        Embedding size.
+    dtype : str, default 'float16'
+        Storage type, 'float32', 'float16' or 'int8'.
+    capacity : int, default 1024
+        Initial number of rows, the storage grows by doubling.
+    """
+    def __init__(self, dim=512, dtype="float16", capacity=1024):
+        if dtype not in ("float32", "float16", "int8"):
+            raise ValueError("Unsupported gallery dtype {}".format(dtype))
+        self.dim: int = dim
+        self.dtype: str = dtype
+        self.codes = np.empty((capacity, dim), dtype=dtype)
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def encode(self, embeddings):
+        embeddings = l2_normalize(embeddings)
+        if self.dtype == "int8":
+            return np.clip(np.rint(embeddings * INT8_SCALE), -127, 127).astype(np.int8)
+        return embeddings.astype(self.dtype)
+
+    def decode(self, codes):
+        codes = codes.astype(np.float32)
+        if self.dtype == "int8":
+            codes *= 1.0 / INT8_SCALE
+        return codes
+
+    def add(self, embeddings, ids):
+        """
+        Append embeddings (normalized here) with their integer ids.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        assert embeddings.shape == (len(ids), self.dim)
+        end = self.size + len(ids)
+        if end > len(self.codes):
+            capacity = max(end, 2 * len(self.codes))
+            codes = np.empty((capacity, self.dim), dtype=self.dtype)
+            codes[:self.size] = self.codes[:self.size]
+            self.codes = codes
+            self.ids = np.resize(self.ids, capacity)
+        self.codes[self.size:end] = self.encode(embeddings)
+        self.ids[self.size:end] = ids
+        self.size = end
+
+    def search(self, queries, k=10, block_size=65536):
+        """
+        Exact top-k cosine search.
+
+        Parameters:
+        ----------
+        queries : np.ndarray
+            (Q, dim) query embeddings, normalized here.
+        k : int, default 10
+            Number of neighbours.
+        block_size : int, default 65536
+            Number of gallery rows decoded and scored at once.
+
+        Returns:
+        -------
+        tuple of two np.ndarray
+            (Q, k) cosine similarities in descending order and the corresponding ids.
+        """
+        queries = l2_normalize(queries)
+        if self.size == 0:
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+        k = min(k, self.size)
+        scores = ids = None
+        for start in range(0, self.size, block_size):
+            end = min(start + block_size, self.size)
+            block_scores = queries @ self.decode(self.codes[start:end]).T
+            block_ids = np.broadcast_to(self.ids[start:end], block_scores.shape)
+            scores, ids = _merge_topk(scores, ids, block_scores, block_ids, k)
+        return _sort_topk(scores, ids)
+
+    def reconstruct(self, rows):
+        return self.decode(self.codes[rows])
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, GALLERY_CODES_NAME), self.codes[:self.size])
+        np.save(os.path.join(path, GALLERY_IDS_NAME), self.ids[:self.size])
+        with open(os.path.join(path, GALLERY_META_NAME), 'w') as f:
+            json.dump({"dim": self.dim, "dtype": self.dtype, "size": self.size}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a saved gallery, memory-mapping the codes unless mmap is False.
+        """
+        with open(os.path.join(path, GALLERY_META_NAME)) as f:
+            meta = json.load(f)
+        gallery = cls(dim=meta["dim"], dtype=meta["dtype"], capacity=0)
+        gallery.codes = np.load(os.path.join(path, GALLERY_CODES_NAME), mmap_mode='r' if mmap else None)
+        gallery.ids = np.load(os.path.join(path, GALLERY_IDS_NAME))
+        gallery.size = meta["size"]
+        return gallery
+
+
+def kmeans(x, num_centroids, num_iters=20, seed=0, block_size=65536):
+    """
+    Lloyd's k-means on float32 rows with inner-product assignment (argmax of x.c - |c|^2 / 2).
+    Empty clusters are re-seeded with random rows.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), num_centroids, replace=False)].copy()
+    for _ in range(num_iters):
+        assign = kmeans_assign(x, centroids, block_size)
+        counts = np.bincount(assign, minlength=num_centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def kmeans_assign(x, centroids, block_size=65536):
+    half_norm = 0.5 * (centroids * centroids).sum(1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), block_size):
+        end = min(start + block_size, len(x))
+        assign[start:end] = np.argmax(x[start:end] @ centroids.T - half_norm, axis=1)
+    return assign
+
+
+class IVFPQIndex(object):
+    """
+    Inverted file index with product-quantized residuals for sub-linear inner-product search on normalized
+    embeddings. A query scans only the `nprobe` lists with the closest coarse centroids and scores each entry
+    as q.c + sum_j LUT[j, code_j], with one (num_subspaces, 256) lookup table per query.
+
+    Parameters:
+    ----------
+    dim : int, default 512
+        Embedding size.
+    num_lists : int, default 1024
+        Number of coarse centroids (inverted lists).
+    num_subspaces : int, default 64
+        Number of PQ sub-vectors, each encoded with one byte.
+    """
+    def __init__(self, dim=512, num_lists=1024, num_subspaces=64):
+        assert dim % num_subspaces == 0
+        self.dim: int = dim
+        self.num_lists: int = num_lists
+        self.num_subspaces: int = num_subspaces
+        self.dsub: int = dim // num_subspaces
+        self.centroids = None
+        self.codebooks = None
+        self.list_codes = [[] for _ in range(num_lists)]
+        self.list_ids = [[] for _ in range(num_lists)]
+        self.codes = None
+        self.ids = None
+        self.offsets = None
+
+    def train(self, x, num_iters=20, seed=0):
+        """
+        Learn the coarse centroids and the PQ codebooks from a sample of normalized embeddings.
+        """
+        x = l2_normalize(x)
+        # k-means seeds the centroids with distinct training rows
+        if len(x) < max(self.num_lists, 256):
+            raise ValueError("IVF-PQ training needs at least {} embeddings ({} lists, 256 codewords), got {}".format(
+                max(self.num_lists, 256), self.num_lists, len(x)))
+        self.centroids = kmeans(x, self.num_lists, num_iters, seed)
+        residuals = x - self.centroids[kmeans_assign(x, self.centroids)]
+        self.codebooks = np.stack([
+            kmeans(residuals[:, j * self.dsub:(j + 1) * self.dsub], 256, num_iters, seed + j + 1)
+            for j in range(self.num_subspaces)])
+
+    def _encode(self, residuals):
+        codes = np.empty((len(residuals), self.num_subspaces), dtype=np.uint8)
+        for j in range(self.num_subspaces):
+            sub = residuals[:, j * self.dsub:(j + 1) * self.dsub]
+            # Nearest codeword in L2 distance.
+            codes[:, j] = kmeans_assign(sub, self.codebooks[j])
+        return codes
+
+    def add(self, embeddings, ids):
+        x = l2_normalize(embeddings)
+        ids = np.asarray(ids, dtype=np.int64)
+        assign = kmeans_assign(x, self.centroids)
+        codes = self._encode(x - self.centroids[assign])
+        for lst in np.unique(assign):
+            mask = assign == lst
+            self.list_codes[lst].append(codes[mask])
+            self.list_ids[lst].append(ids[mask])
+        self.codes = None
+
+    def _finalize(self):
+        """
+        Concatenate the inverted lists into one code array with list offsets.
+        """
+        codes = [np.concatenate(c) if c else np.empty((0, self.num_subspaces), np.uint8) for c in self.list_codes]
+        ids = [np.concatenate(i) if i else np.empty(0, np.int64) for i in self.list_ids]
+        self.offsets = np.concatenate([[0], np.cumsum([len(c) for c in codes])])
+        self.codes = np.concatenate(codes)
+        self.ids = np.concatenate(ids)
+        self.list_codes = [[c] for c in codes]
+        self.list_ids = [[i] for i in ids]
+
+    def __len__(self):
+        return sum(sum(len(i) for i in ids) for ids in self.list_ids)
+
+    def search(self, queries, k=10, nprobe=16):
+        """
+        Approximate top-k inner-product search.
+
+        Returns:
+        -------
+        tuple of two np.ndarray
+            (Q, k) approximate similarities in descending order and the corresponding ids (-1 where fewer than
+            k entries were scanned).
+        """
+        if self.codes is None:
+            self._finalize()
+        queries = l2_normalize(queries)
+        nprobe = min(nprobe, self.num_lists)
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        # (Q, num_subspaces, 256) inner products of the query sub-vectors with the codewords.
+        luts = np.einsum('qjd,jcd->qjc', queries.reshape(len(queries), self.num_subspaces, self.dsub), self.codebooks)
+        subspaces = np.arange(self.num_subspaces)
+        out_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        out_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for q in range(len(queries)):
+            lists = probes[q]
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            if len(rows) == 0:
+                continue
+            base = np.repeat(coarse[q, lists], self.offsets[lists + 1] - self.offsets[lists])
+            scores = base + luts[q][subspaces, self.codes[rows].astype(np.int64)].sum(1)
+            kk = min(k, len(rows))
+            top = np.argpartition(-scores, kk - 1)[:kk]
+            top = top[np.argsort(-scores[top])]
+            out_scores[q, :kk] = scores[top]
+            out_ids[q, :kk] = self.ids[rows[top]]
+        return out_scores, out_ids
+
+
+class EmbeddingStore(object):
+    """
+    Append-only on-disk store of named embeddings, e.g. enrolled identity templates. Rows are appended to a raw
+    code file and names to a text file, in that order, so a store interrupted mid-write is recovered on open by
+    truncating both files to the rows that have a name.
+
+    Parameters:
+    ----------
+    path : str
+        Store directory, created or reopened.
+    dim : int, default 512
+        Embedding size.
+    dtype : str, default 'float16'
+        Storage type, see Gallery.
+    """
+    def __init__(self, path, dim=512, dtype="float16"):
+        os.makedirs(path, exist_ok=True)
+        self.path: str = path
+        self.codec = Gallery(dim=dim, dtype=dtype, capacity=0)
+        meta_path = os.path.join(path, STORE_META_NAME)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta != {"dim": dim, "dtype": dtype}:
+                raise ValueError("Store {} was created with {}".format(path, meta))
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump({"dim": dim, "dtype": dtype}, f)
+        self.row_bytes = dim * np.dtype(dtype).itemsize
+        self.codes_path = os.path.join(path, STORE_CODES_NAME)
+        self.names_path = os.path.join(path, STORE_NAMES_NAME)
+        self.names = self._recover()
+        self._codes = open(self.codes_path, 'ab')
+        self._names = open(self.names_path, 'a', encoding='utf-8')
+
+    def _recover(self):
+        names = []
+        if os.path.exists(self.names_path):
+            with open(self.names_path, encoding='utf-8') as f:
+                content = f.read()
+            # A trailing line without newline was cut off.
+            names = content.split('\n')[:-1]
+        num_rows = os.path.getsize(self.codes_path) // self.row_bytes if os.path.exists(self.codes_path) else 0
+        size = min(len(names), num_rows)
+        names = names[:size]
+        with open(self.codes_path, 'ab') as f:
+            f.truncate(size * self.row_bytes)
+        with open(self.names_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(name + '\n' for name in names))
+        return names
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, names, embeddings):
+        """
+        Append embeddings (normalized here) with their names, names must not contain newlines.
+        """
+        assert len(names) == len(embeddings)
+        self._codes.write(self.codec.encode(embeddings).tobytes())
+        self._codes.flush()
+        self._names.write(''.join(name + '\n' for name in names))
+        self.names.extend(names)
+
+    def flush(self):
+        for f in [self._codes, self._names]:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.flush()
+        self._codes.close()
+        self._names.close()
+
+    def to_gallery(self):
+        """
+        Memory-map the stored codes as a Gallery whose ids are row numbers into `names`.
+        """
+        self.flush()
+        gallery = Gallery(dim=self.codec.dim, dtype=self.codec.dtype, capacity=0)
+        if len(self.names) > 0:
+            gallery.codes = np.memmap(self.codes_path, dtype=self.codec.dtype, mode='r',
+                                      shape=(len(self.names), self.codec.dim))
+        gallery.ids = np.arange(len(self.names), dtype=np.int64)
+        gallery.size = len(self.names)
+        return gallery
+
+
+def _test():
+    rng = np.random.RandomState(0)
+    x = l2_normalize(rng.randn(5000, 64))
+    queries = x[:20] + 0.05 * rng.randn(20, 64).astype(np.float32)
+    exact = Gallery(dim=64, dtype="float32")
+    exact.add(x, np.arange(len(x)))
+    scores, ids = Gallery(dim=64).search(queries, k=5)
+    assert scores.shape == ids.shape == (20, 0)
+    _, ref_ids = exact.search(queries, k=5, block_size=1000)
+    assert (ref_ids[:, 0] == np.arange(20)).all()
+    for dtype in ["float16", "int8"]:
+        gallery = Gallery(dim=64, dtype=dtype, capacity=16)
+        gallery.add(x, np.arange(len(x)))
+        _, ids = gallery.search(queries, k=5, block_size=777)
+        assert (ids[:, 0] == ref_ids[:, 0]).all()
+    index = IVFPQIndex(dim=64, num_lists=16, num_subspaces=8)
+    index.train(x, num_iters=5)
+    index.add(x, np.arange(len(x)))
+    _, ids = index.search(queries, k=5, nprobe=4)
+    print("IVF-PQ recall@1: {}".format((ids[:, 0] == ref_ids[:, 0]).mean()))
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EmbeddingStore(tmp, dim=64)
+        store.append(["a", "b"], x[:2])
+        store.close()
+        # An interrupted append leaves a code row without a name.
+        with open(os.path.join(tmp, STORE_CODES_NAME), 'ab') as f:
+            f.write(b"\0" * 128)
+        store = EmbeddingStore(tmp, dim=64)
+        assert store.names == ["a", "b"]
+        _, ids = store.to_gallery().search(x[1:2], k=1)
+        assert ids[0, 0] == 1
+        store.close()
+
+
+if __name__ == "__main__":
+    _test()
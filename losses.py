@@ -6,19 +6,34 @@ from math import pi
 
 import numpy as np
 
+
+def sparse_margin(cosine, label, s, target_logit):
+    """
+    Scale the cosines in place by s and replace the target entries (label != -1) with their margin logits.
+    Only the target entries are gathered and scattered, so the cost beyond the scaling is O(batch size).
+    """
+    index = torch.where(label != -1)[0]
+    target = label[index]
+    target_cosine = cosine[index, target]
+    cosine.mul_(s)
+    cosine[index, target] = target_logit(target_cosine)
+    return cosine
+
+
 class CosFace(nn.Module):
     def __init__(self, s=64.0, m=0.40):
         super(CosFace, self).__init__()
         self.s = s
         self.m = m
 
-    def forward(self, cosine, label):
-        index = torch.where(label != -1)[0]
-        m_hot = torch.zeros(index.size()[0], cosine.size()[1], device=cosine.device)
-        m_hot.scatter_(1, label[index, None], self.m)
-        cosine[index] -= m_hot
-        ret = cosine * self.s
-        return ret
+    def forward(self, cosine: torch.Tensor, label):
+        return sparse_margin(cosine, label, self.s, self.target_logit)
+
+    def target_logit(self, cosine):
+        """
+        Logit of the target class for a vector of target cosines, the other classes get s * cosine.
+        """
+        return (cosine - self.m) * self.s
 
 class Softmax(nn.Module):
     def __init__(self, s=64.0, m=0.40):
@@ -28,6 +43,10 @@ class Softmax(nn.Module):
     def forward(self, cosine, label):
         ret = cosine * self.s
         return ret
+
+    def target_logit(self, cosine):
+        return cosine * self.s
+
 class ArcFace(nn.Module):
     def __init__(self, s=64.0, m=0.5):
         super(ArcFace, self).__init__()
@@ -35,13 +54,10 @@ class ArcFace(nn.Module):
         self.m = m
 
     def forward(self, cosine: torch.Tensor, label):
-        index = torch.where(label != -1)[0]
-        m_hot = torch.zeros(index.size()[0], cosine.size()[1], device=cosine.device)
-        m_hot.scatter_(1, label[index, None], self.m)
-        cosine.acos_()
-        cosine[index] += m_hot
-        cosine.cos_().mul_(self.s)
-        return cosine
+        return sparse_margin(cosine, label, self.s, self.target_logit)
+
+    def target_logit(self, cosine):
+        return torch.cos(torch.acos(cosine) + self.m) * self.s
 
 
 class CombineLoss(nn.Module):
@@ -53,15 +69,9 @@ class CombineLoss(nn.Module):
         self.m2 = 0.3
         self.m3 = 0.2
     def forward(self, cosine: torch.Tensor, label):
-        index = torch.where(label != -1)[0]
-        m_hot = torch.zeros(index.size()[0], cosine.size()[1], device=cosine.device)
-        m_hot.scatter_(1, label[index, None], self.m2)
-        m_hot3 = torch.zeros(index.size()[0], cosine.size()[1], device=cosine.device)
-        m_hot3.scatter_(1, label[index, None], self.m3)
-        cosine.acos_()
-        cosine[index] += m_hot
-        cosine.cos_()
-        cosine[index] -= m_hot3
-        cosine.mul_(self.s)
-        return cosine
+        return sparse_margin(cosine, label, self.s, self.target_logit)
+
+    def target_logit(self, cosine):
+        return (torch.cos(torch.acos(cosine) + self.m2) - self.m3) * self.s
+
 
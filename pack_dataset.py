@@ -0,0 +1,104 @@
+import argparse
+import json
+import logging
+import numbers
+import os
+import sys
+
+import numpy as np
+
+from dataset import FaceDatasetFolder, PACKED_INDEX_DTYPE, PACKED_INDEX_NAME, PACKED_META_NAME, PACKED_SHARD_NAME
+
+
+class PackedWriter(object):
+    """
+    Writes encoded images into shard files of bounded size and collects the packed index.
+    """
+    def __init__(self, output_dir, shard_size=4 << 30):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.index = np.empty(1 << 20, dtype=PACKED_INDEX_DTYPE)
+        self.num_samples = 0
+        self.shard_id = -1
+        self.shard = None
+        self.shard_offset = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _next_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+        self.shard_id += 1
+        self.shard = open(os.path.join(self.output_dir, PACKED_SHARD_NAME.format(self.shard_id)), 'wb')
+        self.shard_offset = 0
+
+    def write(self, img_bytes, label):
+        if self.shard is None or (self.shard_offset > 0 and self.shard_offset + len(img_bytes) > self.shard_size):
+            self._next_shard()
+        self.shard.write(img_bytes)
+        if self.num_samples == len(self.index):
+            self.index = np.resize(self.index, 2 * len(self.index))
+        self.index[self.num_samples] = (self.shard_id, self.shard_offset, len(img_bytes), label)
+        self.num_samples += 1
+        self.shard_offset += len(img_bytes)
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+        index = self.index[:self.num_samples]
+        np.save(os.path.join(self.output_dir, PACKED_INDEX_NAME), index)
+        num_classes = int(index['label'].max()) + 1 if len(index) > 0 else 0
+        with open(os.path.join(self.output_dir, PACKED_META_NAME), 'w') as f:
+            json.dump({"num_samples": len(index), "num_shards": self.shard_id + 1, "num_classes": num_classes}, f)
+        logging.info("packed %d images of %d classes into %d shards" % (len(index), num_classes, self.shard_id + 1))
+
+
+def pack_record(root_dir, output_dir, shard_size=4 << 30):
+    """
+    Convert a `train.rec`/`train.idx` MXNet RecordIO dataset into the packed format.
+    """
+    import mxnet as mx
+    imgrec = mx.recordio.MXIndexedRecordIO(
+        os.path.join(root_dir, 'train.idx'), os.path.join(root_dir, 'train.rec'), 'r')
+    header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+    if header.flag > 0:
+        imgidx = range(1, int(header.label[0]))
+    else:
+        imgidx = list(imgrec.keys)
+    writer = PackedWriter(output_dir, shard_size)
+    for i, idx in enumerate(imgidx):
+        header, img = mx.recordio.unpack(imgrec.read_idx(idx))
+        label = header.label
+        if not isinstance(label, numbers.Number):
+            label = label[0]
+        writer.write(img, int(label))
+        if i % 100000 == 0:
+            logging.info("packed %d images" % i)
+    writer.close()
+
+
+def pack_folder(root_dir, output_dir, shard_size=4 << 30):
+    """
+    Convert a dataset in the FaceDatasetFolder layout (one directory per identity) into the packed format.
+    """
+    folder = FaceDatasetFolder(root_dir=root_dir, local_rank=0)
+    writer = PackedWriter(output_dir, shard_size)
+    for i in range(len(folder)):
+        with open(folder.get_path(i), 'rb') as f:
+            writer.write(f.read(), int(folder.labels[i]))
+        if i % 100000 == 0:
+            logging.info("packed %d images" % i)
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a training set into the packed memory-mapped format')
+    parser.add_argument('--input', type=str, required=True, help='directory with train.rec/train.idx or image folders')
+    parser.add_argument('--output', type=str, required=True, help='output directory')
+    parser.add_argument('--format', type=str, default="rec", choices=["rec", "folder"], help="input format")
+    parser.add_argument('--shard_size', type=int, default=4 << 30, help="maximum shard size in bytes")
+    args_ = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    if args_.format == "rec":
+        pack_record(args_.input, args_.output, args_.shard_size)
+    else:
+        pack_folder(args_.input, args_.output, args_.shard_size)
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import os
 
@@ -18,19 +19,34 @@ class PartialFC(Module):
 
     @torch.no_grad()
     def __init__(self, rank, local_rank, world_size, batch_size, resume,
-                 margin_softmax, num_classes, sample_rate=1.0, embedding_size=512, prefix="./",global_step=100):
+                 margin_softmax, num_classes, sample_rate=1.0, embedding_size=512, prefix="./",global_step=100,
+                 device=None, fused=False, chunk_size=8192, offload=None):
         super(PartialFC, self).__init__()
         #
         self.num_classes: int = num_classes
         self.rank: int = rank
         self.local_rank: int = local_rank
-        self.device: torch.device = torch.device("cuda:{}".format(self.local_rank))
+        # Defaults to the GPU of the local rank; any other device (e.g. cpu with the gloo backend) works too.
+        if device is None:
+            device = torch.device("cuda:{}".format(self.local_rank))
+        self.device: torch.device = torch.device(device)
         self.world_size: int = world_size
         self.batch_size: int = batch_size
         self.margin_softmax: callable = margin_softmax
         self.sample_rate: float = sample_rate
         self.embedding_size: int = embedding_size
         self.prefix: str = prefix
+        # Offloaded weights: the class weights and momentum live in pinned host memory ("pinned") or in
+        # memory-mapped files in prefix ("memmap") and are streamed through the fused path chunk by chunk.
+        if offload not in (None, "pinned", "memmap"):
+            raise ValueError("Unsupported softmax weight offload {}".format(offload))
+        if offload is not None and int(sample_rate) != 1:
+            raise ValueError("Offloaded softmax weights need sample_rate 1")
+        self.offload = offload
+        # Fused path: loss and gradients in chunks of classes, see forward_backward_fused.
+        self.fused: bool = fused or offload is not None
+        self.chunk_size: int = chunk_size
+        self.buffers = None
         self.num_local: int = num_classes // world_size + int(rank < num_classes % world_size)
         self.class_start: int = num_classes // world_size * rank + min(rank, num_classes % world_size)
         self.num_sample: int = int(self.sample_rate * self.num_local)
@@ -38,26 +54,31 @@ class PartialFC(Module):
         self.weight_name = os.path.join(self.prefix,str(global_step)+ "rank:{}_softmax_weight.pt".format(self.rank))
         self.weight_mom_name = os.path.join(self.prefix,str(global_step)+ "rank:{}_softmax_weight_mom.pt".format(self.rank))
 
+        weight_device = torch.device("cpu") if offload is not None else self.device
         if resume:
             try:
-                self.weight: torch.Tensor = torch.load(self.weight_name)
+                self.weight: torch.Tensor = torch.load(self.weight_name, map_location=weight_device)
                 logging.info("softmax weight resume successfully!")
             except (FileNotFoundError, KeyError, IndexError):
-                self.weight = torch.normal(0, 0.01, (self.num_local, self.embedding_size), device=self.device)
+                self.weight = torch.normal(0, 0.01, (self.num_local, self.embedding_size), device=weight_device)
                 logging.info("softmax weight resume fail!")
 
             try:
-                self.weight_mom: torch.Tensor = torch.load(self.weight_mom_name)
+                self.weight_mom: torch.Tensor = torch.load(self.weight_mom_name, map_location=weight_device)
                 logging.info("softmax weight mom resume successfully!")
             except (FileNotFoundError, KeyError, IndexError):
                 self.weight_mom: torch.Tensor = torch.zeros_like(self.weight)
                 logging.info("softmax weight mom resume fail!")
         else:
-            self.weight = torch.normal(0, 0.01, (self.num_local, self.embedding_size), device=self.device)
+            self.weight = torch.normal(0, 0.01, (self.num_local, self.embedding_size), device=weight_device)
             self.weight_mom: torch.Tensor = torch.zeros_like(self.weight)
             logging.info("softmax weight init successfully!")
             logging.info("softmax weight mom init successfully!")
-        self.stream: torch.cuda.Stream = torch.cuda.Stream(local_rank)
+        if offload is not None:
+            self.weight = self.host_tensor(self.weight, "weight")
+            self.weight_mom = self.host_tensor(self.weight_mom, "weight_mom")
+        # Side stream for the label gathering and sampling, only on GPU.
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
 
         self.index = None
         if int(self.sample_rate) == 1:
@@ -65,11 +86,28 @@ class PartialFC(Module):
             self.sub_weight = Parameter(self.weight)
             self.sub_weight_mom = self.weight_mom
         else:
-            self.sub_weight = Parameter(torch.empty((0, 0)).cuda(local_rank))
+            # Workspace of the sampled weight and momentum, refilled in place every step.
+            self.workspace = (Parameter(torch.empty((self.num_sample, self.embedding_size), device=self.device)),
+                              torch.empty((self.num_sample, self.embedding_size), device=self.device))
+            self.sub_weight, self.sub_weight_mom = self.workspace
+
+    def host_tensor(self, tensor, name):
+        """
+        Copy of a cpu tensor in pinned memory, or in the memory-mapped file prefix/rank:<rank>_softmax_<name>.bin.
+        """
+        if self.offload == "memmap":
+            path = os.path.join(self.prefix, "rank:{}_softmax_{}.bin".format(self.rank, name))
+            mapped = torch.from_file(path, shared=True, size=tensor.numel()).view_as(tensor)
+            return mapped.copy_(tensor)
+        # Pinned memory needs CUDA, and is only useful for asynchronous copies to a GPU.
+        return tensor.pin_memory() if self.device.type == "cuda" else tensor
 
     def save_params(self,global_step):
         self.weight_name = os.path.join(self.prefix, str(global_step)+ "rank:{}_softmax_weight.pt".format(self.rank))
         self.weight_mom_name = os.path.join(self.prefix, str(global_step)+ "rank:{}_softmax_weight_mom.pt".format(self.rank))
+        if self.offload is not None and self.stream is not None:
+            # wait for the write-back of the last step
+            torch.cuda.synchronize(self.device)
         torch.save(self.weight.data, self.weight_name)
         torch.save(self.weight_mom, self.weight_mom_name)
 
@@ -85,36 +123,51 @@ class PartialFC(Module):
                 perm[positive] = 2.0
                 index = torch.topk(perm, k=self.num_sample)[1]
                 index = index.sort()[0]
+                self.sub_weight, self.sub_weight_mom = self.workspace
+                torch.index_select(self.weight, 0, index, out=self.sub_weight.data)
+                torch.index_select(self.weight_mom, 0, index, out=self.sub_weight_mom)
             else:
+                # More positive classes than num_sample: this step alone uses all of them, in temporary tensors.
                 index = positive
+                self.sub_weight = Parameter(self.weight[index])
+                self.sub_weight_mom = self.weight_mom[index]
             self.index = index
             total_label[index_positive] = torch.searchsorted(index, total_label[index_positive])
-            self.sub_weight = Parameter(self.weight[index])
-            self.sub_weight_mom = self.weight_mom[index]
+
+    def stream_context(self):
+        return torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext()
 
     def forward(self, total_features, norm_weight):
-        torch.cuda.current_stream().wait_stream(self.stream)
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
         logits = linear(total_features, norm_weight)
         return logits
 
     @torch.no_grad()
     def update(self):
-        self.weight_mom[self.index] = self.sub_weight_mom
-        self.weight[self.index] = self.sub_weight
+        self.weight_mom.index_copy_(0, self.index, self.sub_weight_mom)
+        self.weight.index_copy_(0, self.index, self.sub_weight.data)
 
     def prepare(self, label, optimizer):
-        with torch.cuda.stream(self.stream):
+        with self.stream_context():
             total_label = torch.zeros(
                 size=[self.batch_size * self.world_size], device=self.device, dtype=torch.long)
             dist.all_gather(list(total_label.chunk(self.world_size, dim=0)), label)
             self.sample(total_label)
-            optimizer.state.pop(optimizer.param_groups[-1]['params'][0], None)
-            optimizer.param_groups[-1]['params'][0] = self.sub_weight
-            optimizer.state[self.sub_weight]['momentum_buffer'] = self.sub_weight_mom
-            norm_weight = normalize(self.sub_weight)
+            # The workspace is refilled in place, the optimizer is only rebound when the sampled tensors change.
+            group = optimizer.param_groups[-1]
+            if group['params'][0] is not self.sub_weight:
+                optimizer.state.pop(group['params'][0], None)
+                group['params'][0] = self.sub_weight
+            if optimizer.state[self.sub_weight].get('momentum_buffer') is not self.sub_weight_mom:
+                optimizer.state[self.sub_weight]['momentum_buffer'] = self.sub_weight_mom
+            # The fused path normalizes the weight chunk by chunk.
+            norm_weight = normalize(self.sub_weight) if not self.fused else None
             return total_label, norm_weight
 
     def forward_backward(self, label, features, optimizer):
+        if self.fused:
+            return self.forward_backward_fused(label, features, optimizer)
         total_label, norm_weight = self.prepare(label, optimizer)
         total_features = torch.zeros(
             size=[self.batch_size * self.world_size, self.embedding_size], device=self.device)
@@ -160,7 +213,290 @@ class PartialFC(Module):
         #x_grad.mul_(self.world_size) #remove
 
         # feature gradient all-reduce
-        dist.reduce_scatter(x_grad, list(total_features.grad.chunk(self.world_size, dim=0)))
+        self.reduce_scatter(x_grad, list(total_features.grad.chunk(self.world_size, dim=0)))
         x_grad = x_grad * self.world_size #add
         # backward backbone
         return x_grad, loss_v
+
+    @torch.no_grad()
+    def forward_backward_fused(self, label, features, optimizer):
+        """
+        Same as forward_backward, computed in chunks of `chunk_size` classes: a first pass keeps a running max and
+        sum of exp per sample (online softmax), a second pass recomputes the logits of each chunk and accumulates
+        the feature and weight gradients, so neither the one-hot nor the full exp matrix is allocated. The margin
+        only changes the target logits, whose gradient goes through `margin_softmax.target_logit` with autograd;
+        the weight gradient goes through the normalization by hand.
+
+        With offloaded weights the chunks are streamed from host memory (see weight_chunks) and the SGD update of
+        the optimizer's last parameter group is applied to each chunk in the second pass, so the optimizer step
+        of the trainer has nothing left to do for the softmax weight.
+        """
+        total_label, _ = self.prepare(label, optimizer)
+        total_features = torch.zeros(
+            size=[self.batch_size * self.world_size, self.embedding_size], device=self.device)
+        dist.all_gather(list(total_features.chunk(self.world_size, dim=0)), features.data)
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        num_total = total_features.size(0)
+        s = self.margin_softmax.s
+        index = torch.where(total_label != -1)[0]
+        target = total_label[index]
+
+        # first pass: target cosines, running max and sum of exp
+        chunks = []
+        target_cosine = torch.zeros(index.size(0), device=self.device)
+        max_fc = torch.full((num_total, 1), -float("inf"), device=self.device)
+        sum_exp = torch.zeros((num_total, 1), device=self.device)
+        for i, (weight,) in enumerate(self.weight_chunks([self.sub_weight])):
+            start = i * self.chunk_size
+            end = start + weight.size(0)
+            in_chunk = (start <= target) & (target < end)
+            rows, cols = index[in_chunk], target[in_chunk] - start
+            chunks.append((start, end, in_chunk, rows, cols))
+
+            logits = linear(total_features, normalize(weight))
+            target_cosine[in_chunk] = logits[rows, cols]
+            logits.mul_(s)
+            logits[rows, cols] = self.margin_softmax.target_logit(target_cosine[in_chunk])
+            chunk_max = torch.max(logits, dim=1, keepdim=True)[0]
+            new_max = torch.max(max_fc, chunk_max)
+            sum_exp.mul_(torch.exp(max_fc - new_max))
+            sum_exp.add_(logits.sub_(new_max).exp_().sum(dim=1, keepdim=True))
+            max_fc = new_max
+
+        global_max = max_fc.clone()
+        dist.all_reduce(global_max, dist.ReduceOp.MAX)
+        sum_exp.mul_(torch.exp(max_fc - global_max))
+        dist.all_reduce(sum_exp, dist.ReduceOp.SUM)
+
+        # calculate loss
+        with torch.enable_grad():
+            target_cosine.requires_grad_(True)
+            target_logit = self.margin_softmax.target_logit(target_cosine)
+        prob = torch.exp(target_logit.detach() - global_max[index, 0]) / sum_exp[index, 0]
+        loss = torch.zeros(num_total, 1, device=self.device)
+        loss[index, 0] = prob
+        dist.all_reduce(loss, dist.ReduceOp.SUM)
+        loss_v = loss.clamp_min_(1e-30).log_().mean() * (-1)
+        # gradient w.r.t. the target cosines, through the margin
+        target_grad = torch.autograd.grad(target_logit, target_cosine, (prob - 1) / num_total)[0]
+
+        # second pass: gradient w.r.t. the cosines of each chunk, then features and weight
+        features_grad = torch.zeros_like(total_features)
+        if self.offload is None:
+            weight_grad = torch.zeros_like(self.sub_weight)
+            tensors = [self.sub_weight]
+        else:
+            tensors = [self.weight, self.weight_mom]
+        for (start, end, in_chunk, rows, cols), weight_chunks in zip(chunks, self.weight_chunks(tensors)):
+            weight = weight_chunks[0]
+            norm_weight = normalize(weight)
+            grad = linear(total_features, norm_weight).mul_(s).sub_(global_max).exp_()
+            grad.div_(sum_exp).mul_(s / num_total)
+            grad[rows, cols] = target_grad[in_chunk]
+            features_grad.addmm_(grad, norm_weight)
+            norm_grad = grad.t().mm(total_features)
+            norm_grad.sub_(norm_weight * (norm_weight * norm_grad).sum(dim=1, keepdim=True))
+            norm_grad.div_(weight.norm(dim=1, keepdim=True).clamp_min_(1e-12))
+            if self.offload is None:
+                weight_grad[start:end] = norm_grad
+                continue
+            weight_mom = weight_chunks[1]
+            self.sgd_step(weight, weight_mom, norm_grad, optimizer.param_groups[-1])
+            if weight.data_ptr() != self.weight[start:end].data_ptr():
+                # streamed copies: write back to host memory
+                self.weight[start:end].copy_(weight, non_blocking=True)
+                self.weight_mom[start:end].copy_(weight_mom, non_blocking=True)
+
+        if self.offload is None:
+            if self.sub_weight.grad is None:
+                self.sub_weight.grad = weight_grad
+            else:
+                self.sub_weight.grad.add_(weight_grad)
+
+        # feature gradient all-reduce
+        x_grad: torch.Tensor = torch.zeros_like(features)
+        self.reduce_scatter(x_grad, list(features_grad.chunk(self.world_size, dim=0)))
+        x_grad = x_grad * self.world_size
+        return x_grad, loss_v
+
+    def weight_chunks(self, tensors):
+        """
+        Iterate over the chunks of `chunk_size` rows of tensors with the same number of rows, as lists of chunks on
+        the device. Offloaded weights on a GPU are copied to two alternating device buffers on the side stream,
+        the next chunk while the current one is used (double buffering); otherwise chunks are views.
+        """
+        num_rows = tensors[0].size(0)
+        starts = range(0, num_rows, self.chunk_size)
+        if self.offload is None or self.stream is None:
+            for start in starts:
+                yield [t[start:start + self.chunk_size] for t in tensors]
+            return
+        if self.buffers is None:
+            self.buffers = [[torch.empty((self.chunk_size, self.embedding_size), device=self.device)
+                             for _ in range(2)] for _ in range(2)]
+        current = torch.cuda.current_stream(self.device)
+
+        def load(i):
+            start = starts[i]
+            with torch.cuda.stream(self.stream):
+                # the buffer of chunk i - 2 is free once the work queued on the current stream is done
+                self.stream.wait_stream(current)
+                chunks = [buffer[i % 2][:min(self.chunk_size, num_rows - start)].copy_(
+                    t[start:start + self.chunk_size], non_blocking=True) for buffer, t in zip(self.buffers, tensors)]
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            return chunks, event
+
+        pending = load(0) if len(starts) > 0 else None
+        for i in range(len(starts)):
+            chunks, event = pending
+            if i + 1 < len(starts):
+                pending = load(i + 1)
+            current.wait_event(event)
+            yield chunks
+
+    @staticmethod
+    def sgd_step(weight, weight_mom, grad, group):
+        """
+        In-place torch.optim.SGD update (weight decay, momentum, dampening) of a weight chunk.
+        """
+        if group['weight_decay'] != 0:
+            grad = grad.add_(weight, alpha=group['weight_decay'])
+        weight_mom.mul_(group['momentum']).add_(grad, alpha=1 - group['dampening'])
+        weight.add_(weight_mom, alpha=-group['lr'])
+
+    def reduce_scatter(self, output, input_list):
+        """
+        dist.reduce_scatter, emulated with an all-reduce on backends without it (gloo).
+        """
+        if dist.get_backend() != dist.Backend.GLOO:
+            dist.reduce_scatter(output, input_list)
+            return
+        total = torch.cat(input_list)
+        dist.all_reduce(total, dist.ReduceOp.SUM)
+        with torch.no_grad():
+            output.copy_(total.chunk(self.world_size, dim=0)[self.rank])
+
+
+def _run_test_rank(rank, world_size, init_method, data, results):
+    """
+    One rank of the gloo test: PartialFC.forward_backward on the local slice of the batch and of the classes.
+    """
+    import losses
+    dist.init_process_group(backend="gloo", init_method=init_method, rank=rank, world_size=world_size)
+    features, labels, weight, loss_name, mode, prefix = data
+    batch_size = features.size(0) // world_size
+    pfc = PartialFC(rank=rank, local_rank=rank, world_size=world_size, batch_size=batch_size, resume=False,
+                    margin_softmax=getattr(losses, loss_name)(), num_classes=weight.size(0),
+                    embedding_size=weight.size(1), prefix=prefix, device="cpu", fused=mode == "fused",
+                    chunk_size=5, offload="memmap" if mode == "memmap" else None)
+    local_weight = weight[pfc.class_start:pfc.class_start + pfc.num_local]
+    pfc.weight.copy_(local_weight)
+    optimizer = torch.optim.SGD(params=[{'params': pfc.parameters()}], lr=0.1)
+    local = slice(rank * batch_size, (rank + 1) * batch_size)
+    x_grad, loss_v = pfc.forward_backward(labels[local].clone(), features[local].clone(), optimizer)
+    if mode == "memmap":
+        # the offloaded weight is updated in place by plain SGD
+        weight_grad = (local_weight - pfc.weight) / 0.1
+    else:
+        weight_grad = pfc.sub_weight.grad.clone()
+    results[rank] = (x_grad.detach().clone(), float(loss_v), weight_grad)
+    dist.destroy_process_group()
+
+
+def _run_sample_test_rank(rank, world_size, init_method, data, results):
+    """
+    Single rank with sample_rate < 1: the loss and weight gradient on the sampled classes, the workspace staying
+    in place over the steps, and a step with more positive classes than num_sample not changing the later ones.
+    """
+    import torch.nn.functional as F
+    import losses
+    dist.init_process_group(backend="gloo", init_method=init_method, rank=rank, world_size=world_size)
+    features, label_steps, weight = data
+    pfc = PartialFC(rank=rank, local_rank=rank, world_size=world_size, batch_size=features.size(0), resume=False,
+                    margin_softmax=losses.CosFace(), num_classes=weight.size(0), sample_rate=0.3,
+                    embedding_size=weight.size(1), device="cpu")
+    pfc.weight.copy_(weight)
+    optimizer = torch.optim.SGD(params=[{'params': pfc.parameters()}], lr=0.1, momentum=0.9)
+    workspace = (pfc.sub_weight, pfc.sub_weight.data_ptr(), pfc.sub_weight_mom.data_ptr())
+    sizes = []
+    for labels in label_steps:
+        weight = pfc.weight.clone()
+        _, loss_v = pfc.forward_backward(labels.clone(), features.clone(), optimizer)
+        ref_weight = weight[pfc.index].requires_grad_(True)
+        ref_labels = torch.searchsorted(pfc.index, labels)
+        ref_loss = F.cross_entropy(losses.CosFace()(linear(features, normalize(ref_weight)), ref_labels), ref_labels)
+        ref_loss.backward()
+        assert abs(float(loss_v) - ref_loss.item()) < 1e-4, (float(loss_v), ref_loss.item())
+        assert torch.allclose(pfc.sub_weight.grad, ref_weight.grad, atol=1e-5)
+        optimizer.step()
+        pfc.update()
+        optimizer.zero_grad()
+        assert torch.equal(pfc.weight[pfc.index], pfc.sub_weight.data)
+        assert torch.equal(pfc.weight_mom[pfc.index], pfc.sub_weight_mom)
+        sizes.append(pfc.sub_weight.size(0))
+    reused = workspace[0] is pfc.sub_weight and workspace[1:] == (pfc.sub_weight.data_ptr(),
+                                                                  pfc.sub_weight_mom.data_ptr())
+    results[rank] = (reused, sizes)
+    dist.destroy_process_group()
+
+
+def _test():
+    import tempfile
+    import torch.multiprocessing as mp
+    import torch.nn.functional as F
+    import losses
+
+    world_size, batch_size, num_classes, embedding_size = 2, 8, 37, 16
+    torch.manual_seed(0)
+    features = normalize(torch.randn(world_size * batch_size, embedding_size))
+    labels = torch.randint(0, num_classes, (world_size * batch_size,))
+    weight = torch.normal(0, 0.01, (num_classes, embedding_size))
+
+    for loss_name in ["CosFace", "ArcFace", "CombineLoss"]:
+        # Single-process reference: full softmax over all classes.
+        ref_features = features.clone().requires_grad_(True)
+        ref_weight = weight.clone().requires_grad_(True)
+        logits = getattr(losses, loss_name)()(linear(ref_features, normalize(ref_weight)), labels.clone())
+        ref_loss = F.cross_entropy(logits, labels)
+        ref_loss.backward()
+
+        for mode in ["default", "fused", "memmap"]:
+            manager = mp.Manager()
+            results = manager.dict()
+            with tempfile.TemporaryDirectory() as tmp:
+                init_method = "file://" + os.path.join(tmp, "store")
+                mp.spawn(_run_test_rank,
+                         args=(world_size, init_method, (features, labels, weight, loss_name, mode, tmp), results),
+                         nprocs=world_size)
+            class_start = 0
+            for rank in range(world_size):
+                x_grad, loss_v, weight_grad = results[rank]
+                assert abs(loss_v - ref_loss.item()) < 1e-4, (loss_name, mode, loss_v, ref_loss.item())
+                # x_grad is scaled by the world size, because DDP averages the backbone gradients.
+                ref_x_grad = ref_features.grad[rank * batch_size:(rank + 1) * batch_size] * world_size
+                assert torch.allclose(x_grad, ref_x_grad, atol=1e-5), \
+                    (loss_name, mode, (x_grad - ref_x_grad).abs().max())
+                ref_weight_grad = ref_weight.grad[class_start:class_start + weight_grad.size(0)]
+                assert torch.allclose(weight_grad, ref_weight_grad, atol=1e-5), \
+                    (loss_name, mode, (weight_grad - ref_weight_grad).abs().max())
+                class_start += weight_grad.size(0)
+            print("{} ({}): loss {:.6f} matches the full softmax reference".format(loss_name, mode, ref_loss.item()))
+
+    # 20 classes, 6 sampled: 4 positive classes fit, 8 overflow for one step.
+    fit, overflow = torch.arange(8) % 4 * 2, torch.arange(8) * 2
+    manager = mp.Manager()
+    results = manager.dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        mp.spawn(_run_sample_test_rank, args=(1, "file://" + os.path.join(tmp, "store"),
+                                              (features[:8], [fit, fit, overflow, fit], weight[:20]), results),
+                 nprocs=1)
+    reused, sizes = results[0]
+    assert reused, "sampled weight workspace was reallocated"
+    assert sizes == [6, 6, 8, 6], sizes
+    print("sample_rate 0.3: sampled loss and gradient match, workspace reused")
+
+
+if __name__ == "__main__":
+    _test()
@@ -1,101 +1,67 @@
-import numpy as np
+import argparse
+import json
+import os
+
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
-from matplotlib.font_manager import FontProperties
-fontP = FontProperties()
-db="IJB-C"
-if (db=="agedb"):
-    agedb = [98.100,97.32,97.6,96.4,94.4,97.05,96.983,96.633,97.05,95.85,95.617,96.07,93.22]
-    accuracies=agedb
-    flops = [1000,577.5,900,1100,900,626.1,626.1,451.7,451.7,161.9,161.9,439.8,66.9]
-    nets=["VarGFaceNet", "ShuffleFaceNet 1.5", "MobileFaceNet", "MobileFaceNetV1", "ProxylessFaceNAS", "MixFaceNet-M(ours)","ShuffleMixFaceNet-M(ours)","MixFaceNet-S(ours)","ShuffleMixFaceNet-S(ours)","MixFaceNet-XS(ours)","ShuffleMixFaceNet-XS(ours)","MobileFaceNets","ShuffleFaceNet 0.5"]
-    marker=['o', '.', 'H', 'x', '+', 'v', 'v', 'v', 'v', 'v', 'v','1','2','3']
-    save_path = "./agedb.png"
-    plt.figure()
-    fig, ax = plt.subplots()
-    plt.plot(accuracies, flops, 'o')
-    plt.ylabel("Accuracy (%) ",fontsize=16)
-    plt.xlabel("MFLOPs",fontsize=16)
-    plt.ylim([93.15, 98.5])
-    plt.xlim([50, 1200])
-elif(db=="lfw"):
-    accuracies = [99.683,99.67,99.7,99.4,99.2,99.683,99.6,99.65,99.583,99.6,99.533,99.55,99.23,99.3]
-    flops = [1000,577.5,900,1100,900,626.1,626.1,451.7,451.7,161.9,161.9,439.8,66.9,1000]
-    nets=["VarGFaceNet", "ShuffleFaceNet 1.5", "MobileFaceNet", "MobileFaceNetV1", "ProxylessFaceNAS", "MixFaceNet-M(ours)","ShuffleMixFaceNet-M(ours)","MixFaceNet-S(ours)","ShuffleMixFaceNet-S(ours)","MixFaceNet-XS(ours)","ShuffleMixFaceNet-XS(ours)","MobileFaceNets","ShuffleFaceNet 0.5","AirFace"]
-    marker=['o', '.', 'H', 'x', '+', 'v', 'v', 'v', 'v', 'v', 'v','1','2','3']
-    save_path = "./lfw.png"
-    plt.figure()
-    fig, ax = plt.subplots()
-    plt.plot(accuracies, flops, 'o')
-    plt.ylabel("Accuracy (%) ",fontsize=16)
-    plt.xlabel("MFLOPs",fontsize=16)
-    plt.ylim([99.15, 99.81])
-    plt.xlim([50, 1200])
-elif(db=="megaface"):
-    accuracies = [93.9,93.0,95.2,91.3,82.8,94.26,94.24,92.23,93.60,89.40,89.24,90.16,96.52]
-    flops = [1000,577.5,900,1100,900,626.1,626.1,451.7,451.7,161.9,161.9,439.8,1000]
-    nets=["VarGFaceNet", "ShuffleFaceNet 1.5", "MobileFaceNet", "MobileFaceNetV1", "ProxylessFaceNAS", "MixFaceNet-M(ours)","ShuffleMixFaceNet-M(ours)","MixFaceNet-S(ours)","ShuffleMixFaceNet-S(ours)","MixFaceNet-XS(ours)","ShuffleMixFaceNet-XS(ours)","MobileFaceNets","AirFace"]
-    marker=['o', '.', 'H', 'x', '+', 'v', 'v', 'v', 'v', 'v', 'v','1','3']
-    save_path = "./megaface.png"
-    plt.figure()
-    fig, ax = plt.subplots()
-    plt.plot(accuracies, flops, 'o')
-    plt.ylabel("TAR at FAR1e–6 ",fontsize=16)
-    plt.xlabel("MFLOPs",fontsize=16)
-    plt.ylim([82.1, 96.7])
-    plt.xlim([50, 1200])
-elif(db=="megafacer"):
-    accuracies = [95.6,94.6,96.8,93.0 ,84.8 ,95.83 ,95.22  ,93.79, 95.19, 91.04, 91.03, 92.59, 97.93]
-    flops = [1000,577.5,900,1100,900,626.1,626.1,451.7,451.7,161.9,161.9,439.8,1000]
-    nets=["VarGFaceNet", "ShuffleFaceNet 1.5", "MobileFaceNet", "MobileFaceNetV1", "ProxylessFaceNAS", "MixFaceNet-M(ours)","ShuffleMixFaceNet-M(ours)","MixFaceNet-S(ours)","ShuffleMixFaceNet-S(ours)","MixFaceNet-XS(ours)","ShuffleMixFaceNet-XS(ours)","MobileFaceNets","AirFace"]
-    marker=['o', '.', 'H', 'x', '+', 'v', 'v', 'v', 'v', 'v', 'v','1','3']
-    save_path = "./megafacer.png"
-    plt.figure()
-    fig, ax = plt.subplots()
-    plt.plot(accuracies, flops, 'o')
-    plt.ylabel("TAR at FAR1e–6 ",fontsize=16)
-    plt.xlabel("MFLOPs",fontsize=16)
-    plt.ylim([84.1, 98.1])
-    plt.xlim([50, 1200])
 
-elif(db=="IJB-B"):
-    accuracies = [92.9,92.3,92.8,92.0,87.1,91.55,91.47,90.17,90.94,88.48,87.86]
+MARKERS = {"mixnet_s": 'v', "mixnet_m": '^', "mixnet_l": 's', "iresnet18": 'o', "iresnet34": 'H', "iresnet50": 'x',
+           "iresnet100": '+'}
+
+
+def load_results(path, batch_size, threads):
+    """
+    Rows of benchmarks/latency.py results for one batch size and thread count.
+    """
+    with open(path) as f:
+        results = json.load(f)["results"]
+    rows = [r for r in results if r["batch_size"] == batch_size and r["threads"] == threads]
+    if not rows:
+        raise ValueError("no results for batch size {} and {} threads in {}".format(batch_size, threads, path))
+    return rows
 
-    flops = [1000,577.5,900,1100,900,626.1,626.1,451.7,451.7,161.9,161.9]
-    nets=["VarGFaceNet", "ShuffleFaceNet 1.5", "MobileFaceNet", "MobileFaceNetV1", "ProxylessFaceNAS", "MixFaceNet-M(ours)","ShuffleMixFaceNet-M(ours)","MixFaceNet-S(ours)","ShuffleMixFaceNet-S(ours)","MixFaceNet-XS(ours)","ShuffleMixFaceNet-XS(ours)"]
-    marker=['o', '.', 'H', 'x', '+', 'v', 'v', 'v', 'v', 'v', 'v','1','3']
-    save_path = "./ijbb.png"
-    plt.figure()
-    fig, ax = plt.subplots()
-    plt.plot(accuracies, flops, 'o')
-    plt.ylabel("TAR at FAR1e–4 ",fontsize=16)
-    plt.xlabel("MFLOPs",fontsize=16)
-    plt.ylim([87, 93])
-    plt.xlim([50, 1200])
-elif(db=="IJB-C"):
-    accuracies = [94.7,94.3,94.7,93.9,89.7,93.42,93.5,92.30,93.08,90.73,90.43]
 
-    flops = [1000,577.5,900,1100,900,626.1,626.1,451.7,451.7,161.9,161.9]
-    nets=["VarGFaceNet", "ShuffleFaceNet 1.5", "MobileFaceNet", "MobileFaceNetV1", "ProxylessFaceNAS", "MixFaceNet-M(ours)","ShuffleMixFaceNet-M(ours)","MixFaceNet-S(ours)","ShuffleMixFaceNet-S(ours)","MixFaceNet-XS(ours)","ShuffleMixFaceNet-XS(ours)"]
-    marker=['o', '.', 'H', 'x', '+', 'v', 'v', 'v', 'v', 'v', 'v','1','3']
-    save_path = "./ijbc.png"
+def plot(rows, x_key, y_values, xlabel, ylabel, save_path):
     plt.figure()
-    fig, ax = plt.subplots()
-    plt.plot(accuracies, flops, 'o')
-    plt.ylabel("TAR at FAR1e–4 ",fontsize=16)
-    plt.xlabel("MFLOPs",fontsize=16)
-    plt.ylim([88, 95])
-    plt.xlim([50, 1200])
-p=[]
-for i in range(len(accuracies)):
-    if "ours" in nets[i]:
-        plt.plot(flops[i], accuracies[i], marker[i],markersize=12,markeredgecolor='red',label=nets[i])
-    else:
-        plt.plot(flops[i], accuracies[i], marker[i],markersize=12,label=nets[i])
+    for row in rows:
+        if row["variant"] not in y_values:
+            continue
+        family = row["family"]
+        kwargs = {"markeredgecolor": 'red'} if family.startswith("mixnet") else {}
+        plt.plot(row[x_key], y_values[row["variant"]], MARKERS.get(family, 'o'), markersize=12,
+                 label=row["variant"], **kwargs)
+    plt.ylabel(ylabel, fontsize=16)
+    plt.xlabel(xlabel, fontsize=16)
+    plt.grid()
+    plt.legend(numpoints=1, loc='lower right', fontsize=8, ncol=2)
+    plt.savefig(save_path, format='png', dpi=600)
+    plt.close()
+
+
+def main(args):
+    rows = load_results(args.results, args.batch_size, args.threads)
+    os.makedirs(args.output, exist_ok=True)
+    suffix = "b{}_t{}".format(args.batch_size, args.threads)
+    latency_label = "Latency (ms), batch {}, {} threads".format(args.batch_size, args.threads)
+    plot(rows, "mflops", {r["variant"]: r["latency_ms"] for r in rows}, "MFLOPs", latency_label,
+         os.path.join(args.output, "latency_mflops_{}.png".format(suffix)))
+    if args.accuracy is not None:
+        # {"<variant>": {"lfw": 99.6, "agedb_30": 96.6, ...}, ...} from the evaluation of trained models.
+        with open(args.accuracy) as f:
+            accuracy = json.load(f)
+        dbs = sorted({db for values in accuracy.values() for db in values})
+        for db in dbs:
+            values = {variant: acc[db] for variant, acc in accuracy.items() if db in acc}
+            plot(rows, "latency_ms", values, latency_label, "Accuracy (%) on {}".format(db),
+                 os.path.join(args.output, "{}_latency_{}.png".format(db, suffix)))
 
-plt.grid()
 
-plt.legend(numpoints=1, loc='lower right',fontsize=8,ncol=2)
-plt.savefig(save_path, format='png', dpi=600)
-plt.close()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Plot measured latency results')
+    parser.add_argument('--results', type=str, default="latency/latency.json", help='benchmarks/latency.py output')
+    parser.add_argument('--accuracy', type=str, default=None, help='JSON of verification accuracies per variant')
+    parser.add_argument('--batch_size', type=int, default=1, help='batch size to plot')
+    parser.add_argument('--threads', type=int, default=1, help='thread count to plot')
+    parser.add_argument('--output', type=str, default="latency", help='output directory')
+    main(parser.parse_args())
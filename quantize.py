@@ -0,0 +1,92 @@
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+import backbones.mixnetm as mx
+from backbones.quantization import quantize_mixnet
+from benchmarks.bench_utils import time_model
+from config import config as cfg
+from dataset import FaceCollate, MXFaceDataset, PackedFaceDataset
+from eval import verification
+
+
+def calibration_loader(args):
+    """
+    Loader over a fixed random subset of the training set, without flipping.
+    """
+    if args.format == "rec":
+        trainset = MXFaceDataset(root_dir=args.rec, local_rank=0)
+    else:
+        trainset = PackedFaceDataset(root_dir=args.rec, local_rank=0)
+    indices = np.random.RandomState(args.seed).permutation(len(trainset))[:args.num_calib]
+    return DataLoader(Subset(trainset, indices.tolist()), batch_size=args.batch_size, shuffle=False,
+                      num_workers=args.num_workers, collate_fn=FaceCollate(flip=False))
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    if args.network == "s":
+        backbone = mx.mixnet_s(embedding_size=cfg.embedding_size, width_scale=args.scale, gdw_size=args.gdw_size,
+                               shuffle=args.shuffle)
+    else:
+        backbone = mx.mixnet_m(embedding_size=cfg.embedding_size, width_scale=args.scale, gdw_size=args.gdw_size,
+                               shuffle=args.shuffle)
+    backbone.load_state_dict(torch.load(args.weights, map_location=torch.device('cpu')))
+    backbone.eval()
+
+    logging.info("calibrating on %d training images" % args.num_calib)
+    qbackbone = quantize_mixnet(backbone, calibration_loader(args), backend=args.backend)
+    if args.output is not None:
+        traced = torch.jit.trace(qbackbone, torch.zeros(1, 3, 112, 112))
+        torch.jit.save(traced, args.output)
+        logging.info("saved quantized model to %s" % args.output)
+
+    cpu = torch.device('cpu')
+    for name in args.val_targets:
+        path = os.path.join(args.val_dir or args.rec, name + ".bin")
+        if not os.path.exists(path):
+            logging.info("%s not found, skipped" % path)
+            continue
+        data_set = verification.load_bin(path, (112, 112))
+        for tag, model in [("fp32", backbone), ("int8", qbackbone)]:
+            _, _, acc, std, xnorm, _ = verification.test(data_set, model, args.batch_size, device=cpu)
+            logging.info('[%s][%s]XNorm: %f' % (name, tag, xnorm))
+            logging.info('[%s][%s]Accuracy-Flip: %1.5f+-%1.5f' % (name, tag, acc, std))
+
+    for batch_size in args.latency_batch_sizes:
+        x = torch.randn(batch_size, 3, 112, 112)
+        fp32_ms, _ = time_model(backbone, x)
+        int8_ms, _ = time_model(qbackbone, x)
+        logging.info("batch %d: fp32 %.2f ms, int8 %.2f ms, speed-up %.2fx" %
+                     (batch_size, fp32_ms, int8_ms, fp32_ms / int8_ms))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='INT8 post-training quantization of a MixNet backbone')
+    parser.add_argument('--weights', type=str, required=True, help='backbone checkpoint')
+    parser.add_argument('--network', type=str, default=cfg.net_size, choices=["s", "m"], help='MixNet size')
+    parser.add_argument('--scale', type=float, default=cfg.scale, help='width scale')
+    parser.add_argument('--gdw_size', type=int, default=cfg.gdw_size, help='GDW channels')
+    parser.add_argument('--shuffle', type=int, default=int(cfg.shuffle), help='channel shuffle (ShuffleMixFaceNet)')
+    parser.add_argument('--rec', type=str, default=cfg.rec, help='training set directory')
+    parser.add_argument('--val_dir', type=str, default=None, help='verification .bin directory, defaults to --rec')
+    parser.add_argument('--format', type=str, default="rec", choices=["rec", "packed"], help="training set format")
+    parser.add_argument('--num_calib', type=int, default=2048, help='number of calibration images')
+    parser.add_argument('--batch_size', type=int, default=64, help='calibration and verification batch size')
+    parser.add_argument('--num_workers', type=int, default=4, help='calibration loader workers')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the calibration subset')
+    parser.add_argument('--backend', type=str, default="fbgemm", choices=["fbgemm", "qnnpack"],
+                        help='quantization engine, fbgemm for x86 and qnnpack for ARM')
+    parser.add_argument('--val_targets', type=str, nargs='+', default=["lfw", "agedb_30"], help='verification sets')
+    parser.add_argument('--latency_batch_sizes', type=int, nargs='+', default=[1, 32], help='timed batch sizes')
+    parser.add_argument('--threads', type=int, default=1, help='number of intra-op threads')
+    parser.add_argument('--output', type=str, default=None, help='path of the TorchScript INT8 model')
+    args_ = parser.parse_args()
+    args_.shuffle = bool(args_.shuffle)
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    main(args_)
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+class EmbeddingService(object):
+    """
+    Asyncio embedding service with dynamic micro-batching.
+
+    Requests are queued; a batcher task collects them until `max_batch_size` crops are waiting or `max_wait_ms`
+    passed since the first one, runs one backbone forward pass for the batch in a worker thread and resolves
+    the future of every caller with its embedding. Up to `num_workers` batches run concurrently, so the next
+    batch is formed while the previous one is in the backbone.
+
+    Parameters:
+    ----------
+    backbone : nn.Module
+        Embedding model in eval mode.
+    max_batch_size : int, default 32
+        Maximum number of crops per forward pass.
+    max_wait_ms : float, default 5.0
+        Maximum time the first request of a batch waits for more requests.
+    num_workers : int, default 1
+        Number of batches in flight.
+    device : torch.device or None, default None
+        Device to run on, defaults to the device of the backbone parameters.
+    cache : EmbeddingCache or None, default None
+        Embedding cache wrapping the backbone (see utils/utils_cache.py), used instead of the plain forward pass.
+    """
+    def __init__(self, backbone, max_batch_size=32, max_wait_ms=5.0, num_workers=1, device=None, cache=None):
+        self.backbone = backbone
+        self.max_batch_size: int = max_batch_size
+        self.max_wait: float = max_wait_ms / 1000.0
+        self.num_workers: int = num_workers
+        self.device = device if device is not None else next(backbone.parameters()).device
+        self.cache = cache
+        self.num_batches = 0
+        self.num_requests = 0
+        self._queue = None
+        self._batcher = None
+        self._slots = None
+        self._executor = None
+        self._tasks = set()
+        self._running = False
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.num_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="embedding")
+        self._batcher = asyncio.get_running_loop().create_task(self._run())
+        self._running = True
+
+    async def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        # Requests not yet in a running batch are cancelled.
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+        # Wait for the batches in flight.
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def embed(self, crop):
+        """
+        Embedding of one aligned (3, H, W) uint8 crop, as a float32 array.
+        """
+        if not self._running:
+            raise RuntimeError("EmbeddingService is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((crop, future))
+        return await future
+
+    def _forward(self, crops):
+        if self.cache is not None:
+            return self.cache(crops)
+        with torch.no_grad():
+            img = torch.from_numpy(crops).to(self.device, non_blocking=True)
+            img = img.float().sub_(127.5).div_(127.5)
+            return self.backbone(img).float().cpu().numpy()
+
+    async def _fill_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        batch.append(await self._queue.get())
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            acquired = False
+            try:
+                await self._slots.acquire()
+                acquired = True
+                await self._fill_batch(batch)
+            except asyncio.CancelledError:
+                if acquired:
+                    self._slots.release()
+                # Requests taken from the queue but not yet in a running batch are cancelled on stop.
+                for _, future in batch:
+                    future.cancel()
+                raise
+            task = loop.create_task(self._process(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, batch):
+        try:
+            crops = np.stack([crop for crop, _ in batch])
+            embeddings = await asyncio.get_running_loop().run_in_executor(self._executor, self._forward, crops)
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        except Exception as e:
+            logging.exception("embedding batch failed")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            self._slots.release()
+
+    def metrics(self):
+        return {"batches": self.num_batches, "requests": self.num_requests,
+                "mean_batch_size": self.num_requests / self.num_batches if self.num_batches > 0 else 0.0}
+
+
+def _test():
+    import backbones.mixnetm as mx
+
+    backbone = mx.mixnet_s(embedding_size=128, width_scale=0.5, gdw_size=128).eval()
+    crops = np.random.RandomState(0).randint(0, 256, (10, 3, 112, 112)).astype(np.uint8)
+
+    async def run():
+        async with EmbeddingService(backbone, max_batch_size=4, max_wait_ms=20) as service:
+            embeddings = await asyncio.gather(*[service.embed(crop) for crop in crops])
+        return np.stack(embeddings), service.metrics()
+
+    embeddings, metrics = asyncio.run(run())
+
+    async def run_stopped():
+        service = EmbeddingService(backbone, max_batch_size=4)
+        # Stopping a service that is not running is a no-op.
+        await service.stop()
+        await service.start()
+        await service.stop()
+        await service.stop()
+        try:
+            await service.embed(crops[0])
+        except RuntimeError:
+            return True
+        return False
+
+    assert asyncio.run(run_stopped())
+    with torch.no_grad():
+        ref = backbone(torch.from_numpy(crops).float().sub_(127.5).div_(127.5)).numpy()
+    assert np.allclose(embeddings, ref, atol=1e-4)
+    assert metrics["batches"] == 3, metrics
+
+
+if __name__ == "__main__":
+    _test()
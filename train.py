@@ -13,7 +13,7 @@ import backbones
 import losses
 from backbones import iresnet100
 from config import config as cfg
-from dataset import MXFaceDataset, DataLoaderX
+from dataset import MXFaceDataset, DataLoaderX, FaceCollate
 from partial_fc import PartialFC
 from utils.utils_callbacks import CallBackVerification, CallBackLogging, CallBackModelCheckpoint
 from utils.utils_logging import AverageMeter, init_logging
@@ -24,9 +24,15 @@ torch.backends.cudnn.benchmark = True
 
 
 def main(args):
-    dist.init_process_group(backend='nccl', init_method='env://')
+    dist.init_process_group(backend=args.backend, init_method='env://')
     local_rank = args.local_rank
-    torch.cuda.set_device(local_rank)
+    # gloo runs on the cpu, e.g. to test distributed training on a machine without GPUs.
+    if args.backend == "gloo" or not torch.cuda.is_available():
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(local_rank)
+    fp16 = cfg.fp16 and device.type == "cuda"
     rank = dist.get_rank()
     world_size = dist.get_world_size()
 
@@ -40,24 +46,28 @@ def main(args):
     trainset = MXFaceDataset(root_dir=cfg.rec, local_rank=local_rank)
     train_sampler = torch.utils.data.distributed.DistributedSampler(
         trainset, shuffle=True)
+    loader_kwargs = {}
+    if cfg.num_workers > 0:
+        loader_kwargs = dict(prefetch_factor=cfg.prefetch_factor, persistent_workers=cfg.persistent_workers)
     train_loader = DataLoaderX(
-        local_rank=local_rank, dataset=trainset, batch_size=cfg.batch_size,
-        sampler=train_sampler, num_workers=0, pin_memory=True, drop_last=True)
+        local_rank=local_rank, device=device, dataset=trainset, batch_size=cfg.batch_size,
+        sampler=train_sampler, num_workers=cfg.num_workers, pin_memory=device.type == "cuda", drop_last=True,
+        collate_fn=FaceCollate(normalize=False), normalize=True, **loader_kwargs)
 
     dropout = 0.4 if cfg.dataset is "webface" else 0
 
     if ("resnet" in cfg.net_name):
-        backbone = eval("backbones.{}".format(cfg.net_name))(False, dropout=dropout, fp16=cfg.fp16).to(local_rank)
+        backbone = eval("backbones.{}".format(cfg.net_name))(False, dropout=dropout, fp16=fp16).to(device)
     elif (cfg.net_name=="mixfacenet"):
      if(cfg.net_size=="s"):
-        backbone = mx.mixnet_s(embedding_size=cfg.embedding_size, width_scale=cfg.scale, gdw_size=cfg.gdw_size,shuffle=cfg.shuffle).to(local_rank)
+        backbone = mx.mixnet_s(embedding_size=cfg.embedding_size, width_scale=cfg.scale, gdw_size=cfg.gdw_size,shuffle=cfg.shuffle).to(device)
      else:
-        backbone = mx.mixnet_m(embedding_size=cfg.embedding_size, width_scale=cfg.scale, gdw_size=cfg.gdw_size,shuffle=cfg.shuffle).to(local_rank)
+        backbone = mx.mixnet_m(embedding_size=cfg.embedding_size, width_scale=cfg.scale, gdw_size=cfg.gdw_size,shuffle=cfg.shuffle).to(device)
 
     if args.resume:
         try:
             backbone_pth = os.path.join(cfg.output, str(cfg.global_step)+ "backbone.pth")
-            backbone.load_state_dict(torch.load(backbone_pth, map_location=torch.device(local_rank)))
+            backbone.load_state_dict(torch.load(backbone_pth, map_location=device))
             if rank is 0:
                 logging.info("backbone resume successfully!")
         except (FileNotFoundError, KeyError, IndexError, RuntimeError):
@@ -66,14 +76,16 @@ def main(args):
     for ps in backbone.parameters():
         dist.broadcast(ps, 0)
     backbone = torch.nn.parallel.DistributedDataParallel(
-        module=backbone, broadcast_buffers=False, device_ids=[local_rank])
+        module=backbone, broadcast_buffers=False, device_ids=[local_rank] if device.type == "cuda" else None)
     backbone.train()
 
     margin_softmax = eval("losses.{}".format(args.loss))(cfg.s,cfg.m)
     module_partial_fc = PartialFC(
         rank=rank, local_rank=local_rank, world_size=world_size, resume=args.resume,
         batch_size=cfg.batch_size, margin_softmax=margin_softmax, num_classes=cfg.num_classes,
-        sample_rate=cfg.sample_rate, embedding_size=cfg.embedding_size, prefix=cfg.output ,global_step=cfg.global_step)
+        sample_rate=cfg.sample_rate, embedding_size=cfg.embedding_size, prefix=cfg.output ,global_step=cfg.global_step,
+        device=device, fused=cfg.fused_softmax, chunk_size=cfg.softmax_chunk_size,
+        offload=cfg.softmax_offload)
     opt_backbone = torch.optim.SGD(
         params=[{'params': backbone.parameters()}],
         lr=cfg.lr / 512 * cfg.batch_size * world_size,
@@ -93,13 +105,14 @@ def main(args):
     total_step = int(len(trainset) / cfg.batch_size / world_size * cfg.num_epoch)
     if rank is 0: logging.info("Total Step is: %d" % total_step)
 
-    callback_verification = CallBackVerification(5686, rank, cfg.val_targets, cfg.rec)
+    callback_verification = CallBackVerification(5686, rank, cfg.val_targets, cfg.rec,
+                                                 async_mode=cfg.async_verification, device=cfg.verification_device)
     callback_logging = CallBackLogging(50, rank, total_step, cfg.batch_size, world_size, None)
     callback_checkpoint = CallBackModelCheckpoint(rank, cfg.output)
 
     loss = AverageMeter()
     global_step = 0
-    grad_scaler = MaxClipGradScaler(cfg.batch_size, 128 * cfg.batch_size, growth_interval=100) if cfg.fp16 else None
+    grad_scaler = MaxClipGradScaler(cfg.batch_size, 128 * cfg.batch_size, growth_interval=100) if fp16 else None
     for epoch in range(start_epoch, cfg.num_epoch):
         train_sampler.set_epoch(epoch)
         for step, (img, label) in enumerate(train_loader):
@@ -107,7 +120,7 @@ def main(args):
             features = F.normalize(backbone(img))
             x_grad, loss_v = module_partial_fc.forward_backward(label, features, opt_pfc)
 
-            if cfg.fp16:
+            if fp16:
                 features.backward(grad_scaler.scale(x_grad))
                 grad_scaler.unscale_(opt_backbone)
                 clip_grad_norm_(backbone.parameters(), max_norm=5, norm_type=2)
@@ -123,11 +136,12 @@ def main(args):
             opt_backbone.zero_grad()
             opt_pfc.zero_grad()
             loss.update(loss_v, 1)
-            callback_logging(global_step, loss, epoch, cfg.fp16, grad_scaler)
+            callback_logging(global_step, loss, epoch, fp16, grad_scaler)
             callback_verification(global_step, backbone)
         callback_checkpoint(global_step, backbone, module_partial_fc)
         scheduler_backbone.step()
         scheduler_pfc.step()
+    callback_verification.wait()
     dist.destroy_process_group()
 
 
@@ -136,5 +150,7 @@ if __name__ == "__main__":
     parser.add_argument('--local_rank', type=int, default=0, help='local_rank')
     parser.add_argument('--loss', type=str, default="ArcFace", help="loss function")
     parser.add_argument('--resume', type=int, default=1, help="model resuming")
+    parser.add_argument('--backend', type=str, default="nccl", choices=["nccl", "gloo"],
+                        help="distributed backend, gloo trains on the cpu")
     args_ = parser.parse_args()
     main(args_)
@@ -0,0 +1,346 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.align_trans import estimate_norm_batch, norm_crop
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-memory LRU cache bounded by the number of entries, with hit/miss/eviction counters.
+
+    Parameters:
+    ----------
+    max_entries : int
+        Maximum number of cached values.
+    """
+    def __init__(self, max_entries):
+        self.max_entries: int = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._data),
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+    def reset_metrics(self):
+        self.hits = self.misses = self.evictions = 0
+
+
+class DiskCache(object):
+    """
+    Unbounded on-disk tier storing one `.npy` file per key in 256 sub-directories. Files are written atomically,
+    so concurrent writers of the same key are safe.
+
+    Parameters:
+    ----------
+    root : str
+        Cache directory.
+    """
+    def __init__(self, root):
+        self.root: str = root
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npy")
+
+    def get(self, key):
+        try:
+            value = np.load(self._path(key))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.{}.tmp.npy".format(path[:-len(".npy")], os.getpid(), threading.get_ident())
+        np.save(tmp, value)
+        os.replace(tmp, path)
+
+    def metrics(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class AlignmentCache(object):
+    """
+    Cache of aligned face crops in front of `norm_crop`.
+
+    The key is a blake2b hash of the landmarks quantized to `landmark_step` pixels and of the source pixels the
+    crop is sampled from (the bounding box of the warped 112x112 square), so the full frame is never hashed and
+    two faces in one frame get different keys. The footprint is derived from the closed-form `estimate_norm_batch`
+    matrix, which is cheap, so a hit costs no skimage call. A miss is computed with `norm_crop` itself: the
+    closed-form matrix differs from skimage's by about 1e-5, enough to change OpenCV's fixed-point rounding by a
+    few intensity levels. A cached crop is therefore exactly `norm_crop(img, quantized landmarks)`; with
+    landmark_step=0 the landmarks are used as they are.
+
+    Parameters:
+    ----------
+    max_entries : int, default 4096
+        Size of the in-memory LRU tier (a crop takes 37 KB).
+    disk_dir : str or None, default None
+        Directory of the optional on-disk tier.
+    landmark_step : float, default 0.25
+        Landmark quantization step in pixels.
+    image_size : int, default 112
+        Crop size.
+    createEvalDB : bool, default False
+        Whether to use the evaluation reference points, see norm_crop.
+    """
+    def __init__(self, max_entries=4096, disk_dir=None, landmark_step=0.25, image_size=112, createEvalDB=False):
+        self.memory = LRUCache(max_entries)
+        self.disk = DiskCache(disk_dir) if disk_dir is not None else None
+        self.landmark_step: float = landmark_step
+        self.image_size: int = image_size
+        self.createEvalDB: bool = createEvalDB
+
+    def _quantize(self, landmark):
+        landmark = np.asarray(landmark, dtype=np.float32)
+        if self.landmark_step <= 0:
+            return landmark
+        return (np.rint(landmark / self.landmark_step) * self.landmark_step).astype(np.float32)
+
+    def _footprint(self, img, M):
+        """
+        Bounding box (x0, y0, x1, y1) of the source pixels read by the warp M.
+        """
+        A_inv = np.linalg.inv(M[:, :2])
+        s = self.image_size - 1
+        corners = np.dot(A_inv, np.array([[0, s, 0, s], [0, 0, s, s]], dtype=np.float64) - M[:, 2:])
+        h, w = img.shape[:2]
+        x0 = int(np.clip(np.floor(corners[0].min()) - 1, 0, w))
+        y0 = int(np.clip(np.floor(corners[1].min()) - 1, 0, h))
+        x1 = int(np.clip(np.ceil(corners[0].max()) + 2, 0, w))
+        y1 = int(np.clip(np.ceil(corners[1].max()) + 2, 0, h))
+        return x0, y0, x1, y1
+
+    def key(self, img, landmark):
+        """
+        Cache key of a face and its quantized landmarks.
+        """
+        landmark = self._quantize(landmark)
+        M = estimate_norm_batch(landmark[None], image_size=self.image_size, createEvalDB=self.createEvalDB)[0]
+        x0, y0, x1, y1 = self._footprint(img, M)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(img[y0:y1, x0:x1]).tobytes())
+        h.update(np.array([x0, y0, x1, y1, self.image_size, int(self.createEvalDB)], dtype=np.int64).tobytes())
+        h.update(landmark.tobytes())
+        return h.hexdigest(), landmark
+
+    def __call__(self, img, landmark):
+        """
+        Aligned crop of `img`, see norm_crop. The returned array is shared with the cache and must not be modified.
+        """
+        key, landmark = self.key(img, landmark)
+        crop = self.memory.get(key)
+        if crop is not None:
+            return crop
+        if self.disk is not None:
+            crop = self.disk.get(key)
+        if crop is None:
+            crop = norm_crop(img, landmark, image_size=self.image_size, createEvalDB=self.createEvalDB)
+            if self.disk is not None:
+                self.disk.put(key, crop)
+        crop.setflags(write=False)
+        self.memory.put(key, crop)
+        return crop
+
+    def metrics(self):
+        metrics = self.memory.metrics()
+        if self.disk is not None:
+            metrics["disk_hits"] = self.disk.hits
+            metrics["disk_misses"] = self.disk.misses
+        return metrics
+
+
+def model_fingerprint(backbone):
+    """
+    Hash of the parameters and buffers of a model, usable as checkpoint id of an EmbeddingCache.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for name, tensor in backbone.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class EmbeddingCache(object):
+    """
+    Cache of backbone embeddings in front of the forward pass.
+
+    Entries are keyed on a blake2b hash of the checkpoint id and of the bytes of a uint8 crop, so entries of
+    another checkpoint are never served. A batch lookup forwards only the missed (deduplicated) crops, normalized
+    on the device like in training, and fills the cache with their embeddings.
+
+    The cache is only valid for frozen weights: the checkpoint id is not checked against the backbone, and
+    embeddings cached before a weight update are served after it. Create a new cache when loading other weights.
+
+    Parameters:
+    ----------
+    backbone : nn.Module
+        Embedding model in eval mode.
+    checkpoint_id : str
+        Identifier of the weights, e.g. the checkpoint file name or model_fingerprint(backbone).
+    max_entries : int, default 65536
+        Size of the LRU (a 512-d embedding takes 2 KB).
+    device : torch.device or None, default None
+        Device to run on, defaults to the device of the backbone parameters.
+    channels_last : bool, default False
+        Whether to feed the batches in channels_last memory format.
+    """
+    def __init__(self, backbone, checkpoint_id, max_entries=65536, device=None, channels_last=False):
+        import torch
+        if not checkpoint_id:
+            raise ValueError("EmbeddingCache needs the checkpoint id of the backbone weights")
+        self.backbone = backbone
+        self.checkpoint_id: str = checkpoint_id
+        self.memory = LRUCache(max_entries)
+        self.device = device if device is not None else next(backbone.parameters()).device
+        self.channels_last: bool = channels_last
+        self._prefix = hashlib.blake2b(digest_size=16)
+        self._prefix.update(self.checkpoint_id.encode('utf-8'))
+        self._torch = torch
+        self.forwarded = 0
+
+    def keys(self, crops):
+        keys = []
+        for crop in crops:
+            h = self._prefix.copy()
+            h.update(np.ascontiguousarray(crop).data)
+            keys.append(h.digest())
+        return keys
+
+    def _forward(self, crops):
+        torch = self._torch
+        with torch.no_grad():
+            img = torch.from_numpy(np.ascontiguousarray(crops)).to(self.device, non_blocking=True)
+            img = img.float().sub_(127.5).div_(127.5)
+            if self.channels_last:
+                img = img.contiguous(memory_format=torch.channels_last)
+            return self.backbone(img).float().cpu().numpy()
+
+    def __call__(self, crops):
+        """
+        Embeddings of a batch of crops.
+
+        Parameters:
+        ----------
+        crops : np.ndarray
+            (N, 3, H, W) uint8 crops.
+
+        Returns:
+        -------
+        np.ndarray
+            (N, D) float32 embeddings.
+        """
+        keys = self.keys(crops)
+        values = [self.memory.get(key) for key in keys]
+        missed = {}
+        for i, value in enumerate(values):
+            if value is None:
+                missed.setdefault(keys[i], i)
+        if missed:
+            rows = list(missed.values())
+            embeddings = self._forward(crops[rows])
+            self.forwarded += len(rows)
+            for key, embedding in zip(missed.keys(), embeddings):
+                embedding = embedding.copy()
+                embedding.setflags(write=False)
+                self.memory.put(key, embedding)
+                missed[key] = embedding
+            values = [missed[key] if value is None else value for key, value in zip(keys, values)]
+        return np.stack(values)
+
+    def metrics(self):
+        metrics = self.memory.metrics()
+        metrics["forwarded"] = self.forwarded
+        return metrics
+
+
+def _test():
+    import tempfile
+    from utils.align_trans import arcface_ref_points
+
+    rng = np.random.RandomState(0)
+    frame = rng.randint(0, 256, (480, 640, 3), dtype=np.uint8)
+    # On the quantization grid, so that a small offset maps back to the same key.
+    lmk_a = np.rint((arcface_ref_points * 1.5 + np.array([100.0, 80.0], dtype=np.float32)) * 4) / 4
+    lmk_b = arcface_ref_points * 1.5 + np.array([400.0, 200.0], dtype=np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = AlignmentCache(max_entries=1, disk_dir=tmp)
+        crop_a = cache(frame, lmk_a)
+        assert np.array_equal(crop_a, norm_crop(frame, lmk_a))
+        assert cache(frame, lmk_a + 0.05) is crop_a
+        # Changing pixels outside the footprint of face a keeps its key.
+        other = frame.copy()
+        other[300:, 300:] = 0
+        assert cache.key(other, lmk_a)[0] == cache.key(frame, lmk_a)[0]
+        cache(frame, lmk_b)
+        assert np.array_equal(cache(frame, lmk_a), crop_a)
+        metrics = cache.metrics()
+        assert metrics["hits"] == 1 and metrics["evictions"] == 2 and metrics["disk_hits"] == 1, metrics
+
+    import torch
+    import backbones.mixnetm as mx
+    backbone = mx.mixnet_s(embedding_size=128, width_scale=0.5, gdw_size=128).eval()
+    crops = rng.randint(0, 256, (6, 3, 112, 112)).astype(np.uint8)
+    crops[3] = crops[0]
+    cache = EmbeddingCache(backbone, model_fingerprint(backbone), max_entries=16)
+    embeddings = cache(crops)
+    assert cache.forwarded == 5
+    with torch.no_grad():
+        ref = backbone(torch.from_numpy(crops).float().sub_(127.5).div_(127.5)).numpy()
+    assert np.allclose(embeddings, ref, atol=1e-4)
+    assert np.array_equal(cache(crops[::-1]), embeddings[::-1]) and cache.forwarded == 5
+    # Another checkpoint id never reuses the entries.
+    assert EmbeddingCache(backbone, checkpoint_id="other").keys(crops[:1]) != cache.keys(crops[:1])
+    # Updated weights change the fingerprint, the id of a cache is never recomputed.
+    with torch.no_grad():
+        next(backbone.parameters()).add_(1.0)
+    assert model_fingerprint(backbone) != cache.checkpoint_id
+    try:
+        EmbeddingCache(backbone, None)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a checkpoint id is required")
+
+
+if __name__ == "__main__":
+    _test()
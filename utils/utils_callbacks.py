@@ -1,6 +1,9 @@
+import copy
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 from typing import List
 
 import torch
@@ -11,21 +14,41 @@ from partial_fc import PartialFC
 
 
 class CallBackVerification(object):
-    def __init__(self, frequent, rank, val_targets, rec_prefix, image_size=(112, 112)):
+    """
+    Runs the verification benchmarks on rank 0 every `frequent` steps. In async mode the backbone weights are
+    copied and evaluated on `device` in a background thread, so the training step is not blocked; results are
+    logged when they arrive and `wait` blocks until all submitted evaluations are done. At most one evaluation
+    runs at a time: snapshots submitted meanwhile are coalesced into the latest one, which runs next, and a
+    failed evaluation is logged as soon as it fails.
+    """
+    def __init__(self, frequent, rank, val_targets, rec_prefix, image_size=(112, 112), async_mode=False,
+                 device="cpu", batch_size=64):
         self.frequent: int = frequent
         self.rank: int = rank
         self.highest_acc: float = 0.0
         self.highest_acc_list: List[float] = [0.0] * len(val_targets)
         self.ver_list: List[object] = []
         self.ver_name_list: List[str] = []
+        self.batch_size: int = batch_size
+        self.async_mode: bool = async_mode
+        self.device = torch.device(device)
+        self.eval_model: torch.nn.Module = None
+        self.executor: ThreadPoolExecutor = None
+        self.pending = []
+        # latest (state_dict, global_step) submitted while an evaluation was running
+        self.queued = None
+        self.results = []
+        self.lock = threading.RLock()
         if self.rank == 0:
             self.init_dataset(val_targets=val_targets, data_dir=rec_prefix, image_size=image_size)
+            if self.async_mode:
+                self.executor = ThreadPoolExecutor(max_workers=1)
 
     def ver_test(self, backbone: torch.nn.Module, global_step: int):
         results = []
         for i in range(len(self.ver_list)):
             acc1, std1, acc2, std2, xnorm, embeddings_list = verification.test(
-                self.ver_list[i], backbone, 10, 10)
+                self.ver_list[i], backbone, self.batch_size, 10)
             logging.info('[%s][%d]XNorm: %f' % (self.ver_name_list[i], global_step, xnorm))
             logging.info('[%s][%d]Accuracy-Flip: %1.5f+-%1.5f' % (self.ver_name_list[i], global_step, acc2, std2))
             if acc2 > self.highest_acc_list[i]:
@@ -33,6 +56,57 @@ class CallBackVerification(object):
             logging.info(
                 '[%s][%d]Accuracy-Highest: %1.5f' % (self.ver_name_list[i], global_step, self.highest_acc_list[i]))
             results.append(acc2)
+        return results
+
+    def submit(self, backbone: torch.nn.Module, global_step: int):
+        module = backbone.module if hasattr(backbone, "module") else backbone
+        # Snapshot of the current weights, the training loop keeps updating the live ones.
+        state_dict = {k: v.detach().to(self.device, copy=True) for k, v in module.state_dict().items()}
+        if self.eval_model is None:
+            self.eval_model = copy.deepcopy(module).to(self.device)
+        with self.lock:
+            if self.pending:
+                if self.queued is not None:
+                    logging.info("verification of step %d skipped, evaluation still running" % self.queued[1])
+                self.queued = (state_dict, global_step)
+                return
+            self.start(state_dict, global_step)
+
+    def start(self, state_dict, global_step):
+        def run():
+            self.eval_model.load_state_dict(state_dict)
+            self.eval_model.eval()
+            return self.ver_test(self.eval_model, global_step)
+
+        future = self.executor.submit(run)
+        self.pending.append(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        with self.lock:
+            self.pending.remove(future)
+            if future.cancelled():
+                pass
+            elif future.exception() is not None:
+                logging.error("background verification failed", exc_info=future.exception())
+            else:
+                self.results.append(future.result())
+            if self.queued is not None:
+                state_dict, global_step = self.queued
+                self.queued = None
+                self.start(state_dict, global_step)
+
+    def wait(self):
+        """
+        Block until all submitted evaluations are done, and return the results of the successful ones.
+        """
+        while True:
+            with self.lock:
+                if not self.pending and self.queued is None:
+                    results, self.results = self.results, []
+                    return results
+                pending = list(self.pending)
+            wait_futures(pending)
 
     def init_dataset(self, val_targets, data_dir, image_size):
         for name in val_targets:
@@ -44,6 +118,9 @@ class CallBackVerification(object):
 
     def __call__(self, num_update, backbone: torch.nn.Module):
         if self.rank is 0 and num_update > 0 and num_update % self.frequent == 0:
+            if self.async_mode:
+                self.submit(backbone, num_update)
+                return
             backbone.eval()
             self.ver_test(backbone, num_update)
             backbone.train()
@@ -104,3 +181,59 @@ class CallBackModelCheckpoint(object):
             torch.save(backbone.module.state_dict(), os.path.join(self.output, str(global_step)+ "backbone.pth"))
         if global_step > 100 and partial_fc is not None:
             partial_fc.save_params(global_step)
+
+
+def _test():
+    import numpy as np
+    import backbones.mixnetm as mx
+
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    num_pairs = 100
+    data = rng.randint(0, 256, (num_pairs * 2, 3, 112, 112)).astype(np.uint8)
+    issame_list = (rng.rand(num_pairs) < 0.5).tolist()
+
+    backbone = mx.mixnet_s(embedding_size=128, width_scale=0.5, gdw_size=128).eval()
+    results = {}
+    for async_mode in [False, True]:
+        callback = CallBackVerification(1, 0, [], "", async_mode=async_mode)
+        callback.ver_list = [(data, issame_list)]
+        callback.ver_name_list = ["synthetic"]
+        callback.highest_acc_list = [0.0]
+        if async_mode:
+            callback(1, backbone)
+            # Weights changed after the snapshot must not leak into the running evaluation.
+            with torch.no_grad():
+                for p in backbone.parameters():
+                    p.add_(1.0)
+            results[async_mode] = callback.wait()[0]
+            with torch.no_grad():
+                for p in backbone.parameters():
+                    p.sub_(1.0)
+            # While step 2 is evaluated, the snapshot of step 3 is replaced by the one of step 4.
+            release = threading.Event()
+            steps = []
+
+            def gated_ver_test(model, global_step):
+                steps.append(global_step)
+                release.wait()
+                if global_step == 5:
+                    raise RuntimeError("evaluation failure")
+                return [float(global_step)]
+
+            callback.ver_test = gated_ver_test
+            for step in [2, 3, 4]:
+                callback(step, backbone)
+            release.set()
+            assert callback.wait() == [[2.0], [4.0]] and steps == [2, 4], steps
+            # A failed evaluation is logged and dropped, it does not block wait.
+            callback(5, backbone)
+            assert callback.wait() == [] and callback.pending == [] and steps == [2, 4, 5], steps
+        else:
+            results[async_mode] = callback.ver_test(backbone, 1)
+    assert np.allclose(results[False], results[True]), results
+    print("sync {} == async {}".format(results[False], results[True]))
+
+
+if __name__ == "__main__":
+    _test()